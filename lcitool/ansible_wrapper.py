@@ -5,19 +5,45 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import ansible_runner  # type: ignore
+import fcntl
+import hashlib
 import logging
+import os
 import shutil
+import sys
+import threading
 import yaml
 
 from ansible_runner import Runner
 from pathlib import Path
-from tempfile import TemporaryDirectory, NamedTemporaryFile
+from tempfile import TemporaryDirectory
 
 from lcitool import util, LcitoolError
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, IO, List, Optional, Set, Union
 
 log = logging.getLogger(__name__)
 
+# the libyaml based dumper is way faster, but PyYAML may be built without it
+try:
+    from yaml import CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeDumper as YAMLDumper  # type: ignore[assignment]
+
+
+def _dump_yaml(data: Any) -> str:
+    return str(yaml.dump(data, Dumper=YAMLDumper))
+
+
+def _digest(path: Path) -> Optional[str]:
+    try:
+        st = path.stat()
+        content = path.read_bytes()
+    except OSError:
+        return None
+
+    # the mode matters too, inventory scripts need to stay executable
+    return hashlib.sha256(content + str(st.st_mode).encode()).hexdigest()
+
 
 class AnsibleWrapperError(LcitoolError):
     """Global exception type for this module.
@@ -33,10 +59,16 @@ class AnsibleWrapperError(LcitoolError):
 class ExecutionError(AnsibleWrapperError):
     """Thrown whenever the Ansible runner failed the execution."""
 
-    def __init__(self, message: str):
+    def __init__(self, message: str, failed_hosts: Optional[List[str]] = None):
+        """
+        :param message: error message
+        :param failed_hosts: hosts which failed or were unreachable, if known
+        """
+
         message_prefix = "Ansible execution failed: "
         message = message_prefix + message
         super().__init__(message)
+        self.failed_hosts = failed_hosts
 
 
 class EnvironmentError(AnsibleWrapperError):
@@ -48,32 +80,324 @@ class EnvironmentError(AnsibleWrapperError):
         super().__init__(message)
 
 
+class TaskTimings:
+    """
+    Collects the timing of every task on every host of playbook runs.
+
+    The object is meant to be passed to AnsibleWrapper.run_playbook() which
+    hooks it into ansible-runner as an event handler. A single object may be
+    shared among multiple concurrent runs.
+
+    Attributes:
+        :ivar tasks: list of the finished tasks as dicts with the 'host',
+                     'play', 'task', 'path' (where the task is defined),
+                     'action', 'status' and 'duration' (in seconds) keys, in
+                     the order they finished
+    """
+
+    RESULT_EVENTS = {
+        "runner_on_ok": "ok",
+        "runner_on_failed": "failed",
+        "runner_on_skipped": "skipped",
+        "runner_on_unreachable": "unreachable",
+    }
+
+    def __init__(self, hosts: Optional[List[str]] = None, progress: bool = False):
+        """
+        :param hosts: hosts the playbook runs on (used for the progress view)
+        :param progress: print a compact progress view of the plays on stderr
+        """
+
+        self.tasks: List[Dict[str, Any]] = []
+        self._total = len(hosts) if hosts else None
+        self.progress = progress
+        self._live = progress and sys.stderr.isatty()
+        self._lock = threading.Lock()
+
+        # play -> hosts which reported any result and which failed
+        self._plays: Dict[str, Dict[str, Set[str]]] = {}
+
+        # (play, task UUID) -> hosts which finished the task
+        self._task_hosts: Dict[Any, Set[str]] = {}
+
+    def event_handler(self, event: Dict[str, Any]) -> bool:
+        """ansible-runner event handler, the events are kept on disk."""
+
+        status = self.RESULT_EVENTS.get(event.get("event", ""))
+        if status is None:
+            return True
+
+        data = event.get("event_data", {})
+        host = data.get("host")
+        play = data.get("play", "")
+        if data.get("ignore_errors"):
+            status = "ok"
+
+        with self._lock:
+            self.tasks.append(
+                {
+                    "host": host,
+                    "play": play,
+                    "task": data.get("task", ""),
+                    "path": data.get("task_path", ""),
+                    "action": data.get("task_action", ""),
+                    "status": status,
+                    "duration": data.get("duration") or 0.0,
+                }
+            )
+
+            stats = self._plays.setdefault(play, {"hosts": set(), "failed": set()})
+            stats["hosts"].add(host)
+            if status in ["failed", "unreachable"]:
+                stats["failed"].add(host)
+
+            task_hosts = self._task_hosts.setdefault(
+                (play, data.get("task_uuid")), set()
+            )
+            task_hosts.add(host)
+
+            if self._live:
+                total = self._total or len(stats["hosts"])
+                line = (
+                    f"{play}: {len(task_hosts)}/{total} hosts done, "
+                    f"{len(stats['failed'])} failed [{data.get('task', '')}]"
+                )
+                sys.stderr.write(f"\r\033[K{line[:120]}")
+                sys.stderr.flush()
+
+        return True
+
+    def close(self) -> None:
+        """Print the summary of the plays once the playbook runs finished."""
+
+        if not self.progress:
+            return
+
+        if self._live:
+            sys.stderr.write("\r\033[K")
+        for play, stats in self._plays.items():
+            total = self._total or len(stats["hosts"])
+            failed = len(stats["failed"])
+            done = len(stats["hosts"]) - failed
+            sys.stderr.write(f"{play}: {done}/{total} hosts done, {failed} failed\n")
+        sys.stderr.flush()
+
+    def report(
+        self, host_targets: Optional[Dict[str, str]] = None, top: int = 10
+    ) -> Dict[str, Any]:
+        """
+        Build a report of the slowest tasks per host and per target OS.
+
+        :param host_targets: host -> target OS mapping, the target OS part of
+                             the report is empty without it
+        :param top: number of the slowest tasks listed for each host and
+                    target OS
+        :returns: a JSON serializable dictionary
+        """
+
+        host_targets = host_targets or {}
+        hosts: Dict[str, Any] = {}
+        targets: Dict[str, Any] = {}
+        for entry in self.tasks:
+            host = entry["host"]
+            host_report = hosts.setdefault(
+                host,
+                {"target": host_targets.get(host), "duration": 0.0, "tasks": []},
+            )
+            host_report["duration"] += entry["duration"]
+            host_report["tasks"].append({k: v for k, v in entry.items() if k != "host"})
+
+            target = host_targets.get(host)
+            if target is None:
+                continue
+
+            target_tasks = targets.setdefault(target, {"hosts": set(), "tasks": {}})
+            target_tasks["hosts"].add(host)
+            task = target_tasks["tasks"].setdefault(
+                (entry["play"], entry["task"], entry["path"]),
+                {
+                    "play": entry["play"],
+                    "task": entry["task"],
+                    "path": entry["path"],
+                    "hosts": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                },
+            )
+            task["hosts"] += 1
+            task["total"] += entry["duration"]
+            task["max"] = max(task["max"], entry["duration"])
+
+        def _slowest(tasks: Any, key: str) -> List[Dict[str, Any]]:
+            return sorted(tasks, key=lambda t: t[key], reverse=True)[:top]
+
+        for host_report in hosts.values():
+            host_report["tasks"] = _slowest(host_report["tasks"], "duration")
+
+        return {
+            "hosts": hosts,
+            "targets": {
+                target: {
+                    "hosts": len(target_tasks["hosts"]),
+                    "tasks": _slowest(target_tasks["tasks"].values(), "total"),
+                }
+                for target, target_tasks in targets.items()
+            },
+        }
+
+
 class AnsibleWrapper:
-    def __init__(self) -> None:
-        self._tempdir: TemporaryDirectory = TemporaryDirectory(
-            prefix="ansible_runner", dir=util.get_temp_dir()
-        )
-        self._private_data_dir: Path = Path(self._tempdir.name)
+    """
+    Attributes:
+        :ivar persistent: whether the persistent workspace is used
+    """
+
+    # persistent workspace, relative to the lcitool cache dir
+    WORKSPACE_DIR = "ansible-runner"
+
+    # SSH control sockets of the persistent workspace, relative to the
+    # lcitool cache dir (the host facts go to util.get_ansible_facts_dir())
+    CONTROL_PATH_DIR = "ansible-cp"
 
-    def _get_default_params(self) -> Dict[str, Union[str, Any]]:
+    # lifetime of the cached facts and of idle SSH master connections
+    FACT_CACHE_TIMEOUT = 24 * 60 * 60
+    CONTROL_PERSIST = 10 * 60
+
+    # number of runs whose artifacts are kept in the persistent workspace
+    KEEP_ARTIFACTS = 3
+
+    # report of the task timings of the last playbook run, relative to the
+    # lcitool cache dir
+    TIMINGS_FILE = "ansible-timings.json"
+
+    def __init__(self, persistent: bool = False) -> None:
+        """
+        :param persistent: use the persistent workspace in the lcitool cache
+                           dir, which is only updated with what changed since
+                           the last run and in which Ansible caches the host
+                           facts and keeps SSH connections open for a while;
+                           if another lcitool process holds the workspace, a
+                           temporary one is used instead (the fact cache and
+                           the SSH connections are still shared)
+        """
+
+        self._tempdir: Optional[TemporaryDirectory] = None
+        self._lock: Optional[IO[str]] = None
+        self._keep_state = persistent
+
+        self.persistent = persistent and self._lock_workspace()
+        if self.persistent:
+            self._private_data_dir = Path(util.get_cache_dir(), self.WORKSPACE_DIR)
+        else:
+            self._tempdir = TemporaryDirectory(
+                prefix="ansible_runner", dir=util.get_temp_dir()
+            )
+            self._private_data_dir = Path(self._tempdir.name)
+
+    def _lock_workspace(self) -> bool:
+        workspace = Path(util.get_cache_dir(), self.WORKSPACE_DIR)
+        workspace.mkdir(parents=True, exist_ok=True)
+
+        lock = open(workspace.with_suffix(".lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            log.debug(f"Ansible workspace '{workspace}' in use, not using it")
+            lock.close()
+            return False
+
+        # the lock is released once the file gets closed with the object
+        self._lock = lock
+        return True
+
+    @staticmethod
+    def _write(dst: Path, content: str) -> None:
+        try:
+            if dst.read_text() == content:
+                return
+        except (OSError, UnicodeError):
+            pass
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        util.atomic_write(dst, content)
+
+    @staticmethod
+    def _sync(src: Path, dst: Path) -> Set[Path]:
+        """
+        Copy a file or directory tree, skipping files whose content matches.
+
+        :returns: set of the destination file paths
+        """
+
+        files = [(src, dst)]
+        if src.is_dir():
+            files = [
+                (path, Path(dst, path.relative_to(src)))
+                for path in src.rglob("*")
+                if path.is_file()
+            ]
+
+        for src_path, dst_path in files:
+            if _digest(src_path) != _digest(dst_path):
+                dst_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(src_path, dst_path)
+
+        return set(dst_path for _, dst_path in files)
+
+    @staticmethod
+    def _remove_stale(root: Path, keep: Set[Path]) -> None:
+        if not root.exists():
+            return
+
+        # children sort after their parents, so remove bottom-up
+        for path in sorted(root.rglob("*"), reverse=True):
+            if path.is_dir() and not path.is_symlink():
+                if not any(path.iterdir()):
+                    path.rmdir()
+            elif path not in keep:
+                path.unlink()
+
+    def _get_default_params(self) -> Dict[str, Any]:
         ansible_log_path = Path(util.get_cache_dir(), "ansible.log").as_posix()
-        default_params = {
+        envvars = {
+            "ANSIBLE_DISPLAY_SKIPPED_HOSTS": "False",
+            "ANSIBLE_FORKS": "16",
+            "ANSIBLE_NOCOWS": "True",
+            "ANSIBLE_LOG_PATH": ansible_log_path,
+            "ANSIBLE_SSH_PIPELINING": "True",
+            # Group names officially cannot contain dashes, because those
+            # characters are invalid in Python identifiers and it caused
+            # issues in some Ansible scenarios like using the dot notation,
+            # e.g. groups.group-with-dash. In simple group names like
+            # ours dashes are still perfectly fine, so ignore the warning
+            "ANSIBLE_TRANSFORM_INVALID_GROUP_CHARS": "ignore",
+        }
+        default_params: Dict[str, Any] = {
             "private_data_dir": self._private_data_dir,
-            "envvars": {
-                "ANSIBLE_DISPLAY_SKIPPED_HOSTS": "False",
-                "ANSIBLE_FORKS": "16",
-                "ANSIBLE_NOCOWS": "True",
-                "ANSIBLE_LOG_PATH": ansible_log_path,
-                "ANSIBLE_SSH_PIPELINING": "True",
-                # Group names officially cannot contain dashes, because those
-                # characters are invalid in Python identifiers and it caused
-                # issues in some Ansible scenarios like using the dot notation,
-                # e.g. groups.group-with-dash. In simple group names like
-                # ours dashes are still perfectly fine, so ignore the warning
-                "ANSIBLE_TRANSFORM_INVALID_GROUP_CHARS": "ignore",
-            },
+            "envvars": envvars,
         }
 
+        if self._keep_state:
+            facts_dir = util.get_ansible_facts_dir()
+            control_path_dir = Path(util.get_cache_dir(), self.CONTROL_PATH_DIR)
+            ssh_args = [
+                "-C",
+                "-o ControlMaster=auto",
+                f"-o ControlPersist={self.CONTROL_PERSIST}s",
+            ]
+
+            # only gather the facts of hosts which aren't in the cache and
+            # keep the SSH connections open for the next run
+            envvars["ANSIBLE_GATHERING"] = "smart"
+            envvars["ANSIBLE_CACHE_PLUGIN"] = "jsonfile"
+            envvars["ANSIBLE_CACHE_PLUGIN_CONNECTION"] = facts_dir.as_posix()
+            envvars["ANSIBLE_CACHE_PLUGIN_TIMEOUT"] = str(self.FACT_CACHE_TIMEOUT)
+            envvars["ANSIBLE_SSH_ARGS"] = " ".join(ssh_args)
+            envvars["ANSIBLE_SSH_CONTROL_PATH_DIR"] = control_path_dir.as_posix()
+
+        if self.persistent:
+            default_params["rotate_artifacts"] = self.KEEP_ARTIFACTS
+
         return default_params
 
     def prepare_env(
@@ -95,6 +419,11 @@ class AnsibleWrapper:
         lcitool to be able to use the Ansible runner. As part of this process
         some Ansible input data are created/symlinked from the main git repo.
 
+        The environment can be prepared in multiple steps, e.g. the inventory
+        can be queried first and the playbook added later on. Passing any of
+        the parameters again replaces the corresponding data prepared before
+        (the group_vars are part of the inventory).
+
         :param playbookdir: absolute path to the directory containing the
                             playbook and its data (as Path());
                             we don't touch playbooks, so the source path is
@@ -120,45 +449,57 @@ class AnsibleWrapper:
                 raise EnvironmentError(f"{playbookdir} is not a directory")
 
             dst = Path(self._private_data_dir, "project")
-            dst.symlink_to(playbookdir, target_is_directory=True)
+            if not dst.is_symlink() or os.readlink(dst) != str(playbookdir):
+                dst.unlink(missing_ok=True)
+                dst.symlink_to(playbookdir, target_is_directory=True)
 
+        inventory_dir = Path(self._private_data_dir, "inventory")
+        group_vars_dir = Path(inventory_dir, "group_vars")
+
+        # only the files which changed since the last time are rewritten
+        # (which matters with the persistent workspace), the stale ones are
+        # removed afterwards
+        inventory_files: Set[Path] = set()
         if inventories:
-            dst = Path(self._private_data_dir, "inventory")
-            dst.mkdir()
+            inventory_dir.mkdir(exist_ok=True)
 
             # NOTE: If we're ever to support multiple inventory sources in the
             # frontend, we'll need to make sure we copy all user data using
-            # 'tempfile' primitives in order to avoid file name conflicts among
+            # distinct file names in order to avoid file name conflicts among
             # all the sources, otherwise we'd lose data due to rewriting the
             # impacted files.
-            for inventory in inventories:
+            for i, inventory in enumerate(inventories):
                 if isinstance(inventory, dict):
-                    with NamedTemporaryFile("w", dir=dst, delete=False) as fd:
-                        yaml.dump(inventory, fd)
+                    dst = Path(inventory_dir, f"lcitool-inventory-{i}.yml")
+                    self._write(dst, _dump_yaml(inventory))
+                    inventory_files.add(dst)
                 elif isinstance(inventory, Path) or isinstance(inventory, str):
+                    inventory = Path(inventory)
                     if inventory.is_dir():
-                        shutil.copytree(inventory, dst, dirs_exist_ok=True)
+                        dst = inventory_dir
                     else:
-                        shutil.copy2(inventory, dst)
+                        dst = Path(inventory_dir, inventory.name)
+                    inventory_files |= self._sync(inventory, dst)
 
+        group_vars_files = set()
         if group_vars:
-            dst_dir = Path(self._private_data_dir, "inventory/group_vars")
-            dst_dir.mkdir(parents=True, exist_ok=True)
-
             for group in group_vars:
                 log.debug(f"Dumping group vars for [{group}]: " f"{group_vars[group]}")
 
-                dst = Path(dst_dir, group + ".yml")
-                with open(dst, "w") as fp:
-                    yaml.dump(group_vars[group], fp)
+                dst = Path(group_vars_dir, group + ".yml")
+                self._write(dst, _dump_yaml(group_vars[group]))
+                group_vars_files.add(dst)
 
-        if extravars:
-            dst_dir = Path(self._private_data_dir, "env")
-            dst_dir.mkdir()
+        if inventories:
+            self._remove_stale(inventory_dir, inventory_files | group_vars_files)
+        elif group_vars:
+            self._remove_stale(group_vars_dir, group_vars_files)
 
-            dst = Path(dst_dir, "extravars")
-            with open(dst, "w") as fp:
-                yaml.dump(extravars, fp)
+        if extravars:
+            self._write(
+                Path(self._private_data_dir, "env", "extravars"),
+                _dump_yaml(extravars),
+            )
 
     def _run(self, params: Any, **kwargs: Any) -> Runner:
         """
@@ -183,16 +524,25 @@ class AnsibleWrapper:
         if runner.status != "successful":
             error = runner.stderr.read()
             message = f"Failed to execute Ansible command '{cmd}': {error}"
-            raise ExecutionError(message)
+
+            failed_hosts = None
+            stats = runner.stats
+            if stats:
+                failed = set(stats.get("failures", {})) | set(stats.get("dark", {}))
+                failed_hosts = sorted(failed)
+            raise ExecutionError(message, failed_hosts)
 
         return runner
 
     def get_inventory(
         self,
+        export: bool = False,
     ) -> Any:
         """
         Returns a YAML-formatted Ansible inventory populated from all sources.
 
+        :param export: keep the inventory group vars in their groups rather
+                       than merging them into the vars of each host
         :returns: a dictionary corresponding to the Ansible YAML format.
         """
 
@@ -224,6 +574,7 @@ class AnsibleWrapper:
                 action="list",
                 inventories=[inventory_path],
                 response_format="yaml",
+                export=export or None,
                 **params,
             )
         except ansible_runner.exceptions.AnsibleRunnerException as ex:
@@ -237,21 +588,62 @@ class AnsibleWrapper:
                 f"Got this from Ansible: {inventory}"
             )
 
+    @staticmethod
+    def default_forks(hosts: int, jobs: int = 1) -> int:
+        """
+        Number of forks suitable for running a playbook on a number of hosts.
+
+        The forks mostly wait for the remote hosts, so there can be a few of
+        them per local CPU, but never more than there are hosts.
+
+        :param hosts: number of hosts the playbook runs on
+        :param jobs: number of playbook runs sharing the local CPUs
+        :returns: number of forks
+        """
+
+        cpus = os.cpu_count() or 1
+        return max(1, min(hosts, 4 * cpus // jobs))
+
     def run_playbook(
-        self, limit: Optional[List[str]] = None, verbosity: int = 0
-    ) -> Runner:
+        self,
+        limit: Optional[List[str]] = None,
+        verbosity: int = 0,
+        forks: Optional[int] = None,
+        strategy: Optional[str] = None,
+        timings: Optional[TaskTimings] = None,
+    ) -> TaskTimings:
         """
         :param limit: list of hosts to restrict the playbook execution to
         :param verbosity: verbosity of underlying ansible invocation
-        :returns: None
+        :param forks: number of hosts to run the tasks on in parallel
+                      (default: 16)
+        :param strategy: Ansible strategy plugin to use, e.g. 'free' not to
+                         wait for all the hosts to finish a task before
+                         starting the next one (default: 'linear')
+        :param timings: TaskTimings object to collect the task timings in,
+                        useful when the playbook fails or for sharing one
+                        among multiple runs; the Ansible output is replaced
+                        by its progress view if it has one enabled
+        :returns: TaskTimings object with the timings of the tasks
         """
 
+        if timings is None:
+            timings = TaskTimings(limit)
+
         params = self._get_default_params()
         params["playbook"] = "main.yml"
+        params["event_handler"] = timings.event_handler
+        if timings.progress:
+            params["quiet"] = True
 
         if verbosity:
             params["verbosity"] = verbosity
         if limit:
             params["limit"] = ",".join(limit)
+        if forks:
+            params["envvars"]["ANSIBLE_FORKS"] = str(forks)
+        if strategy:
+            params["envvars"]["ANSIBLE_STRATEGY"] = strategy
 
         self._run(params)
+        return timings
@@ -4,10 +4,13 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import hashlib
+import json
 import logging
 import sys
 import textwrap
-from typing import Any, Callable, Dict, Optional, Union
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import argparse
 
 from pathlib import Path
@@ -30,6 +33,8 @@ from lcitool.formatters import ShellBuildEnvFormatter
 from lcitool.manifest import Manifest
 from lcitool.containers import Docker, Podman, ContainerExecError
 from lcitool.containers.containers import Container
+from lcitool.containers.ccache import CompilerCache
+from lcitool.containers.matrix import ContainerMatrix
 
 
 log = logging.getLogger(__name__)
@@ -78,12 +83,19 @@ class Application:
         self,
         playbook: str,
         hosts_pattern: str,
-        projects_pattern: str,
+        projects_pattern: Optional[str],
         config_path: Optional[Path],
         data_dir: DataDir,
         verbosity: int = 0,
+        refresh_inventory: bool = False,
+        libvirt_inventory: bool = False,
+        forks: Optional[int] = None,
+        strategy: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        skip_unchanged: bool = False,
+        progress: bool = False,
     ) -> None:
-        from lcitool.ansible_wrapper import AnsibleWrapper
+        from lcitool.ansible_wrapper import AnsibleWrapper, ExecutionError, TaskTimings
 
         log.debug(
             f"Executing playbook '{playbook}': "
@@ -96,21 +108,37 @@ class Application:
         targets = Targets(data_dir)
         packages = Packages(data_dir)
         projects = Projects(data_dir)
+        inventory_path = None
+        if not libvirt_inventory:
+            inventory_path = util.get_datadir_inventory(data_dir)
+
+        # the inventory and the playbook share the runner environment, which
+        # persists across invocations
+        log.debug("Preparing Ansible runner environment")
+        ansible_runner = AnsibleWrapper(persistent=True)
         inventory = Inventory(
-            targets, config, inventory_path=util.get_datadir_inventory(data_dir)
+            targets,
+            config,
+            inventory_path=inventory_path,
+            refresh=refresh_inventory,
+            ansible_runner=ansible_runner,
         )
 
         hosts_expanded = inventory.expand_hosts(hosts_pattern)
-        projects_expanded = projects.expand_names(projects_pattern)
+        projects_expanded = []
+        if projects_pattern:
+            projects_expanded = projects.expand_names(projects_pattern)
 
         playbook_base = Path(base, "playbooks", playbook)
         group_vars = dict()
 
+        playbook_paths = [playbook_base]
         user_pre = False
         if data_dir:
             assert data_dir.path
             ansible_path = Path(data_dir.path, "ansible")
             if ansible_path.exists():
+                playbook_paths.append(ansible_path)
                 if Path(ansible_path, "pre/tasks/main.yml").exists():
                     user_pre = True
 
@@ -125,30 +153,205 @@ class Application:
             }
         )
 
-        log.debug("Preparing Ansible runner environment")
-        ansible_runner = AnsibleWrapper()
-
-        for host in hosts_expanded:
-            # packages are evaluated on a target level and since the
-            # host->target mapping is N-1, we can skip hosts belonging to a
-            # target group for which we already evaluated the package list
-            target_name = inventory.get_host_target_name(host)
-            if target_name in group_vars:
-                continue
-
+        # packages are evaluated on a target level and since the host->target
+        # mapping is N-1, the package lists are only evaluated once for each
+        # target group
+        target_names = dict.fromkeys(
+            inventory.get_host_target_name(host) for host in hosts_expanded
+        )
+        for target_name in target_names:
             target = BuildTarget(targets, packages, target_name)
             group_vars[target_name] = inventory.get_group_vars(
                 target, projects, projects_expanded
             )
 
-        ansible_runner.prepare_env(
-            playbookdir=playbook_base,
-            inventories=[inventory.ansible_inventory],
-            group_vars=group_vars,
-            extravars=extra_vars,
+        # very large host lists are split into batches run by concurrent
+        # ansible-runner invocations, the first one reuses the persistent
+        # workspace and the others fall back to temporary ones
+        batches = [hosts_expanded]
+        if batch_size and len(hosts_expanded) > batch_size:
+            batches = [
+                hosts_expanded[i : i + batch_size]
+                for i in range(0, len(hosts_expanded), batch_size)
+            ]
+        if forks is None:
+            forks = AnsibleWrapper.default_forks(len(batches[0]), len(batches))
+
+        # hosts whose fingerprint matches the one of their last successful
+        # update only get their installed packages updated by the playbook
+        playbook_digest = self._tree_digest(playbook_paths)
+        fingerprints: Dict[str, str] = {}
+        unchanged: List[str] = []
+
+        runners = [ansible_runner]
+        runners.extend(AnsibleWrapper(persistent=True) for _ in batches[1:])
+        for runner, batch in zip(runners, batches):
+            batch_inventory = inventory.get_ansible_inventory_subset(batch)
+            batch_targets = batch_inventory["all"]["children"]
+            for target_name, group in batch_targets.items():
+                for host, host_vars in group["hosts"].items():
+                    fingerprint = self._host_fingerprint(
+                        playbook_digest,
+                        host_vars,
+                        group_vars[target_name],
+                        extra_vars,
+                    )
+                    fingerprints[host] = fingerprint
+                    if skip_unchanged and self._load_fingerprint(host) == fingerprint:
+                        host_vars["host_unchanged"] = True
+                        unchanged.append(host)
+                    else:
+                        self._store_fingerprint(host, None)
+
+            runner.prepare_env(
+                playbookdir=playbook_base,
+                inventories=[batch_inventory],
+                group_vars={t: group_vars[t] for t in batch_targets},
+                extravars=extra_vars,
+            )
+
+        if unchanged:
+            log.info(
+                f"{len(unchanged)} of {len(hosts_expanded)} hosts unchanged since "
+                "their last update, only updating their installed packages "
+                "(use --force to update them fully)"
+            )
+
+        log.debug(
+            f"Running Ansible with playbook '{playbook_base.name}': "
+            f"batches={len(batches)} forks={forks} strategy={strategy}"
         )
-        log.debug(f"Running Ansible with playbook '{playbook_base.name}'")
-        ansible_runner.run_playbook(limit=hosts_expanded, verbosity=verbosity)
+        timings = TaskTimings(hosts_expanded, progress=progress)
+        try:
+            if len(batches) == 1:
+                ansible_runner.run_playbook(
+                    limit=hosts_expanded,
+                    verbosity=verbosity,
+                    forks=forks,
+                    strategy=strategy,
+                    timings=timings,
+                )
+            else:
+                self._run_playbook_batches(
+                    runners, batches, verbosity, forks, strategy, timings
+                )
+        except ExecutionError as ex:
+            # the hosts which didn't fail were updated nevertheless
+            if ex.failed_hosts is not None:
+                for host, fingerprint in fingerprints.items():
+                    if host not in ex.failed_hosts:
+                        self._store_fingerprint(host, fingerprint)
+            raise
+        finally:
+            timings.close()
+
+            # the timings of failed runs are just as interesting
+            host_targets = {
+                h: inventory.get_host_target_name(h) for h in hosts_expanded
+            }
+            util.dump_cache_file(
+                AnsibleWrapper.TIMINGS_FILE, timings.report(host_targets)
+            )
+
+        for host, fingerprint in fingerprints.items():
+            self._store_fingerprint(host, fingerprint)
+
+    @staticmethod
+    def _tree_digest(paths: List[Path]) -> str:
+        """Compute a digest of the names and contents of the files in 'paths'."""
+
+        digest = hashlib.sha256()
+        for path in paths:
+            for file in sorted(path.rglob("*")):
+                if not file.is_file():
+                    continue
+                content = file.read_bytes()
+                name = file.relative_to(path).as_posix()
+                digest.update(f"{name}\0{len(content)}\0".encode("utf-8"))
+                digest.update(content)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _host_fingerprint(
+        playbook_digest: str,
+        host_vars: Dict[str, Any],
+        group_vars: Dict[str, Any],
+        extra_vars: Dict[str, Any],
+    ) -> str:
+        """Compute a fingerprint of everything the update of a host depends on."""
+
+        data = {
+            "playbook": playbook_digest,
+            "host_vars": host_vars,
+            "group_vars": group_vars,
+            "extra_vars": extra_vars,
+        }
+        serialized = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _load_fingerprint(host: str) -> Optional[str]:
+        path = Path(util.get_update_fingerprints_dir(), host)
+        try:
+            return path.read_text().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _store_fingerprint(host: str, fingerprint: Optional[str]) -> None:
+        """Store the fingerprint of the host's last update (None drops it)."""
+
+        path = Path(util.get_update_fingerprints_dir(), host)
+        try:
+            if fingerprint is None:
+                path.unlink(missing_ok=True)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                util.atomic_write(path, fingerprint + "\n")
+        except OSError as ex:
+            log.debug(f"Failed to store update fingerprint '{path}': {ex}")
+
+    @staticmethod
+    def _run_playbook_batches(
+        runners: List[Any],
+        batches: List[List[str]],
+        verbosity: int,
+        forks: int,
+        strategy: Optional[str],
+        timings: Any = None,
+    ) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        from lcitool.ansible_wrapper import AnsibleWrapperError, ExecutionError
+
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            futures = [
+                executor.submit(
+                    runner.run_playbook,
+                    limit=batch,
+                    verbosity=verbosity,
+                    forks=forks,
+                    strategy=strategy,
+                    timings=timings,
+                )
+                for runner, batch in zip(runners, batches)
+            ]
+
+        # merge the results of all the batches
+        failed: List[str] = []
+        for i, (batch, future) in enumerate(zip(batches, futures)):
+            try:
+                future.result()
+            except AnsibleWrapperError as ex:
+                log.debug(f"Batch {i + 1}/{len(batches)} failed: {ex}")
+                failed_hosts = getattr(ex, "failed_hosts", None)
+                failed.extend(failed_hosts if failed_hosts is not None else batch)
+
+        if failed:
+            total = sum(len(batch) for batch in batches)
+            raise ExecutionError(
+                f"{len(failed)} of {total} hosts failed: " + ", ".join(failed),
+                failed,
+            )
 
     @required_deps("ansible_runner", "libvirt")
     def _action_hosts(self, args: argparse.Namespace) -> None:
@@ -161,7 +364,10 @@ class Application:
         config = Config(config_path)
         targets = Targets(args.data_dir)
         inventory = Inventory(
-            targets, config, inventory_path=util.get_datadir_inventory(args.data_dir)
+            targets,
+            config,
+            inventory_path=util.get_datadir_inventory(args.data_dir),
+            refresh=args.refresh_inventory,
         )
         for host in sorted(inventory.hosts):
             print(host)
@@ -186,25 +392,10 @@ class Application:
         for project in sorted(projects.names):
             print(project)
 
-    @required_deps("libvirt")
-    def _action_install(self, args: argparse.Namespace) -> None:
-        from lcitool.install import VirtInstall
-
-        self._entrypoint_debug(args)
-
-        facts = {}
-        config_path = None
-        if args.config:
-            config_path = args.config.name
-
-        config = Config(config_path)
-        targets = Targets(args.data_dir)
-        inventory = Inventory(
-            targets, config, inventory_path=util.get_datadir_inventory(args.data_dir)
-        )
-        host = args.host
-        target = args.target
-
+    @staticmethod
+    def _get_install_facts(
+        inventory: Inventory, targets: Targets, host: str, target: Optional[str]
+    ) -> Dict[str, Any]:
         try:
             facts = inventory.host_facts[host]
         except KeyError:
@@ -217,7 +408,7 @@ class Application:
             if target not in targets.targets:
                 raise ApplicationError(f"Unsupported target OS '{target}'")
 
-            facts = targets.target_facts[target]
+            return targets.target_facts[target]
         else:
             if target is not None:
                 raise ApplicationError(
@@ -228,10 +419,83 @@ class Application:
                 raise ApplicationError(
                     f"fully_managed=True not set for {host}, refusing to proceed"
                 )
+        return facts
 
+    def _expand_install_hosts(
+        self, pattern: str, target: Optional[str], inventory: Inventory, targets: Targets
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Expand the hosts to install.
+
+        :param pattern: comma separated list of inventory hosts (globs are
+                        accepted) or new hosts given as 'host:target' pairs
+        :param target: target OS of the hosts lacking an explicit one
+        :returns: list of (host name, host facts) tuples
+        """
+
+        hosts: Dict[str, Dict[str, Any]] = {}
+        for item in pattern.split(","):
+            name, _, explicit_target = item.strip().partition(":")
+            host_target = explicit_target or target
+
+            if any(c in name for c in "*?[") and name not in inventory.host_facts:
+                names = inventory.expand_hosts(name)
+            else:
+                names = [name]
+
+            for name in names:
+                hosts[name] = self._get_install_facts(
+                    inventory, targets, name, host_target
+                )
+
+        return list(hosts.items())
+
+    @required_deps("libvirt")
+    def _action_install(self, args: argparse.Namespace) -> None:
+        from lcitool.install import BatchInstall, VirtInstall
+
+        self._entrypoint_debug(args)
+
+        config_path = None
+        if args.config:
+            config_path = args.config.name
+
+        config = Config(config_path)
+        targets = Targets(args.data_dir)
+        inventory = Inventory(
+            targets,
+            config,
+            inventory_path=util.get_datadir_inventory(args.data_dir),
+            refresh=args.refresh_inventory,
+        )
+        hosts = self._expand_install_hosts(args.host, args.target, inventory, targets)
+
+        if len(hosts) > 1:
+            results = BatchInstall(
+                config,
+                strategy=args.strategy,
+                jobs=args.jobs,
+                force_download=args.force,
+                template=args.template,
+                offline=args.offline,
+            ).run(hosts, wait=args.wait)
+
+            failed = [r["host"] for r in results if r["error"]]
+            if failed:
+                raise ApplicationError(
+                    f"Failed to install {len(failed)} of {len(results)} hosts: "
+                    + ", ".join(failed)
+                )
+            return
+
+        host, facts = hosts[0]
         if args.strategy == "cloud":
             virt_install = VirtInstall.from_vendor_image(
-                name=host, config=config, facts=facts, force_download=args.force
+                name=host,
+                config=config,
+                facts=facts,
+                force_download=args.force,
+                offline=args.offline,
             )
         elif args.strategy == "template":
             virt_install = VirtInstall.from_template_image(
@@ -256,8 +520,129 @@ class Application:
             config_path,
             args.data_dir,
             args.verbose,
+            args.refresh_inventory,
+            forks=args.forks,
+            strategy=args.strategy,
+            batch_size=args.batch_size,
+            skip_unchanged=not args.force,
+            progress=args.progress,
+        )
+
+    @required_deps("ansible_runner", "libvirt")
+    def _action_template_build(self, args: argparse.Namespace) -> None:
+        from lcitool.install.template import TemplateBuilder
+
+        self._entrypoint_debug(args)
+
+        config_path = None
+        if args.config:
+            config_path = args.config.name
+
+        config = Config(config_path)
+        targets = Targets(args.data_dir)
+        if args.target not in targets.targets:
+            raise ApplicationError(f"Unsupported target OS '{args.target}'")
+
+        builder = TemplateBuilder(
+            config,
+            args.target,
+            targets.target_facts[args.target],
+            force_download=args.force,
+        )
+        try:
+            builder.install()
+
+            # the builder VM is a libvirt domain, it's not going to be in the
+            # inventory from the data dir
+            self._execute_playbook(
+                "update",
+                builder.name,
+                args.projects,
+                config_path,
+                args.data_dir,
+                args.verbose,
+                libvirt_inventory=True,
+            )
+            template = builder.seal(projects=args.projects or "")
+        finally:
+            builder.cleanup()
+
+        print(template.path)
+
+    @staticmethod
+    def _format_size(size: int) -> str:
+        value = float(size)
+        for unit in ["B", "KiB", "MiB", "GiB"]:
+            if value < 1024:
+                break
+            value /= 1024
+        else:
+            unit = "TiB"
+        return f"{value:.1f} {unit}"
+
+    @required_deps("gi")
+    def _action_images_list(self, args: argparse.Namespace) -> None:
+        from lcitool.install.image import Images
+
+        self._entrypoint_debug(args)
+
+        entries = Images().list()
+        if not entries:
+            return
+
+        print(f"{'TARGET':<20} {'ARCH':<8} {'SIZE':>10}  {'LAST USED':<16}  IMAGE")
+        for entry in entries:
+            metadata = entry["metadata"]
+            last_used = "never"
+            if entry["last_used"]:
+                last_used = time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(entry["last_used"])
+                )
+
+            notes = []
+            if not entry["latest"]:
+                notes.append("superseded")
+            if not metadata.get("verified"):
+                notes.append("unverified")
+
+            line = (
+                f"{metadata['target']:<20} {metadata['arch']:<8} "
+                f"{self._format_size(entry['size']):>10}  {last_used:<16}  "
+                f"{Path(metadata['image']).name}"
+            )
+            if notes:
+                line += f" ({', '.join(notes)})"
+            print(line)
+
+    @required_deps("gi", "libvirt")
+    def _action_images_prune(self, args: argparse.Namespace) -> None:
+        from lcitool.install.image import Images
+        from lcitool.libvirt_wrapper import LibvirtWrapper
+
+        self._entrypoint_debug(args)
+
+        max_size = args.max_size
+        if max_size is None:
+            config_path = None
+            if args.config:
+                config_path = args.config.name
+
+            max_size = Config(config_path).values["install"]["image_cache_size"]
+
+        evicted = Images().prune(
+            max_size=max_size * (1 << 30) if max_size else None,
+            keep=LibvirtWrapper().backing_stores(),
+            dry_run=args.dry_run,
         )
 
+        action = "Would evict" if args.dry_run else "Evicted"
+        for entry in evicted:
+            name = Path(entry["metadata"]["image"]).name
+            print(f"{action} {name} ({self._format_size(entry['size'])})")
+
+        freed = sum(entry["size"] for entry in evicted)
+        print(f"{action} {len(evicted)} images, {self._format_size(freed)} in total")
+
     def _action_variables(self, args: argparse.Namespace) -> None:
         self._entrypoint_debug(args)
 
@@ -295,6 +680,14 @@ class Application:
 
         print(header + variables)
 
+    @staticmethod
+    def _downloads_cliargv(args: argparse.Namespace) -> List[str]:
+        if args.package_proxy is not None:
+            return ["--package-proxy", args.package_proxy]
+        if args.fast_downloads:
+            return ["--fast-downloads"]
+        return []
+
     def _action_dockerfile(self, args: argparse.Namespace) -> None:
         self._entrypoint_debug(args)
 
@@ -306,14 +699,19 @@ class Application:
             targets, packages, args.target, args.host_arch, args.cross_arch
         )
 
-        dockerfile = DockerfileFormatter(projects, args.base, args.layers).format(
-            target, projects_expanded
-        )
+        dockerfile = DockerfileFormatter(
+            projects,
+            args.base,
+            args.layers,
+            fastdownloads=args.fast_downloads,
+            package_proxy=args.package_proxy,
+        ).format(target, projects_expanded)
 
         cliargv = [args.action]
         if args.base is not None:
             cliargv.extend(["--base", args.base])
         cliargv.extend(["--layers", args.layers])
+        cliargv.extend(self._downloads_cliargv(args))
         if args.host_arch:
             cliargv.extend(["--host-arch", args.host_arch])
         if args.cross_arch:
@@ -334,11 +732,14 @@ class Application:
             targets, packages, args.target, args.host_arch, args.cross_arch
         )
 
-        buildenvscript = ShellBuildEnvFormatter(projects).format(
-            target, projects_expanded
-        )
+        buildenvscript = ShellBuildEnvFormatter(
+            projects,
+            fastdownloads=args.fast_downloads,
+            package_proxy=args.package_proxy,
+        ).format(target, projects_expanded)
 
         cliargv = [args.action]
+        cliargv.extend(self._downloads_cliargv(args))
         if args.host_arch:
             cliargv.extend(["--host-arch", args.host_arch])
         if args.cross_arch:
@@ -362,12 +763,12 @@ class Application:
         manifest.generate(args.dry_run)
 
     @staticmethod
-    def _container_handle(engine: str) -> Container:
-        handle: Container = Podman()
+    def _container_handle(engine: str, use_api: bool = False) -> Container:
+        handle: Container = Podman(use_api=use_api)
         if engine == "docker":
-            handle = Docker()
+            handle = Docker(use_api=use_api)
 
-        if handle.available is None:
+        if not handle.available:
             raise ApplicationError(f"{handle.engine} engine not available")
 
         return handle
@@ -395,7 +796,7 @@ class Application:
         _file = None
         tag = f"lcitool.{args.target}"
 
-        engine = self._container_handle(args.engine)
+        engine = self._container_handle(args.engine, args.engine_api)
 
         # remove image and prepare to build a new one.
         engine.rmi(tag)
@@ -419,7 +820,6 @@ class Application:
 
     def _get_container_run_common_params(self) -> Dict[str, Any]:
         params = {}
-        params["image"] = self.args.image
         params["user"] = self.args.user
         if self.args.user.isdecimal():
             params["user"] = int(self.args.user)
@@ -456,7 +856,7 @@ class Application:
         )
 
         container_params["tempdir"] = container_tempdir.name
-        engine = self._container_handle(self.args.engine)
+        engine = self._container_handle(self.args.engine, self.args.engine_api)
         if shell:
             return engine.shell(**container_params)
         return engine.run(**container_params)
@@ -465,13 +865,72 @@ class Application:
         self._entrypoint_debug(self.args)
 
         params = self._get_container_run_common_params()
+        params["image"] = self.args.image
         params["container_cmd"] = "./script"
+        if self.args.ccache:
+            params["ccache"] = CompilerCache(self.args.image, self.args.ccache_max_size)
         return self._container_run(params)
 
     def _action_container_shell(self, args: argparse.Namespace) -> int:
         self._entrypoint_debug(self.args)
 
-        return self._container_run(self._get_container_run_common_params(), shell=True)
+        params = self._get_container_run_common_params()
+        params["image"] = self.args.image
+        if self.args.ccache:
+            params["ccache"] = CompilerCache(self.args.image, self.args.ccache_max_size)
+        return self._container_run(params, shell=True)
+
+    @staticmethod
+    def _expand_matrix_images(pattern: str, targets: Targets) -> List[str]:
+        """
+        Expand a matrix image pattern into a list of images.
+
+        Items of the comma separated pattern matching target OS names
+        (accepts globs) are translated to the respective 'lcitool.<target>'
+        images built by 'container build', anything else is taken as a plain
+        image reference.
+        """
+
+        images: List[str] = []
+        for item in pattern.split(","):
+            is_glob = any(c in item for c in "*?[")
+            if "/" not in item and (is_glob or item in targets.targets):
+                try:
+                    matches = util.expand_pattern(item, targets.targets, "targets")
+                except ValueError as ex:
+                    raise ApplicationError(str(ex))
+                expanded = [f"lcitool.{target}" for target in sorted(matches)]
+            else:
+                expanded = [item]
+
+            for image in expanded:
+                if image not in images:
+                    images.append(image)
+
+        return images
+
+    def _action_container_matrix(self, args: argparse.Namespace) -> None:
+        self._entrypoint_debug(args)
+
+        params = self._get_container_run_common_params()
+        images = self._expand_matrix_images(args.images, Targets(args.data_dir))
+
+        log_dir = Path(args.log_dir)
+        report = Path(args.report) if args.report else Path(log_dir, "report.json")
+
+        engine = self._container_handle(args.engine, args.engine_api)
+        matrix = ContainerMatrix(engine, images, log_dir, jobs=args.jobs)
+        if args.ccache:
+            params["ccache_max_size"] = args.ccache_max_size
+        results = matrix.run("./script", report=report, **params)
+
+        print(f"Report written to '{report}'")
+        failed = [r["image"] for r in results if r["error"] or r["returncode"]]
+        if failed:
+            raise ApplicationError(
+                f"Workload failed in {len(failed)} of {len(results)} images: "
+                + ", ".join(failed)
+            )
 
     def run(self, args: argparse.Namespace) -> None:
         try:
@@ -10,8 +10,10 @@ import argparse
 from typing import Any, List, Optional
 
 from pathlib import Path
+from urllib.parse import urlparse
 
 from lcitool.application import Application
+from lcitool.containers.ccache import CompilerCache
 from lcitool.util import DataDir
 from lcitool.util import valid_arches
 
@@ -69,6 +71,14 @@ class CommandLine:
             default="podman",
             help="container engine to use (default=podman)",
         )
+        engineopt.add_argument(
+            "--engine-api",
+            default=False,
+            action="store_true",
+            help="talk to the engine over its REST API socket instead of \
+                  spawning the engine CLI (falls back to the CLI when the \
+                  socket is not available)",
+        )
 
         workload_diropt = argparse.ArgumentParser(add_help=False)
         workload_diropt.add_argument(
@@ -98,6 +108,21 @@ class CommandLine:
                   id or username (default=root)",
         )
 
+        ccacheopt = argparse.ArgumentParser(add_help=False)
+        ccacheopt.add_argument(
+            "--no-ccache",
+            dest="ccache",
+            default=True,
+            action="store_false",
+            help="don't mount the persistent per-target compiler cache",
+        )
+        ccacheopt.add_argument(
+            "--ccache-max-size",
+            default=CompilerCache.DEFAULT_MAX_SIZE,
+            help=f"size cap of the compiler cache \
+                  (default: {CompilerCache.DEFAULT_MAX_SIZE})",
+        )
+
         imageopt = argparse.ArgumentParser(add_help=False)
         imageopt.add_argument(
             "image",
@@ -105,6 +130,33 @@ class CommandLine:
                   full registry paths and tags - if no tag is provided 'latest' is assumed)",
         )
 
+        matriximagesopt = argparse.ArgumentParser(add_help=False)
+        matriximagesopt.add_argument(
+            "images",
+            help="list of images to run the workload in (accepts plain \
+                  image references as well as target OS names and globs \
+                  which map to the 'lcitool.<target>' images)",
+        )
+
+        matrixopt = argparse.ArgumentParser(add_help=False)
+        matrixopt.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of containers to run concurrently (default: 1)",
+        )
+        matrixopt.add_argument(
+            "--log-dir",
+            default="matrix-logs",
+            help="directory to store the per-image logs in \
+                  (default: 'matrix-logs')",
+        )
+        matrixopt.add_argument(
+            "--report",
+            help="path to the JSON report (default: '<log-dir>/report.json')",
+        )
+
         container_projectopt = argparse.ArgumentParser(add_help=False)
         container_projectopt.add_argument(
             "-p",
@@ -122,7 +174,18 @@ class CommandLine:
         installhostopt = argparse.ArgumentParser(add_help=False)
         installhostopt.add_argument(
             "host",
-            help="name of the host (taken from inventory OR a new name)",
+            help="name of the host (taken from inventory OR a new name); "
+            "can be a comma separated list of inventory hosts (globs are "
+            "accepted) and new 'host:target' pairs",
+        )
+
+        installjobsopt = argparse.ArgumentParser(add_help=False)
+        installjobsopt.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of hosts to install concurrently (default: 1)",
         )
 
         installstrategyopt = argparse.ArgumentParser(add_help=False)
@@ -141,10 +204,68 @@ class CommandLine:
             help="force download of a new image (only with --strategy=cloud)",
         )
 
+        installofflineopt = argparse.ArgumentParser(add_help=False)
+        installofflineopt.add_argument(
+            "--offline",
+            default=False,
+            action="store_true",
+            help="only use cached images, don't download nor look up new ones "
+            "(only with --strategy=cloud)",
+        )
+
         installfromtemplate = argparse.ArgumentParser(add_help=False)
         installfromtemplate.add_argument(
             "--template",
-            help="template image to instantiate (only with --strategy=template)",
+            help="template image to instantiate (only with --strategy=template, "
+            "defaults to the latest template built for the target OS)",
+        )
+
+        templatetargetopt = argparse.ArgumentParser(add_help=False)
+        templatetargetopt.add_argument(
+            "target",
+            help="target OS to build the template of",
+        )
+
+        templateforceopt = argparse.ArgumentParser(add_help=False)
+        templateforceopt.add_argument(
+            "--force",
+            default=False,
+            action="store_true",
+            help="force download of a new vendor cloud image",
+        )
+
+        updateprogressopt = argparse.ArgumentParser(add_help=False)
+        updateprogressopt.add_argument(
+            "--progress",
+            default=False,
+            action="store_true",
+            help="show how many hosts finished each play instead of the "
+            "Ansible output",
+        )
+
+        updateforceopt = argparse.ArgumentParser(add_help=False)
+        updateforceopt.add_argument(
+            "--force",
+            default=False,
+            action="store_true",
+            help="fully update hosts even if their configuration didn't change "
+            "since their last successful update",
+        )
+
+        imagespruneopt = argparse.ArgumentParser(add_help=False)
+        imagespruneopt.add_argument(
+            "--max-size",
+            type=int,
+            metavar="GIB",
+            help="evict the least recently used images until the cache fits \
+                  the size (default: 'install.image_cache_size' from the \
+                  config, only superseded images are evicted if that's 0)",
+        )
+        imagespruneopt.add_argument(
+            "-n",
+            "--dry-run",
+            action="store_true",
+            help="print what images would be evicted",
         )
 
         update_projectopt = argparse.ArgumentParser(add_help=False)
@@ -194,6 +315,28 @@ class CommandLine:
             help="output layers (default: 'all')",
         )
 
+        downloadsopt = argparse.ArgumentParser(add_help=False)
+        downloadsopt.add_argument(
+            "--fast-downloads",
+            default=False,
+            action="store_true",
+            help="configure the package manager for parallel downloads",
+        )
+        downloadsopt.add_argument(
+            "--package-proxy",
+            metavar="URL",
+            help="default HTTP(S) proxy to download packages through "
+            "(implies --fast-downloads, can be overridden with PACKAGE_PROXY)",
+        )
+
+        refreshinventoryopt = argparse.ArgumentParser(add_help=False)
+        refreshinventoryopt.add_argument(
+            "--refresh-inventory",
+            default=False,
+            action="store_true",
+            help="don't use the cached inventory, resolve it again",
+        )
+
         waitopt = argparse.ArgumentParser(add_help=False)
         waitopt.add_argument(
             "-w",
@@ -229,6 +372,28 @@ class CommandLine:
             help="make Ansible more verbose (repeat for even more output)",
         )
 
+        updateschedulingopt = argparse.ArgumentParser(add_help=False)
+        updateschedulingopt.add_argument(
+            "--forks",
+            type=int,
+            help="number of hosts to run Ansible tasks on in parallel "
+            "(default: based on the number of hosts and local CPUs)",
+        )
+        updateschedulingopt.add_argument(
+            "--strategy",
+            choices=["linear", "free"],
+            default="linear",
+            help="Ansible strategy: 'linear' runs each task on all the hosts "
+            "before moving on to the next one, with 'free' each host "
+            "proceeds at its own pace (default: linear)",
+        )
+        updateschedulingopt.add_argument(
+            "--batch-size",
+            type=int,
+            help="split the hosts into batches of this size updated by "
+            "concurrent Ansible runs",
+        )
+
         quietopt = argparse.ArgumentParser(add_help=False)
         quietopt.add_argument(
             "-q",
@@ -297,9 +462,12 @@ class CommandLine:
                 waitopt,
                 installtargetopt,
                 installhostopt,
+                installjobsopt,
                 installstrategyopt,
                 installforceopt,
+                installofflineopt,
                 installfromtemplate,
+                refreshinventoryopt,
             ],
         )
         installparser.set_defaults(func=Application._action_install)
@@ -307,13 +475,65 @@ class CommandLine:
         updateparser = subparsers.add_parser(
             "update",
             help="prepare hosts and keep them updated",
-            parents=[verbosityopt, hostsopt, update_projectopt],
+            parents=[
+                verbosityopt,
+                hostsopt,
+                update_projectopt,
+                updateschedulingopt,
+                updateforceopt,
+                updateprogressopt,
+                refreshinventoryopt,
+            ],
         )
         updateparser.set_defaults(func=Application._action_update)
 
+        template_parser = subparsers.add_parser(
+            "template", help="VM template image related functionality"
+        )
+
+        templatesubparser = template_parser.add_subparsers(
+            metavar="COMMAND", dest="template"
+        )
+        templatesubparser.required = True
+
+        build_templateparser = templatesubparser.add_parser(
+            "build",
+            help="build a pre-provisioned template image of a target OS",
+            parents=[
+                verbosityopt,
+                templatetargetopt,
+                container_projectopt,
+                templateforceopt,
+            ],
+        )
+        build_templateparser.set_defaults(func=Application._action_template_build)
+
+        images_parser = subparsers.add_parser(
+            "images", help="vendor cloud image cache related functionality"
+        )
+
+        imagessubparser = images_parser.add_subparsers(
+            metavar="COMMAND", dest="images"
+        )
+        imagessubparser.required = True
+
+        list_imagesparser = imagessubparser.add_parser(
+            "list",
+            help="list the cached images",
+        )
+        list_imagesparser.set_defaults(func=Application._action_images_list)
+
+        prune_imagesparser = imagessubparser.add_parser(
+            "prune",
+            help="evict superseded and least recently used images",
+            parents=[imagespruneopt],
+        )
+        prune_imagesparser.set_defaults(func=Application._action_images_prune)
+
         hostsparser = subparsers.add_parser(
             "hosts",
             help="list all known hosts",
+            parents=[refreshinventoryopt],
         )
         hostsparser.set_defaults(func=Application._action_hosts)
 
@@ -353,6 +573,7 @@ class CommandLine:
                 crossarchopt,
                 baseopt,
                 layersopt,
+                downloadsopt,
             ],
         )
         dockerfileparser.set_defaults(func=Application._action_dockerfile)
@@ -360,7 +581,13 @@ class CommandLine:
         buildenvscriptparser = subparsers.add_parser(
             "buildenvscript",
             help="generate shell script for build environment setup",
-            parents=[targetopt, update_projectopt, hostarchopt, crossarchopt],
+            parents=[
+                targetopt,
+                update_projectopt,
+                hostarchopt,
+                crossarchopt,
+                downloadsopt,
+            ],
         )
         buildenvscriptparser.set_defaults(func=Application._action_buildenvscript)
 
@@ -396,20 +623,49 @@ class CommandLine:
         run_containerparser = containersubparser.add_parser(
             "run",
             help="run container action",
-            parents=[imageopt, containeropt, engineopt, workload_diropt, scriptopt],
+            parents=[
+                imageopt,
+                containeropt,
+                engineopt,
+                workload_diropt,
+                scriptopt,
+                ccacheopt,
+            ],
         )
         run_containerparser.set_defaults(func=Application._action_container_run)
 
         shell_containerparser = containersubparser.add_parser(
             "shell",
             help="Access to an interactive shell",
-            parents=[imageopt, containeropt, engineopt, workload_diropt, scriptopt],
+            parents=[
+                imageopt,
+                containeropt,
+                engineopt,
+                workload_diropt,
+                scriptopt,
+                ccacheopt,
+            ],
         )
         shell_containerparser.set_defaults(func=Application._action_container_shell)
 
+        matrix_containerparser = containersubparser.add_parser(
+            "matrix",
+            help="run a workload in multiple images concurrently",
+            parents=[
+                matriximagesopt,
+                matrixopt,
+                containeropt,
+                engineopt,
+                workload_diropt,
+                scriptopt,
+                ccacheopt,
+            ],
+        )
+        matrix_containerparser.set_defaults(func=Application._action_container_matrix)
+
     @staticmethod
     def _validate_container(args: argparse.Namespace) -> None:
-        if args.container not in ["build", "run", "shell"]:
+        if args.container not in ["build", "run", "shell", "matrix"]:
             return
 
         # Ensure that (--target & --projects) argument are passed with
@@ -421,18 +677,63 @@ class CommandLine:
                 log.error("--target and --projects are required")
                 sys.exit(1)
 
-        if args.container == "run":
+        if args.container in ["run", "matrix"]:
             # "run" subcommand only requires "--script" argument;
             # it works with or without "--workload-dir" argument
             if not args.script:
                 log.error("--script is required")
                 sys.exit(1)
 
+        if args.container == "matrix" and args.jobs < 1:
+            log.error("--jobs must be a positive number")
+            sys.exit(1)
+
+        if args.container in ["run", "shell", "matrix"]:
+            max_size = args.ccache_max_size
+            if not CompilerCache.MAX_SIZE_RE.fullmatch(max_size):
+                log.error(
+                    f"Invalid --ccache-max-size '{max_size}', "
+                    "expected a number with an optional k, K, M, G or T suffix"
+                )
+                sys.exit(1)
+
+    @staticmethod
+    def _validate_downloads(args: argparse.Namespace) -> None:
+        if args.package_proxy is None:
+            return
+
+        url = urlparse(args.package_proxy)
+        if (
+            url.scheme not in ["http", "https"]
+            or not url.netloc
+            or any(c.isspace() or c in "\"'$`\\" for c in args.package_proxy)
+        ):
+            log.error(f"Invalid package proxy URL '{args.package_proxy}'")
+            sys.exit(1)
+
     @staticmethod
     def _validate_install(args: argparse.Namespace) -> None:
-        if args.strategy == "template":
-            if not args.template:
-                log.error("--template is required with with --strategy=template")
+        if args.jobs < 1:
+            log.error("--jobs must be a positive number")
+            sys.exit(1)
+
+        if args.offline and args.force:
+            log.error("--offline and --force are mutually exclusive")
+            sys.exit(1)
+
+    @staticmethod
+    def _validate_update(args: argparse.Namespace) -> None:
+        for opt in ["forks", "batch_size"]:
+            value = getattr(args, opt)
+            if value is not None and value < 1:
+                log.error(f"--{opt.replace('_', '-')} must be a positive number")
+                sys.exit(1)
+
+    @staticmethod
+    def _validate_images(args: argparse.Namespace) -> None:
+        if args.images == "prune" and args.max_size is not None:
+            if args.max_size < 0:
+                log.error("--max-size must not be negative")
                 sys.exit(1)
 
     # Main CLI validating method
@@ -451,6 +752,15 @@ class CommandLine:
         elif args.action == "install":
             self._validate_install(args)
 
+        elif args.action == "update":
+            self._validate_update(args)
+
+        elif args.action == "images":
+            self._validate_images(args)
+
+        elif args.action in ["dockerfile", "buildenvscript"]:
+            self._validate_downloads(args)
+
         return args
 
     def parse(self) -> argparse.Namespace:
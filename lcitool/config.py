@@ -167,6 +167,56 @@ class Config:
         if flavor not in ["test", "gitlab"]:
             raise ValidationError(f"Invalid value '{flavor}' for 'install.flavor'")
 
+        download_jobs = values["install"].get("download_jobs")
+        if not isinstance(download_jobs, int) or download_jobs < 1:
+            raise ValidationError(
+                f"Invalid value '{download_jobs}' for 'install.download_jobs'"
+            )
+
+        cpan_jobs = values["install"].get("cpan_jobs")
+        if not isinstance(cpan_jobs, int) or cpan_jobs < 1:
+            raise ValidationError(
+                f"Invalid value '{cpan_jobs}' for 'install.cpan_jobs'"
+            )
+
+        image_cache_size = values["install"].get("image_cache_size")
+        if not isinstance(image_cache_size, int) or image_cache_size < 0:
+            raise ValidationError(
+                f"Invalid value '{image_cache_size}' for 'install.image_cache_size'"
+            )
+
+        preallocation = values["install"].get("disk_preallocation")
+        if preallocation not in ["off", "metadata", "full"]:
+            raise ValidationError(
+                f"Invalid value '{preallocation}' for 'install.disk_preallocation'"
+            )
+
+        # qcow2 cluster sizes range from 512 B to 2 MiB
+        cluster_size = values["install"].get("disk_cluster_size")
+        if (
+            not isinstance(cluster_size, int)
+            or cluster_size < 0
+            or cluster_size > 2048
+            or cluster_size & (cluster_size - 1)
+        ):
+            raise ValidationError(
+                f"Invalid value '{cluster_size}' for 'install.disk_cluster_size'"
+            )
+
+        # subclusters can't be smaller than 512 B
+        if values["install"].get("disk_extended_l2") and 0 < cluster_size < 16:
+            raise ValidationError(
+                "'install.disk_extended_l2' needs a cluster size of 16 KiB or more"
+            )
+
+        # the disk options apply to the overlays of cloud and template images
+        # and libvirt refuses to preallocate volumes with a backing store
+        if preallocation != "off":
+            raise ValidationError(
+                "'install.disk_preallocation' is not supported for the overlays "
+                "of cloud and template images"
+            )
+
         if flavor == "gitlab":
             secret = values["gitlab"]["runner_secret"]
             if secret == "NONE" or secret is None:
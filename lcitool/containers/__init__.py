@@ -1,6 +1,14 @@
 from .docker import Docker
 from .podman import Podman
 from .containers import ContainerError, ContainerExecError
+from .api import EngineAPIClient, EngineAPIError
 
 # this line only makes sense with 'from xyz import *'; it also silences flake8
-__all__ = ("Docker", "Podman", "ContainerError", "ContainerExecError")
+__all__ = (
+    "Docker",
+    "Podman",
+    "ContainerError",
+    "ContainerExecError",
+    "EngineAPIClient",
+    "EngineAPIError",
+)
@@ -0,0 +1,426 @@
+# api.py - module implementing a client for the container engine REST API
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import tarfile
+import logging
+import threading
+import subprocess
+import http.client
+
+from pathlib import Path
+from urllib.parse import quote, urlencode
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+from typing import cast
+
+from .containers import ContainerError, ContainerExecError
+
+log = logging.getLogger()
+
+
+class EngineAPIError(ContainerError):
+    """Thrown whenever the engine API returns an unexpected response."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"Engine API request failed ({status}): {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket."""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None) -> None:
+        # the host name is only used for the 'Host' header which both Docker
+        # and Podman ignore for Unix socket connections
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EngineAPIClient:
+    """
+    Minimal client for the Docker-compatible REST API.
+
+    Both Docker and Podman serve the same compat API over a local Unix socket,
+    so a single client is enough for both. The client keeps an HTTP
+    connection open and reuses it for all the requests it makes. HTTP
+    connections can't be shared among threads, so each thread using the
+    client gets its own connection.
+    """
+
+    def __init__(self, socket_path: Union[str, Path]) -> None:
+        self.socket_path = str(socket_path)
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> UnixHTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path)
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _path(endpoint: str, params: Optional[Dict[str, Any]] = None) -> str:
+        if params:
+            return endpoint + "?" + urlencode(params)
+        return endpoint
+
+    def _request(
+        self,
+        method: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[Union[bytes, io.IOBase]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> http.client.HTTPResponse:
+        path = self._path(endpoint, params)
+        log.debug(f"Engine API request: {method} {path}")
+
+        try:
+            self.conn.request(method, path, body=body, headers=headers or {})
+            return self.conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            # the engine may have closed an idle keep-alive connection, retry
+            # once with a fresh one before giving up
+            self.close()
+            try:
+                self.conn.request(method, path, body=body, headers=headers or {})
+                return self.conn.getresponse()
+            except (OSError, http.client.HTTPException) as ex:
+                self.close()
+                raise ContainerError(f"Failed to reach engine API: {ex}")
+
+    def _request_json(
+        self,
+        method: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Dict[str, Any]] = None,
+        ok: Tuple[int, ...] = (200,),
+    ) -> Tuple[int, Any]:
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        resp = self._request(method, endpoint, params, body, headers)
+        payload = resp.read()
+        if resp.status not in ok:
+            raise EngineAPIError(resp.status, self._error_message(payload))
+
+        if not payload:
+            return resp.status, None
+        try:
+            return resp.status, json.loads(payload)
+        except ValueError:
+            return resp.status, payload.decode("utf-8", errors="replace")
+
+    @staticmethod
+    def _error_message(payload: bytes) -> str:
+        try:
+            return str(json.loads(payload).get("message", payload))
+        except (ValueError, AttributeError):
+            return payload.decode("utf-8", errors="replace").strip()
+
+    def ping(self) -> bool:
+        """
+        Check whether the engine API is reachable.
+
+        :returns: boolean
+        """
+
+        try:
+            resp = self._request("GET", "/_ping")
+            resp.read()
+        except ContainerError as ex:
+            log.debug(f"Engine API at '{self.socket_path}' not reachable: {ex}")
+            return False
+
+        return resp.status == 200
+
+    def version(self) -> Dict[str, Any]:
+        _, version = self._request_json("GET", "/version")
+        return dict(version)
+
+    def image_inspect(self, image: str) -> Optional[Dict[str, Any]]:
+        """
+        Inspect a single image.
+
+        :param image: name/id/registry-path of the image (optionally tagged)
+        :returns: image details as a dict or None if the image doesn't exist
+        """
+
+        status, details = self._request_json(
+            "GET", f"/images/{quote(image, safe='/:@')}/json", ok=(200, 404)
+        )
+        if status == 404:
+            return None
+        return dict(details)
+
+    def image_remove(self, image: str) -> bool:
+        """
+        Remove an image.
+
+        :param image: name/id/registry-path of the image (optionally tagged)
+        :returns: True if the image was removed, False otherwise
+        """
+
+        try:
+            self._request_json("DELETE", f"/images/{quote(image, safe='/:@')}")
+        except EngineAPIError as ex:
+            log.debug(str(ex))
+            return False
+        return True
+
+    @staticmethod
+    def _build_context(filepath: Path, context_dir: Path) -> Tuple[bytes, str]:
+        """
+        Pack the build context into a tar archive.
+
+        :returns: a tuple of (tar archive, Dockerfile path inside the archive)
+        """
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            tar.add(context_dir, arcname=".")
+
+            try:
+                dockerfile = filepath.resolve().relative_to(context_dir.resolve())
+            except ValueError:
+                dockerfile = Path(".lcitool.Dockerfile")
+                tar.add(filepath, arcname=dockerfile.as_posix())
+
+        return buf.getvalue(), dockerfile.as_posix()
+
+    def build(
+        self, filepath: Path, context_dir: Path, tag: str, pull: bool = True
+    ) -> Iterator[str]:
+        """
+        Build an image, streaming the build output.
+
+        :param filepath: path to the Dockerfile/Containerfile
+        :param context_dir: path to the directory used as build context
+        :param tag: name of the image to be built
+        :param pull: whether to always pull a newer version of the base image
+        :returns: an iterator over the lines of the build output
+        """
+
+        context, dockerfile = self._build_context(filepath, context_dir)
+        params = {"t": tag, "dockerfile": dockerfile, "rm": 1}
+        if pull:
+            params["pull"] = 1
+
+        headers = {"Content-Type": "application/x-tar"}
+        resp = self._request("POST", "/build", params, context, headers)
+        if resp.status != 200:
+            raise EngineAPIError(resp.status, self._error_message(resp.read()))
+
+        for raw in resp:
+            line = raw.strip()
+            if not line:
+                continue
+
+            try:
+                message = json.loads(line)
+            except ValueError:
+                yield line.decode("utf-8", errors="replace") + "\n"
+                continue
+
+            if message.get("error"):
+                # drain the rest of the response to keep the connection usable
+                resp.read()
+                raise ContainerExecError(1, str(message["error"]).strip())
+            if message.get("stream"):
+                yield str(message["stream"])
+
+    def container_create(self, spec: Dict[str, Any]) -> str:
+        _, created = self._request_json(
+            "POST", "/containers/create", data=spec, ok=(200, 201)
+        )
+        return str(created["Id"])
+
+    def container_start(self, container_id: str) -> None:
+        self._request_json("POST", f"/containers/{container_id}/start", ok=(204, 304))
+
+    def container_logs(self, container_id: str) -> Iterator[Tuple[int, bytes]]:
+        """
+        Follow the output of a (non-TTY) container.
+
+        :returns: an iterator over (stream, data) tuples where stream is 1 for
+                  stdout and 2 for stderr
+        """
+
+        params = {"follow": 1, "stdout": 1, "stderr": 1}
+        resp = self._request("GET", f"/containers/{container_id}/logs", params)
+        if resp.status != 200:
+            raise EngineAPIError(resp.status, self._error_message(resp.read()))
+
+        # non-TTY output is multiplexed into frames, each prefixed with an
+        # 8-byte header: stream type (1 byte), padding (3 bytes) and the frame
+        # length (4 bytes, big-endian)
+        while True:
+            header = resp.read(8)
+            if len(header) < 8:
+                break
+
+            stream, length = struct.unpack(">BxxxL", header)
+            yield stream, resp.read(length)
+
+    def container_wait(self, container_id: str) -> int:
+        _, result = self._request_json("POST", f"/containers/{container_id}/wait")
+        return int(result.get("StatusCode", 1))
+
+    def container_remove(self, container_id: str) -> None:
+        self._request_json(
+            "DELETE",
+            f"/containers/{container_id}",
+            params={"force": 1},
+            ok=(200, 204, 404),
+        )
+
+    def run(
+        self,
+        spec: Dict[str, Any],
+        stdout: Optional[Any] = None,
+        stderr: Optional[Any] = None,
+    ) -> int:
+        """
+        Create and start a container, stream its output and remove it.
+
+        :param spec: container create spec as the engine API expects it
+        :param stdout: where to write the container's stdout; follows the
+                       subprocess conventions, i.e. None for the parent's
+                       stdout, subprocess.DEVNULL or a binary file object
+        :param stderr: same as stdout, also accepts subprocess.STDOUT
+        :returns: the exit status of the container
+        """
+
+        def _sink(target: Optional[Any], default: Any) -> Optional[BinaryIO]:
+            if target is None:
+                return cast(BinaryIO, getattr(default, "buffer", default))
+            if target == subprocess.DEVNULL:
+                return None
+            if not hasattr(target, "write"):
+                raise ContainerError(f"Unsupported output redirection '{target}'")
+            return cast(BinaryIO, target)
+
+        out = _sink(stdout, sys.stdout)
+        err = out if stderr == subprocess.STDOUT else _sink(stderr, sys.stderr)
+
+        container_id = self.container_create(spec)
+        try:
+            self.container_start(container_id)
+            for stream, data in self.container_logs(container_id):
+                sink = err if stream == 2 else out
+                if sink is not None:
+                    sink.write(data)
+                    sink.flush()
+            return self.container_wait(container_id)
+        finally:
+            self.container_remove(container_id)
+
+
+def create_spec(
+    image: str,
+    container_cmd: str,
+    engine_args: List[Union[Tuple[str, str], Tuple[str]]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Translate container options into an engine API container create spec.
+
+    :param image: name of the image to run container in
+    :param container_cmd: command to run in the container
+    :param engine_args: a list of options as returned by Container._build_args
+    :returns: the create spec as a dict or None if any of the options cannot
+              be expressed through the compat API (e.g. Podman's ID mappings)
+    """
+
+    host_config: Dict[str, Any] = {"Binds": [], "CapAdd": [], "Ulimits": []}
+    spec: Dict[str, Any] = {
+        "Image": image,
+        "Cmd": [container_cmd],
+        "Env": [],
+        "AttachStdout": True,
+        "AttachStderr": True,
+        "HostConfig": host_config,
+    }
+
+    for arg in engine_args:
+        # single-item tuples only carry the option itself, e.g. '--env=FOO=bar'
+        option, value = arg[0], arg[-1]
+        if option.startswith("--env="):
+            spec["Env"].append(option[len("--env=") :])
+        elif option == "--volume":
+            host_config["Binds"].append(value)
+        elif option == "--user":
+            spec["User"] = value
+        elif option == "--workdir":
+            spec["WorkingDir"] = value
+        elif option == "--cap-add":
+            host_config["CapAdd"].append(value)
+        elif option == "--ulimit":
+            name, _, limits = value.partition("=")
+            soft, _, hard = limits.partition(":")
+            host_config["Ulimits"].append(
+                {"Name": name, "Soft": int(soft), "Hard": int(hard or soft)}
+            )
+        else:
+            log.debug(f"Option '{option}' not supported by the engine API")
+            return None
+
+    return spec
+
+
+def default_socket(engine: str) -> Optional[Path]:
+    """
+    Locate the engine's API socket.
+
+    Honours the DOCKER_HOST/CONTAINER_HOST environment variables if they point
+    to a Unix socket, otherwise falls back to the well-known socket locations.
+
+    :param engine: name of the engine ("podman" or "docker")
+    :returns: path to the socket or None if no socket could be found
+    """
+
+    candidates = []
+
+    env = "DOCKER_HOST" if engine == "docker" else "CONTAINER_HOST"
+    host = os.environ.get(env)
+    if host:
+        if not host.startswith("unix://"):
+            log.debug(f"{env}={host} is not a Unix socket, not using engine API")
+            return None
+        candidates.append(Path(host[len("unix://") :]))
+    elif engine == "docker":
+        candidates.append(Path("/var/run/docker.sock"))
+    else:
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+        if os.getuid() != 0 and runtime_dir:
+            candidates.append(Path(runtime_dir, "podman/podman.sock"))
+        candidates.append(Path("/run/podman/podman.sock"))
+
+    for candidate in candidates:
+        if candidate.is_socket():
+            return candidate
+
+    return None
@@ -0,0 +1,160 @@
+# ccache.py - module managing persistent compiler caches for containers
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import re
+import shutil
+import logging
+import time
+
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from lcitool import util
+
+log = logging.getLogger()
+
+
+class CompilerCache:
+    """
+    Persistent ccache directory shared by all containers of the same image.
+
+    The generated container images come with ccache wrappers set up (see
+    CCACHE_WRAPPERSDIR), but the cache itself would be thrown away together
+    with the container. This class maintains a ccache directory per target
+    OS and architecture in the lcitool cache dir which is then mounted into
+    the container. The size of each cache is capped using ccache's own
+    max_size setting (ccache evicts the least recently used entries on its
+    own) and caches which haven't been used for MAX_AGE_DAYS are removed.
+
+    :ivar name: name of the cache (usually the target OS name)
+    :ivar arch: architecture the cached objects are built for
+    :ivar max_size: ccache size cap (anything CCACHE_MAXSIZE accepts)
+    """
+
+    MAX_AGE_DAYS = 30
+    DEFAULT_MAX_SIZE = "2G"
+
+    # the subset of the CCACHE_MAXSIZE syntax accepted from the user
+    MAX_SIZE_RE = re.compile(r"[0-9]+(\.[0-9]+)?[kKMGT]?")
+
+    def __init__(
+        self,
+        image: str,
+        max_size: str = DEFAULT_MAX_SIZE,
+        base_dir: Optional[Path] = None,
+    ) -> None:
+        """
+        :param image: container image the cache is used with
+        :param max_size: ccache size cap (e.g. "500M", "2G")
+        :param base_dir: directory holding all the caches (defaults to
+                         'ccache' in the lcitool cache dir)
+        """
+
+        if base_dir is None:
+            base_dir = Path(util.get_cache_dir(), "ccache")
+
+        self.name, self.arch = self.key(image)
+        self.max_size = max_size
+        self.base_dir = base_dir
+
+    @property
+    def path(self) -> Path:
+        return Path(self.base_dir, self.name, self.arch)
+
+    @staticmethod
+    def key(image: str) -> Tuple[str, str]:
+        """
+        Derive the (name, arch) cache key from an image reference.
+
+        Images built by 'lcitool container build' ('lcitool.<target>') and
+        the upstream CI images ('ci-<target>[-cross-<arch>]') map to their
+        target OS, any other image is keyed by its sanitized name.
+
+        :param image: container image reference
+        :returns: a (name, arch) tuple
+        """
+
+        name = image.split("/")[-1]
+        if "@" in name:
+            name = name.split("@")[0]
+        name = name.split(":")[0]
+
+        arch = util.get_host_arch()
+        if name.startswith("lcitool."):
+            name = name[len("lcitool.") :]
+        elif name.startswith("ci-"):
+            name = name[len("ci-") :]
+            if "-cross-" in name:
+                name, cross_arch = name.split("-cross-", 1)
+                if cross_arch in util.valid_arches():
+                    arch = cross_arch
+
+        return re.sub(r"[^\w.-]", "_", name), arch
+
+    def cleanup(self) -> None:
+        """Remove caches which haven't been used for MAX_AGE_DAYS."""
+
+        deadline = time.time() - self.MAX_AGE_DAYS * 24 * 3600
+        for cache_dir in self.base_dir.glob("*/*"):
+            try:
+                if cache_dir == self.path or cache_dir.stat().st_mtime > deadline:
+                    continue
+            except OSError:
+                continue
+
+            log.debug(f"Removing stale compiler cache '{cache_dir}'")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            try:
+                cache_dir.parent.rmdir()
+            except OSError:
+                # other caches of the same name still exist
+                pass
+
+    def prepare(self, uid: int, gid: int) -> bool:
+        """
+        Make sure the cache directory exists and is usable by the given user.
+
+        :param uid: host user ID the container processes run as
+        :param gid: host group ID the container processes run as
+        :returns: True if the cache can be used, False otherwise
+        """
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            # mark the cache as recently used for the cleanup policy
+            os.utime(self.path)
+            self.cleanup()
+
+            st = self.path.stat()
+            if uid != 0 and (st.st_uid, st.st_gid) != (uid, gid):
+                os.chown(self.path, uid, gid)
+        except OSError as ex:
+            log.warning(f"Can't use compiler cache '{self.path}': {ex}")
+            return False
+
+        return True
+
+    def engine_args(
+        self, uid: int, gid: int, user_home: str
+    ) -> List[Union[Tuple[str, str], Tuple[str]]]:
+        """
+        Generate the container options mounting the cache.
+
+        :param uid: host user ID owning the cache
+        :param gid: host group ID owning the cache
+        :param user_home: home directory of the user inside the container
+        :returns: a list of container options (see Container._build_args)
+        """
+
+        if not self.prepare(uid, gid):
+            return []
+
+        mountpoint = f"{user_home}/.ccache"
+        return [
+            ("--volume", f"{self.path}:{mountpoint}:z"),
+            (f"--env=CCACHE_DIR={mountpoint}",),
+            (f"--env=CCACHE_MAXSIZE={self.max_size}",),
+        ]
@@ -5,6 +5,8 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import pwd
+import sys
+import time
 import shutil
 import logging
 import subprocess
@@ -12,10 +14,14 @@ import subprocess
 from abc import ABC, abstractmethod
 from pathlib import Path
 
-from lcitool import LcitoolError
-from typing import Any, List, Optional, Tuple, Union
+from lcitool import util, LcitoolError
+from typing import Any, List, Optional, Set, Tuple, Union, TYPE_CHECKING
 from pwd import struct_passwd
 
+if TYPE_CHECKING:
+    from .api import EngineAPIClient
+    from .ccache import CompilerCache
+
 log = logging.getLogger()
 
 
@@ -37,11 +43,57 @@ class ContainerExecError(ContainerError):
         self.returncode = rc
 
 
+class ImageIndex:
+    """
+    Lookup index over the local container images.
+
+    The index is built from a single engine image listing so that any number
+    of image lookups can be answered without asking the engine again.
+
+    :ivar ids: list of image IDs
+    :ivar refs: set of fully qualified "<repository>:<tag>" image references
+    :ivar short_refs: set of "<name>:<tag>" image references with the registry
+                      and namespace parts stripped
+    """
+
+    def __init__(self) -> None:
+        self.ids: List[str] = []
+        self.refs: Set[str] = set()
+        self.short_refs: Set[str] = set()
+
+    def add(self, image_id: Optional[str], refs: List[str]) -> None:
+        if image_id:
+            self.ids.append(image_id)
+        for ref in refs:
+            self.refs.add(ref)
+            self.short_refs.add(ref.split("/")[-1])
+
+    def has_id(self, id_prefix: str) -> bool:
+        return bool(id_prefix) and any(i.startswith(id_prefix) for i in self.ids)
+
+
 class Container(ABC):
     """Abstract class for containers"""
 
-    def __init__(self) -> None:
+    # how long (in seconds) a successful engine availability probe stays
+    # valid in the lcitool cache dir; failed probes aren't cached so that an
+    # engine started right after a failed check is noticed immediately
+    PROBE_CACHE_TTL = 60
+    PROBE_CACHE_FILE = "engines.json"
+
+    def __init__(self, use_api: bool = False) -> None:
+        """
+        :param use_api: whether to talk to the engine over its REST API socket
+                        instead of spawning the engine CLI; the CLI is still
+                        used as a fallback whenever the API is not reachable
+        """
+
         self.engine: str = self.__class__.__name__.lower()
+        self._use_api = use_api
+        self._api: Optional["EngineAPIClient"] = None
+        self._api_probed = False
+        self._available: Optional[bool] = None
+        self._image_index: Optional[ImageIndex] = None
 
     @staticmethod
     def _exec(command: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
@@ -79,11 +131,19 @@ class Container(ABC):
 
         message = f"Checking if '{self.engine}' is available...%s"
 
+        if self.api is not None:
+            log.debug(message, "yes (API)")
+            return True
+
         command = shutil.which(self.engine)
         if command is None:
             log.debug(message, f"no\n'{self.engine}' path cannot be found")
             return False
 
+        if self._load_probe(command):
+            log.debug(message, "yes (cached)")
+            return True
+
         exists = self._exec(
             [command, "version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
         )
@@ -93,17 +153,87 @@ class Container(ABC):
             log.debug(message, "yes")
 
         log.debug("\n" + exists.stdout)
-        return not exists.returncode
+        if exists.returncode:
+            return False
+
+        self._store_probe(command)
+        return True
+
+    def _load_probe(self, command: str) -> bool:
+        """
+        Look up a recent successful engine availability probe in the cache dir.
+
+        :param command: path to the engine binary the probe was run with
+        :returns: whether there's a valid one
+        """
+
+        probes = util.load_cache_file(self.PROBE_CACHE_FILE)
+        if not isinstance(probes, dict):
+            return False
+
+        probe = probes.get(self.engine)
+        if not isinstance(probe, dict) or probe.get("path") != command:
+            return False
+
+        age = time.time() - probe.get("timestamp", 0)
+        if age < 0 or age > self.PROBE_CACHE_TTL:
+            return False
+
+        return bool(probe.get("available"))
+
+    def _store_probe(self, command: str) -> None:
+        probes = util.load_cache_file(self.PROBE_CACHE_FILE)
+        if not isinstance(probes, dict):
+            probes = {}
+
+        probes[self.engine] = {
+            "path": command,
+            "available": True,
+            "timestamp": time.time(),
+        }
+        util.dump_cache_file(self.PROBE_CACHE_FILE, probes)
 
     @property
     def available(self) -> bool:
         """
         Checks whether the container engine is available and ready to use.
 
+        The result is remembered for the lifetime of the object and shared
+        with other lcitool invocations for a short period of time through
+        the lcitool cache dir.
+
         :returns: boolean
         """
 
-        return self._check()
+        if self._available is None:
+            self._available = self._check()
+        return self._available
+
+    @property
+    def api(self) -> Optional["EngineAPIClient"]:
+        """
+        Engine API client if the API backend was requested and is reachable.
+
+        :returns: EngineAPIClient instance or None
+        """
+
+        if not self._use_api or self._api_probed:
+            return self._api
+
+        from .api import EngineAPIClient, default_socket
+
+        self._api_probed = True
+        socket_path = default_socket(self.engine)
+        if socket_path is None:
+            log.debug(f"No '{self.engine}' API socket found, using the CLI")
+            return None
+
+        client = EngineAPIClient(socket_path)
+        if client.ping():
+            log.debug(f"Using '{self.engine}' API at '{socket_path}'")
+            self._api = client
+
+        return self._api
 
     @staticmethod
     def _passwd(user: Optional[Union[int, str]]) -> struct_passwd:
@@ -126,6 +256,17 @@ class Container(ABC):
         except KeyError:
             raise ContainerError(f"user, {user} not found")
 
+    def _host_ids(self, uid: int, gid: int) -> Tuple[int, int]:
+        """
+        Get the host IDs the container user's processes run as.
+
+        :param uid: user ID inside the container
+        :param gid: group ID inside the container
+        :returns: a (uid, gid) tuple
+        """
+
+        return uid, gid
+
     def _build_args(
         self,
         user: Union[int, str],
@@ -133,6 +274,7 @@ class Container(ABC):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional["CompilerCache"] = None,
     ) -> List[Union[Tuple[str, str], Tuple[str]]]:
         """
         Generate container options.
@@ -149,6 +291,7 @@ class Container(ABC):
                         a container.
         :param script: path to an executable script to kickstart
                        operations in the container.
+        :param ccache: persistent compiler cache to mount in the container.
 
         :returns: a list.
         The list contains some options passed to the engine. e.g
@@ -238,6 +381,10 @@ class Container(ABC):
                 ]
             )
 
+        if ccache:
+            owner_uid, owner_gid = self._host_ids(uid, gid)
+            engine_args.extend(ccache.engine_args(owner_uid, owner_gid, user_home))
+
         if env:
             envs = [("--env=" + i,) for i in env]
             engine_args.extend(envs)
@@ -254,6 +401,12 @@ class Container(ABC):
         It returns True if image was successfully removed, False otherwise.
         """
 
+        # the local images are about to change
+        self._image_index = None
+
+        if self.api is not None:
+            return self.api.image_remove(image)
+
         # podman rmi {image}
         cmd = [self.engine, "rmi", image]
         proc = self._exec(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -277,6 +430,43 @@ class Container(ABC):
         log.debug(f"{self.engine} images\n%s", img.stdout)
         return str(img.stdout)
 
+    @abstractmethod
+    def _index_images(self) -> ImageIndex:
+        pass
+
+    @property
+    def image_index(self) -> ImageIndex:
+        """
+        Index of the local images built from a single engine image listing.
+
+        The index is built lazily on first access and reused until the local
+        images are modified through this object.
+        """
+
+        if self._image_index is None:
+            self._image_index = self._index_images()
+        return self._image_index
+
+    def _api_image_exists(self, image_ref: str, image_tag: str) -> Optional[bool]:
+        """
+        Check if image exists using a targeted engine API inspect call.
+
+        :returns: boolean or None if the engine API is not in use
+        """
+
+        if self.api is None:
+            return None
+
+        if not image_ref:
+            return False
+
+        # the engine resolves a bare reference to either an image ID (prefix)
+        # or the 'latest' tag itself, appending the tag would break the former
+        image = image_ref
+        if image_tag and image_tag != "latest":
+            image = f"{image_ref}:{image_tag}"
+        return self.api.image_inspect(image) is not None
+
     @abstractmethod
     def image_exists(self, image_ref: str, image_tag: str) -> bool:
         pass
@@ -288,6 +478,7 @@ class Container(ABC):
         engine_extra_args: List[str],
         **kwargs: Any,
     ) -> int:
+        reference = image
         tag = "latest"
         if ":" in image:
             image, tag = image.split(":")
@@ -298,6 +489,22 @@ class Container(ABC):
                 "Build it or pull from registry first."
             )
 
+        if self.api is not None and "--tty" not in engine_extra_args:
+            from .api import create_spec
+
+            # passed on unchanged, the engine resolves image IDs on its own
+            spec = create_spec(
+                reference, container_cmd, self._api_run_args(engine_extra_args)
+            )
+            if spec is not None:
+                log.debug(f"Run spec: {spec}")
+                rc = self.api.run(
+                    spec, stdout=kwargs.get("stdout"), stderr=kwargs.get("stderr")
+                )
+                if rc:
+                    raise ContainerExecError(rc)
+                return rc
+
         cmd = [self.engine, "run"] + engine_extra_args
         cmd.extend([image, container_cmd])
 
@@ -305,6 +512,28 @@ class Container(ABC):
         run = self._exec(cmd, check=True, **kwargs)
         return run.returncode
 
+    @staticmethod
+    def _api_run_args(
+        engine_extra_args: List[str],
+    ) -> List[Union[Tuple[str, str], Tuple[str]]]:
+        """
+        Regroup flat engine CLI arguments into option tuples.
+
+        The flags only meaningful to the CLI (--rm, --interactive) are dropped
+        as the API backend always removes the container after it finishes.
+        """
+
+        args: List[Union[Tuple[str, str], Tuple[str]]] = []
+        it = iter(engine_extra_args)
+        for arg in it:
+            if arg in ["--rm", "--interactive"]:
+                continue
+            if arg.startswith("--") and "=" not in arg:
+                args.append((arg, next(it)))
+            else:
+                args.append((arg,))
+        return args
+
     @abstractmethod
     def run(
         self,
@@ -315,6 +544,7 @@ class Container(ABC):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional["CompilerCache"] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -332,7 +562,9 @@ class Container(ABC):
                         run workloads.
         :param script: path to an executable script to kickstart
                        operations in the container.
-        :param **kwargs: arguments passed to subprocess.run()
+        :param ccache: persistent compiler cache to mount in the container.
+        :param **kwargs: arguments passed to subprocess.run() (ignored when
+                         the engine API is in use)
 
         e.g {
                 "image": "ubuntu", "container_cmd": "/bin/sh", "user": 0,
@@ -356,7 +588,7 @@ class Container(ABC):
         engine_extra_args = ["--rm", "--interactive"]
 
         build_args = self._build_args(
-            user, tempdir, env=env, datadir=datadir, script=script
+            user, tempdir, env=env, datadir=datadir, script=script, ccache=ccache
         )
         engine_extra_args.extend([item for tuple_ in build_args for item in tuple_])
 
@@ -373,7 +605,8 @@ class Container(ABC):
         :param tempdir: path to a directory which would be used as
                          build context.
         :param tag: name of the image to be built.
-        :param **kwargs: arguments passed to subprocess.run()
+        :param **kwargs: arguments passed to subprocess.run() (ignored when
+                         the engine API is in use)
 
         e.g {
                 "filepath": "/path/to/Dockerfile", "tempdir": /path/to/dir,
@@ -384,6 +617,13 @@ class Container(ABC):
         The returned integer is the status code after completing the build.
         """
 
+        if self.api is not None:
+            self._image_index = None
+            for line in self.api.build(filepath, Path(tempdir), tag):
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            return 0
+
         # podman build --pull --tag $TAG --file='container/Dockerfile' .
 
         cmd_args = ["--pull", "--tag", tag, "--file", f"{filepath}", f"{tempdir}"]
@@ -392,6 +632,7 @@ class Container(ABC):
         cmd.extend(cmd_args)
 
         log.debug(f"Build command: {cmd}")
+        self._image_index = None
         build = self._exec(cmd, check=True, **kwargs)
         return build.returncode
 
@@ -404,6 +645,7 @@ class Container(ABC):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional["CompilerCache"] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -417,7 +659,7 @@ class Container(ABC):
         engine_extra_args = ["--rm", "--interactive", "--tty"]
 
         build_args = self._build_args(
-            user, tempdir, env=env, datadir=datadir, script=script
+            user, tempdir, env=env, datadir=datadir, script=script, ccache=ccache
         )
         engine_extra_args.extend([item for tuple_ in build_args for item in tuple_])
 
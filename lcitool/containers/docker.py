@@ -10,7 +10,8 @@ import logging
 from typing import Any, Union, Optional, List
 from pathlib import Path
 
-from .containers import Container
+from .ccache import CompilerCache
+from .containers import Container, ImageIndex
 
 log = logging.getLogger()
 
@@ -27,6 +28,7 @@ class Docker(Container):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional[CompilerCache] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -36,7 +38,15 @@ class Docker(Container):
         """
 
         return super().run(
-            image, container_cmd, user, tempdir, env, datadir, script, **kwargs
+            image,
+            container_cmd,
+            user,
+            tempdir,
+            env,
+            datadir,
+            script,
+            ccache,
+            **kwargs,
         )
 
     def shell(
@@ -47,6 +57,7 @@ class Docker(Container):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional[CompilerCache] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -55,7 +66,9 @@ class Docker(Container):
         See Container.shell() for more information
         """
 
-        return super().shell(image, user, tempdir, env, datadir, script, **kwargs)
+        return super().shell(
+            image, user, tempdir, env, datadir, script, ccache, **kwargs
+        )
 
     def _images(self) -> Any:
         """
@@ -74,6 +87,23 @@ class Docker(Container):
         log.debug(f"Deserialized {self.engine} images\n%s", images)
         return images
 
+    def _index_images(self) -> ImageIndex:
+        """
+        Build the local image index from a single 'docker images' call.
+
+        :returns: ImageIndex
+        """
+
+        index = ImageIndex()
+        for img in self._images():
+            img_repository = img.get("Repository")
+            img_tag = img.get("Tag", "latest")
+
+            refs = [f"{img_repository}:{img_tag}"] if img_repository else []
+            index.add(img.get("ID"), refs)
+
+        return index
+
     def image_exists(self, image_ref: str, image_tag: str) -> bool:
         """
         Check if image exists in docker.
@@ -83,14 +113,9 @@ class Docker(Container):
         :returns: boolean
         """
 
-        for img in self._images():
-            id = img.get("ID")
-            img_repository = img.get("Repository")
-            img_tag = img.get("Tag", "latest")
-
-            if (image_ref and id.startswith(image_ref)) or (
-                image_ref == img_repository and image_tag == img_tag
-            ):
-                return True
+        exists = self._api_image_exists(image_ref, image_tag)
+        if exists is not None:
+            return exists
 
-        return False
+        index = self.image_index
+        return index.has_id(image_ref) or f"{image_ref}:{image_tag}" in index.refs
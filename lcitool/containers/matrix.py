@@ -0,0 +1,165 @@
+# matrix.py - module implementing concurrent workload runs across images
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Union
+
+from lcitool import util
+
+from .ccache import CompilerCache
+from .containers import Container, ContainerError, ContainerExecError
+
+log = logging.getLogger()
+
+
+class ContainerMatrix:
+    """
+    Runs the same workload in a number of container images concurrently.
+
+    Each container gets its own temporary directory (see Container.run) and
+    its combined stdout/stderr is written to a dedicated log file.
+    """
+
+    def __init__(
+        self, engine: Container, images: List[str], log_dir: Path, jobs: int = 1
+    ) -> None:
+        """
+        :param engine: container engine handle to run the containers with
+        :param images: list of images to run the workload in
+        :param log_dir: directory where the per-image log files are written
+        :param jobs: maximum number of containers to run at the same time
+        """
+
+        if jobs < 1:
+            raise ContainerError(f"Invalid number of jobs '{jobs}'")
+
+        self._engine = engine
+        self.images = images
+        self.log_dir = log_dir
+        self.jobs = jobs
+
+    @staticmethod
+    def _log_name(image: str) -> str:
+        return image.replace("/", "_").replace(":", "_") + ".log"
+
+    def _run_one(
+        self,
+        image: str,
+        container_cmd: str,
+        ccache_max_size: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            "image": image,
+            "log": Path(self.log_dir, self._log_name(image)).as_posix(),
+            "returncode": None,
+            "error": None,
+        }
+
+        if ccache_max_size is not None:
+            kwargs["ccache"] = CompilerCache(image, ccache_max_size)
+
+        tempdir = TemporaryDirectory(prefix="container", dir=util.get_temp_dir())
+        start = time.monotonic()
+        try:
+            with open(result["log"], "wb") as fd:
+                # there's no terminal to interact with, the containers run
+                # concurrently after all
+                result["returncode"] = self._engine.run(
+                    image,
+                    container_cmd,
+                    tempdir=Path(tempdir.name),
+                    stdin=subprocess.DEVNULL,
+                    stdout=fd,
+                    stderr=subprocess.STDOUT,
+                    **kwargs,
+                )
+        except ContainerExecError as ex:
+            result["returncode"] = ex.returncode
+        except (ContainerError, OSError) as ex:
+            result["error"] = str(ex)
+        finally:
+            result["duration"] = round(time.monotonic() - start, 3)
+            tempdir.cleanup()
+
+        return result
+
+    def run(
+        self,
+        container_cmd: str,
+        user: Union[int, str],
+        env: Optional[List[str]] = None,
+        datadir: Optional[Path] = None,
+        script: Optional[Path] = None,
+        report: Optional[Path] = None,
+        ccache_max_size: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the workload in all the images.
+
+        See Container.run() for the meaning of the workload parameters.
+
+        :param report: path to a file to write the JSON report to
+        :param ccache_max_size: size cap of the persistent compiler cache to
+                                mount in each container (no cache is mounted
+                                if None, see CompilerCache)
+        :returns: list of per-image results (dicts) in the order of images,
+                  each containing the image name, the log file path, the exit
+                  code of the workload (None if the container couldn't be
+                  started, see 'error' for details) and the wall-clock
+                  duration in seconds
+        """
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+
+        kwargs: Dict[str, Any] = {
+            "user": user,
+            "env": env,
+            "datadir": datadir,
+            "script": script,
+            "ccache_max_size": ccache_max_size,
+        }
+
+        results: Dict[str, Dict[str, Any]] = {}
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {
+                executor.submit(self._run_one, image, container_cmd, **kwargs): image
+                for image in self.images
+            }
+
+            for future in as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+
+                if result["error"]:
+                    status = "error"
+                elif result["returncode"]:
+                    status = f"failed ({result['returncode']})"
+                else:
+                    status = "passed"
+                print(
+                    f"[{len(results)}/{len(self.images)}] {result['image']}: "
+                    f"{status} in {result['duration']:.1f}s, log: {result['log']}"
+                )
+
+        ordered = [results[image] for image in self.images]
+        if report is not None:
+            report_data = {
+                "engine": self._engine.engine,
+                "jobs": self.jobs,
+                "duration": round(time.monotonic() - start, 3),
+                "results": ordered,
+            }
+            util.atomic_write(report, json.dumps(report_data, indent=2) + "\n")
+            log.debug(f"Matrix report written to '{report}'")
+
+        return ordered
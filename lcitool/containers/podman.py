@@ -6,8 +6,10 @@
 
 import json
 import logging
+import os
 
-from .containers import Container
+from .ccache import CompilerCache
+from .containers import Container, ImageIndex
 from typing import Any, List, Optional, Tuple, Union
 from pathlib import Path
 
@@ -26,6 +28,7 @@ class Podman(Container):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional[CompilerCache] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -35,7 +38,15 @@ class Podman(Container):
         """
 
         return super().run(
-            image, container_cmd, user, tempdir, env, datadir, script, **kwargs
+            image,
+            container_cmd,
+            user,
+            tempdir,
+            env,
+            datadir,
+            script,
+            ccache,
+            **kwargs,
         )
 
     def shell(
@@ -46,6 +57,7 @@ class Podman(Container):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional[CompilerCache] = None,
         **kwargs: Any,
     ) -> int:
         """
@@ -54,7 +66,9 @@ class Podman(Container):
         See Container.shell() for more information
         """
 
-        return super().shell(image, user, tempdir, env, datadir, script, **kwargs)
+        return super().shell(
+            image, user, tempdir, env, datadir, script, ccache, **kwargs
+        )
 
     def _extra_args(self, user: Optional[Union[int, str]]) -> List[Tuple[str, str]]:
         """
@@ -116,6 +130,16 @@ class Podman(Container):
         )
         return podman_args_
 
+    def _host_ids(self, uid: int, gid: int) -> Tuple[int, int]:
+        """
+        Get the host IDs the container user's processes run as.
+
+        Podman runs rootless, so both root and the user we map in
+        _extra_args() are backed by the invoking user on the host.
+        """
+
+        return os.getuid(), os.getgid()
+
     def _build_args(
         self,
         user: Union[int, str],
@@ -123,6 +147,7 @@ class Podman(Container):
         env: Optional[List[str]] = None,
         datadir: Optional[Path] = None,
         script: Optional[Path] = None,
+        ccache: Optional[CompilerCache] = None,
     ) -> List[Union[Tuple[str, str], Tuple[str]]]:
         """
         Options for Podman engine.
@@ -137,7 +162,7 @@ class Podman(Container):
         """
 
         args_ = super()._build_args(
-            user, tempdir, env=env, datadir=datadir, script=script
+            user, tempdir, env=env, datadir=datadir, script=script, ccache=ccache
         )
         args_podman = args_ + self._extra_args(user)
         log.debug(f"Options for podman engine: {args_podman}")
@@ -157,6 +182,19 @@ class Podman(Container):
         log.debug(f"Deserialized {self.engine} images\n%s", images)
         return images
 
+    def _index_images(self) -> ImageIndex:
+        """
+        Build the local image index from a single 'podman images' call.
+
+        :returns: ImageIndex
+        """
+
+        index = ImageIndex()
+        for img in self._images():
+            index.add(img.get("Id"), img.get("Names") or [])
+
+        return index
+
     def image_exists(self, image_ref: str, image_tag: str) -> bool:
         """
         Check if image exists in podman.
@@ -166,23 +204,17 @@ class Podman(Container):
         :returns: boolean
         """
 
+        exists = self._api_image_exists(image_ref, image_tag)
+        if exists is not None:
+            return exists
+
+        index = self.image_index
+        if index.has_id(image_ref):
+            return True
+
         image_repository, _, image_name = image_ref.rpartition("/")
+        if image_repository:
+            return f"{image_ref}:{image_tag}" in index.refs
 
-        for img in self._images():
-            id = img.get("Id")
-            img_repository = img.get("Names")
-
-            image_reference = image_name + ":" + image_tag
-            if image_repository:
-                image_reference = image_repository + "/" + image_reference
-                repository_names = img_repository
-            else:
-                # parse `img_repository` just to get "<image_name>:<image_tag>"
-                repository_names = list(map(lambda x: x.split("/")[-1], img_repository))
-
-            if (image_ref and id.startswith(image_ref)) or (
-                image_reference in repository_names
-            ):
-                return True
-
-        return False
+        # match just "<image_name>:<image_tag>" regardless of the registry
+        return f"{image_name}:{image_tag}" in index.short_refs
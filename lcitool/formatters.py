@@ -131,12 +131,18 @@ class BuildEnvFormatter(Formatter):
         indent: int = 0,
         pkgcleanup: bool = False,
         nosync: bool = False,
+        fastdownloads: bool = False,
+        package_proxy: Optional[str] = None,
     ) -> None:
         super().__init__(inventory)
         self._indent = indent
         self._pkgcleanup = pkgcleanup
         self._nosync = nosync
 
+        # a package proxy is only of any use with the downloader tweaks
+        self._fastdownloads = fastdownloads or package_proxy is not None
+        self._package_proxy = package_proxy
+
     def _align(self, command: str, strings: List[str]) -> str:
         if len(strings) == 1:
             return strings[0]
@@ -235,6 +241,61 @@ class BuildEnvFormatter(Formatter):
                 )
         return commands
 
+    def _format_commands_downloads(
+        self, target: BuildTarget, persistent: bool = True
+    ) -> List[str]:
+        # Configures the package manager for faster downloads. The settings
+        # which are written to the package manager configuration stay in the
+        # image, the package proxy (PACKAGE_PROXY) on the other hand is only
+        # ever exported to the environment of the commands installing
+        # packages, so that the resulting image doesn't depend on it: each
+        # Dockerfile RUN instruction has a shell of its own and the build env
+        # script runs the commands in a subshell
+        facts = target.facts
+        commands: List[str] = []
+        osname = facts["os"]["name"]
+
+        if not self._fastdownloads:
+            return commands
+
+        commands.extend(
+            [
+                'if test -n "$PACKAGE_PROXY"; then '
+                'export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; '
+                "fi",
+            ]
+        )
+
+        if facts["packaging"]["format"] == "deb":
+            if persistent:
+                apt_conf = [
+                    'Acquire::Queue-Mode "host";',
+                    'Acquire::http::Pipeline-Depth "20";',
+                    'Acquire::Retries "3";',
+                ]
+                commands.extend(
+                    [
+                        "printf '" + "\\n".join(apt_conf) + "\\n' "
+                        "> /etc/apt/apt.conf.d/90lcitool-downloads",
+                    ]
+                )
+        elif facts["packaging"]["format"] == "rpm":
+            if osname == "OpenSUSE":
+                # libzypp fetches the packages of a transaction one by one
+                # unless asked to preload them in parallel
+                commands.extend(["export ZYPP_PCK_PRELOAD=1"])
+            elif persistent:
+                commands.extend(
+                    [
+                        "sed -i '/^max_parallel_downloads=/d' /etc/dnf/dnf.conf",
+                        "echo 'max_parallel_downloads=10' >> /etc/dnf/dnf.conf",
+                    ]
+                )
+
+        # apk doesn't support parallel downloads, only the proxy applies
+
+        return commands
+
     def _format_commands_pkglist(self, target: BuildTarget) -> List[str]:
         facts = target.facts
         commands = []
@@ -261,6 +322,8 @@ class BuildEnvFormatter(Formatter):
         mappings = varmap["mappings"]
         assert isinstance(mappings, list)
 
+        commands.extend(self._format_commands_downloads(target))
+
         if facts["packaging"]["format"] == "apk":
             # See earlier comment about adding this later
             # "{packaging_command} add libeatmydata",
@@ -459,6 +522,9 @@ class BuildEnvFormatter(Formatter):
         facts = target.facts
         cross_commands = []
 
+        # the persistent downloader settings come with the native layer
+        cross_commands.extend(self._format_commands_downloads(target, False))
+
         if facts["packaging"]["format"] == "deb":
             cross_commands.extend(
                 [
@@ -556,9 +622,21 @@ class BuildEnvFormatter(Formatter):
 class DockerfileFormatter(BuildEnvFormatter):
 
     def __init__(
-        self, inventory: Projects, base: Optional[str] = None, layers: str = "all"
+        self,
+        inventory: Projects,
+        base: Optional[str] = None,
+        layers: str = "all",
+        fastdownloads: bool = False,
+        package_proxy: Optional[str] = None,
     ):
-        super().__init__(inventory, indent=len("RUN "), pkgcleanup=True, nosync=True)
+        super().__init__(
+            inventory,
+            indent=len("RUN "),
+            pkgcleanup=True,
+            nosync=True,
+            fastdownloads=fastdownloads,
+            package_proxy=package_proxy,
+        )
         self._base = base
         self._layers = layers
 
@@ -577,6 +655,12 @@ class DockerfileFormatter(BuildEnvFormatter):
         else:
             base = target.facts["containers"]["base"]
         strings.append(f"FROM {base}")
+        if self._fastdownloads:
+            # allows choosing the package proxy with '--build-arg'
+            if self._package_proxy:
+                strings.append(f"\nARG PACKAGE_PROXY={self._package_proxy}")
+            else:
+                strings.append("\nARG PACKAGE_PROXY")
         return strings
 
     def _format_section_native(
@@ -758,8 +842,22 @@ class YamlVariablesFormatter(VariablesFormatter):
 
 class ShellBuildEnvFormatter(BuildEnvFormatter):
 
-    def __init__(self, inventory: Projects, base: None = None, layers: str = "all"):
-        super().__init__(inventory, indent=len("    "), pkgcleanup=False, nosync=False)
+    def __init__(
+        self,
+        inventory: Projects,
+        base: None = None,
+        layers: str = "all",
+        fastdownloads: bool = False,
+        package_proxy: Optional[str] = None,
+    ):
+        super().__init__(
+            inventory,
+            indent=len("    "),
+            pkgcleanup=False,
+            nosync=False,
+            fastdownloads=fastdownloads,
+            package_proxy=package_proxy,
+        )
 
     @staticmethod
     def _format_env(env: Dict[str, str]) -> str:
@@ -778,12 +876,27 @@ class ShellBuildEnvFormatter(BuildEnvFormatter):
         strings = [
             "function install_buildenv() {",
         ]
+
+        # the package proxy must not leak into the caller's shell
+        indent = "    "
+        if self._fastdownloads:
+            strings.append(indent + "(")
+            indent += "    "
+
+        if self._package_proxy:
+            # the caller's PACKAGE_PROXY takes precedence
+            strings.append(
+                f'{indent}PACKAGE_PROXY="${{PACKAGE_PROXY:-{self._package_proxy}}}"'
+            )
         groups = self._format_commands_native(target, varmap)
         for commands in groups:
-            strings.extend(["    " + c for c in commands])
+            strings.extend([indent + c for c in commands])
         if target.cross_arch:
             for command in self._format_commands_foreign(target, varmap):
-                strings.append("    " + command)
+                strings.append(indent + command)
+
+        if self._fastdownloads:
+            strings.append("    )")
         strings.append("}")
 
         strings.append(self._format_env(self._format_env_native(varmap)))
@@ -6,7 +6,7 @@
 
 import textwrap
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 #
 # The job templates in this file rely on variables in a
@@ -145,7 +145,112 @@ def format_variables(variables: Dict[str, str]) -> str:
     return ""
 
 
-def container_template(cidir: Path) -> str:
+def _quote(value: Any) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def format_matrix(matrix: Optional[List[Dict[str, str]]]) -> str:
+    if not matrix:
+        return ""
+
+    entries = []
+    for variables in matrix:
+        lines = [f"{key}: {_quote(variables[key])}" for key in sorted(variables)]
+        entries.append("      - " + "\n        ".join(lines))
+    return "  parallel:\n    matrix:\n" + "\n".join(entries) + "\n"
+
+
+def format_needs(job: str, matrix: Optional[Dict[str, str]] = None) -> str:
+    needs = f"  needs:\n    - job: {job}\n"
+    if matrix:
+        lines = [f"{key}: {_quote(matrix[key])}" for key in sorted(matrix)]
+        needs += (
+            "      parallel:\n"
+            "        matrix:\n"
+            "          - " + "\n            ".join(lines) + "\n"
+        )
+    return needs + "      optional: true\n"
+
+
+def matrix_variables(
+    variables: List[Dict[str, str]], keys: List[str]
+) -> Tuple[Dict[str, str], List[Dict[str, str]]]:
+    """
+    Split the variables of jobs to be merged into a parallel:matrix job.
+
+    :param variables: list of the variables of each job
+    :param keys: variables which are always part of the matrix entries,
+                 which identifies the jobs in the GitLab UI
+    :returns: tuple of the variables shared by all the jobs and the list of
+              the remaining variables of each job (the matrix entries)
+    """
+
+    common = {}
+    for key, value in variables[0].items():
+        if key in keys:
+            continue
+        if all(key in other and other[key] == value for other in variables[1:]):
+            common[key] = value
+
+    matrix = [
+        {key: value for key, value in jobvars.items() if key not in common}
+        for jobvars in variables
+    ]
+    return common, matrix
+
+
+def container_template(
+    cidir: Path, cache: bool = False, content_tags: bool = False
+) -> str:
+    tag = "latest"
+    tag_docs = ""
+    latest_export = ""
+    skip_script = ""
+    latest_args = ""
+    latest_push = ""
+    publish_rule = """
+            # upstream: allow force re-publishing containers on default branch for web/api/scheduled pipelines
+            - if: '$CI_PROJECT_NAMESPACE == $RUN_UPSTREAM_NAMESPACE && $CI_PIPELINE_SOURCE =~ /(web|api|schedule)/ && $CI_COMMIT_REF_NAME == $CI_DEFAULT_BRANCH && $RUN_CONTAINER_BUILDS == "1"'
+              when: on_success"""
+    if content_tags:
+        tag = "$CONTAINER_TAG"
+        tag_docs = """
+        # Containers are also published with a tag that is the digest of their
+        # Dockerfile, that build jobs use. A container whose tag was published
+        # already isn't built again, unless re-publishing is forced, which is
+        # why web/api/scheduled pipelines always run the container jobs: they
+        # publish the tags which are missing from the registry, eg. after the
+        # tags were turned on or expired
+        #"""
+        publish_rule = """
+            # upstream: publish missing containers (or force re-publishing them) on default branch for web/api/scheduled pipelines
+            - if: '$CI_PROJECT_NAMESPACE == $RUN_UPSTREAM_NAMESPACE && $CI_PIPELINE_SOURCE =~ /(web|api|schedule)/ && $CI_COMMIT_REF_NAME == $CI_DEFAULT_BRANCH'
+              when: on_success"""
+        latest_export = """
+            - export LATEST_TAG="$CI_REGISTRY_IMAGE/ci-$NAME:latest\""""
+        skip_script = """
+            - if test "$RUN_CONTAINER_BUILDS" != "1" && docker manifest inspect "$TAG" >/dev/null 2>&1 ;
+              then
+                echo "$TAG already published, skipping build" ;
+                exit 0 ;
+              fi"""
+        latest_args = '--tag "$LATEST_TAG" '
+        latest_push = """
+            - docker push "$LATEST_TAG\""""
+
+    cache_docs = ""
+    cache_args = ""
+    if cache:
+        cache_docs = """
+        # The published image embeds inline BuildKit cache metadata, and it is
+        # used as the cache source of the next build, so that only the layers
+        # which changed are rebuilt
+        #"""
+        cache_from = "$LATEST_TAG" if content_tags else "$TAG"
+        cache_args = (
+            f'--cache-from "{cache_from}" --build-arg BUILDKIT_INLINE_CACHE=1 '
+        )
+
     return textwrap.dedent(
         f"""
         # We want to publish containers with tag 'latest':
@@ -155,7 +260,7 @@ def container_template(cidir: Path) -> str:
         #    against default branch
         #
         # Note: never publish from merge requests since they have non-committed code
-        #
+        #{tag_docs}{cache_docs}
         .container_job:
           image: docker:latest
           stage: containers
@@ -164,12 +269,12 @@ def container_template(cidir: Path) -> str:
           services:
             - docker:dind
           before_script:
-            - export TAG="$CI_REGISTRY_IMAGE/ci-$NAME:latest"
+            - export TAG="$CI_REGISTRY_IMAGE/ci-$NAME:{tag}"{latest_export}
             - docker info
             - docker login "$CI_REGISTRY" -u "$CI_REGISTRY_USER" -p "$CI_REGISTRY_PASSWORD"
-          script:
-            - docker build --tag "$TAG" -f "{cidir}/containers/$NAME.Dockerfile" {cidir}/containers ;
-            - docker push "$TAG"
+          script:{skip_script}
+            - docker build {cache_args}--tag "$TAG" {latest_args}-f "{cidir}/containers/$NAME.Dockerfile" {cidir}/containers ;
+            - docker push "$TAG"{latest_push}
           after_script:
             - docker logout
           rules:
@@ -179,10 +284,7 @@ def container_template(cidir: Path) -> str:
               changes:
                 - {cidir}/gitlab/container-templates.yml
                 - {cidir}/containers/$NAME.Dockerfile
-
-            # upstream: allow force re-publishing containers on default branch for web/api/scheduled pipelines
-            - if: '$CI_PROJECT_NAMESPACE == $RUN_UPSTREAM_NAMESPACE && $CI_PIPELINE_SOURCE =~ /(web|api|schedule)/ && $CI_COMMIT_REF_NAME == $CI_DEFAULT_BRANCH && $RUN_CONTAINER_BUILDS == "1"'
-              when: on_success
+{publish_rule}
 
             # upstream+forks: that's all folks
             - when: never
@@ -190,7 +292,9 @@ def container_template(cidir: Path) -> str:
     )
 
 
-def _build_template(template: str, envid: str, project: str, cidir: Path) -> str:
+def _build_template(
+    template: str, envid: str, project: str, cidir: Path, tag: str = "latest"
+) -> str:
     return textwrap.dedent(
         f"""
         #
@@ -224,7 +328,7 @@ def _build_template(template: str, envid: str, project: str, cidir: Path) -> str
                 cat /packages.txt ;
               fi
           variables:
-            IMAGE: $CI_REGISTRY/$CONTAINER_UPSTREAM_NAMESPACE/{project}/ci-{envid}:latest
+            IMAGE: $CI_REGISTRY/$CONTAINER_UPSTREAM_NAMESPACE/{project}/ci-{envid}:{tag}
           rules:
             ### PUSH events
 
@@ -340,13 +444,29 @@ def _build_template(template: str, envid: str, project: str, cidir: Path) -> str
     )
 
 
-def native_build_template(project: str, cidir: Path) -> str:
-    return _build_template(".gitlab_native_build_job", "$NAME", project, cidir)
+def _image_tag(content_tags: bool) -> str:
+    return "$CONTAINER_TAG" if content_tags else "latest"
+
+
+def native_build_template(
+    project: str, cidir: Path, content_tags: bool = False
+) -> str:
+    return _build_template(
+        ".gitlab_native_build_job",
+        "$NAME",
+        project,
+        cidir,
+        _image_tag(content_tags),
+    )
 
 
-def cross_build_template(project: str, cidir: Path) -> str:
+def cross_build_template(project: str, cidir: Path, content_tags: bool = False) -> str:
     return _build_template(
-        ".gitlab_cross_build_job", "$NAME-cross-$CROSS", project, cidir
+        ".gitlab_cross_build_job",
+        "$NAME-cross-$CROSS",
+        project,
+        cidir,
+        _image_tag(content_tags),
     )
 
 
@@ -546,15 +666,45 @@ def flake8_job() -> str:
     )
 
 
-def _container_job(
-    target: str, arch: str, image: str, allow_failure: bool, optional: bool
-) -> str:
+def container_job_vars(
+    target: str, arch: Optional[str], optional: bool, tag: Optional[str] = None
+) -> Dict[str, str]:
+    image = target
+    if arch is not None:
+        image = f"{target}-cross-{arch}"
+
     jobvars = {
         "NAME": image,
     }
     if optional:
         jobvars["JOB_OPTIONAL"] = "1"
+    if tag is not None:
+        jobvars["CONTAINER_TAG"] = tag
+    return jobvars
+
+
+def container_matrix_job(
+    name: str,
+    allow_failure: bool,
+    variables: Dict[str, str],
+    matrix: List[Dict[str, str]],
+) -> str:
+    return (
+        textwrap.dedent(
+            f"""
+        {name}:
+          extends: .container_job
+          allow_failure: {str(allow_failure).lower()}
+        """
+        )
+        + format_variables(variables)
+        + format_matrix(matrix)
+    )
+
 
+def _container_job(
+    target: str, arch: str, jobvars: Dict[str, str], allow_failure: bool
+) -> str:
     return (
         textwrap.dedent(
             f"""
@@ -567,16 +717,22 @@ def _container_job(
     )
 
 
-def native_container_job(target: str, allow_failure: bool, optional: bool) -> str:
-    return _container_job(target, "x86_64", f"{target}", allow_failure, optional)
+def native_container_job(
+    target: str, allow_failure: bool, optional: bool, tag: Optional[str] = None
+) -> str:
+    jobvars = container_job_vars(target, None, optional, tag)
+    return _container_job(target, "x86_64", jobvars, allow_failure)
 
 
 def cross_container_job(
-    target: str, arch: str, allow_failure: bool, optional: bool
+    target: str,
+    arch: str,
+    allow_failure: bool,
+    optional: bool,
+    tag: Optional[str] = None,
 ) -> str:
-    return _container_job(
-        target, arch, f"{target}-cross-{arch}", allow_failure, optional
-    )
+    jobvars = container_job_vars(target, arch, optional, tag)
+    return _container_job(target, arch, jobvars, allow_failure)
 
 
 def format_artifacts(artifacts: Optional[Dict[str, Union[str, List[str]]]]) -> str:
@@ -612,34 +768,68 @@ def merge_vars(system: Dict[str, str], user: Dict[str, str]) -> Dict[str, str]:
     return {**user, **system}
 
 
-def _build_job(
-    target: str,
-    image: str,
-    arch: str,
-    suffix: str,
-    variables: Dict[str, str],
+def build_job(
+    name: str,
     template: str,
+    needs: str,
     allow_failure: bool,
+    variables: Dict[str, str],
     artifacts: Optional[Dict[str, Union[str, List[str]]]],
+    matrix: Optional[List[Dict[str, str]]] = None,
 ) -> str:
-    variables["TARGET_BASE_IMAGE"] = image
-
     return (
         textwrap.dedent(
             f"""
-        {arch}-{target}{suffix}:
+        {name}:
           extends: {template}
-          needs:
-            - job: {arch}-{target}-container
-              optional: true
-          allow_failure: {str(allow_failure).lower()}
         """
         )
+        + needs
+        + f"  allow_failure: {str(allow_failure).lower()}\n"
         + format_variables(variables)
+        + format_matrix(matrix)
         + format_artifacts(artifacts)
     )
 
 
+def _build_vars(
+    system: Dict[str, str],
+    image: str,
+    variables: Dict[str, str],
+    optional: bool,
+    tag: Optional[str],
+) -> Dict[str, str]:
+    jobvars = merge_vars(system, variables)
+    if optional:
+        jobvars["JOB_OPTIONAL"] = "1"
+    jobvars["TARGET_BASE_IMAGE"] = image
+    if tag is not None:
+        jobvars["CONTAINER_TAG"] = tag
+    return jobvars
+
+
+def native_build_vars(
+    target: str,
+    image: str,
+    variables: Dict[str, str],
+    optional: bool,
+    tag: Optional[str] = None,
+) -> Dict[str, str]:
+    return _build_vars({"NAME": target}, image, variables, optional, tag)
+
+
+def cross_build_vars(
+    target: str,
+    image: str,
+    arch: str,
+    variables: Dict[str, str],
+    optional: bool,
+    tag: Optional[str] = None,
+) -> Dict[str, str]:
+    system = {"NAME": target, "CROSS": arch}
+    return _build_vars(system, image, variables, optional, tag)
+
+
 def native_build_job(
     target: str,
     image: str,
@@ -649,18 +839,15 @@ def native_build_job(
     allow_failure: bool,
     optional: bool,
     artifacts: None,
+    tag: Optional[str] = None,
 ) -> str:
-    jobvars = merge_vars(
-        {
-            "NAME": target,
-        },
-        variables,
-    )
-    if optional:
-        jobvars["JOB_OPTIONAL"] = "1"
-
-    return _build_job(
-        target, image, "x86_64", suffix, jobvars, template, allow_failure, artifacts
+    return build_job(
+        f"x86_64-{target}{suffix}",
+        template,
+        format_needs(f"x86_64-{target}-container"),
+        allow_failure,
+        native_build_vars(target, image, variables, optional, tag),
+        artifacts,
     )
 
 
@@ -674,28 +861,27 @@ def cross_build_job(
     allow_failure: bool,
     optional: bool,
     artifacts: Optional[Dict[str, Union[str, List[str]]]],
+    tag: Optional[str] = None,
 ) -> str:
-    jobvars = merge_vars({"NAME": target, "CROSS": arch}, variables)
-    if optional:
-        jobvars["JOB_OPTIONAL"] = "1"
-
-    return _build_job(
-        target, image, arch, suffix, jobvars, template, allow_failure, artifacts
+    return build_job(
+        f"{arch}-{target}{suffix}",
+        template,
+        format_needs(f"{arch}-{target}-container"),
+        allow_failure,
+        cross_build_vars(target, image, arch, variables, optional, tag),
+        artifacts,
     )
 
 
-def cirrus_build_job(
+def cirrus_build_vars(
     target: str,
     instance_type: str,
     image_selector: str,
     image_name: str,
-    arch: str,
     pkg_cmd: str,
-    suffix: str,
     variables: Dict[Any, Any],
-    allow_failure: bool,
     optional: bool,
-) -> str:
+) -> Dict[str, str]:
     if pkg_cmd == "brew":
         install_cmd = "brew install"
         upgrade_cmd = "brew upgrade"
@@ -711,11 +897,6 @@ def cirrus_build_job(
     else:
         raise ValueError(f"Unknown package command {pkg_cmd}")
 
-    if allow_failure:
-        allow_failure_block = "  allow_failure: true\n"
-    else:
-        allow_failure_block = "  allow_failure:\n    exit_codes: 3\n"
-
     jobvars = merge_vars(
         {
             "NAME": target,
@@ -730,15 +911,53 @@ def cirrus_build_job(
     )
     if optional:
         jobvars["JOB_OPTIONAL"] = "1"
+    return jobvars
+
+
+def cirrus_job(
+    name: str,
+    allow_failure: bool,
+    variables: Dict[str, str],
+    matrix: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    if allow_failure:
+        allow_failure_block = "  allow_failure: true\n"
+    else:
+        allow_failure_block = "  allow_failure:\n    exit_codes: 3\n"
 
     return (
         textwrap.dedent(
             f"""
-        {arch}-{target}{suffix}:
+        {name}:
           extends: .cirrus_build_job
           needs: []
         """
         )
         + allow_failure_block
-        + format_variables(jobvars)
+        + format_variables(variables)
+        + format_matrix(matrix)
+    )
+
+
+def cirrus_build_job(
+    target: str,
+    instance_type: str,
+    image_selector: str,
+    image_name: str,
+    arch: str,
+    pkg_cmd: str,
+    suffix: str,
+    variables: Dict[Any, Any],
+    allow_failure: bool,
+    optional: bool,
+) -> str:
+    jobvars = cirrus_build_vars(
+        target,
+        instance_type,
+        image_selector,
+        image_name,
+        pkg_cmd,
+        variables,
+        optional,
     )
+    return cirrus_job(f"{arch}-{target}{suffix}", allow_failure, jobvars)
@@ -0,0 +1,176 @@
+# batch.py - module implementing concurrent installation of multiple hosts
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from lcitool import LcitoolError
+from lcitool.config import Config
+
+from .install import InstallerError, VirtInstall
+
+log = logging.getLogger(__name__)
+
+
+class BatchInstall:
+    """
+    Installs a number of hosts concurrently.
+
+    The steps shared by hosts of the same target OS (base image download,
+    volume creation) are serialized by VirtInstall itself, everything else
+    (most notably virt-install and waiting for the hosts to come up) runs
+    in parallel.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        strategy: str = "url",
+        jobs: int = 1,
+        force_download: bool = False,
+        template: Optional[str] = None,
+        offline: bool = False,
+    ) -> None:
+        """
+        :param config: Config object
+        :param strategy: installation strategy ('url', 'cloud' or 'template')
+        :param jobs: maximum number of hosts to install at the same time
+        :param force_download: download the base image even if it's cached
+                               ('cloud' strategy only)
+        :param template: path to the template image ('template' strategy only,
+                         the latest template built for each target OS is
+                         used if None)
+        :param offline: only use the cached base images ('cloud' strategy
+                        only)
+        """
+
+        if jobs < 1:
+            raise InstallerError(f"Invalid number of jobs '{jobs}'")
+
+        self._config = config
+        self.strategy = strategy
+        self.jobs = jobs
+        self._force_download = force_download
+        self._template = template
+        self._offline = offline
+        self._started: Dict[str, float] = {}
+
+    def _create(self, name: str, facts: Dict[str, Any]) -> VirtInstall:
+        if self.strategy == "cloud":
+            return VirtInstall.from_vendor_image(
+                name=name,
+                config=self._config,
+                facts=facts,
+                force_download=self._force_download,
+                offline=self._offline,
+            )
+        elif self.strategy == "template":
+            return VirtInstall.from_template_image(
+                name=name,
+                config=self._config,
+                facts=facts,
+                template_path=self._template,
+            )
+        return VirtInstall.from_url(name=name, config=self._config, facts=facts)
+
+    def _start_one(self, name: str, facts: Dict[str, Any], wait: bool) -> VirtInstall:
+        self._started[name] = time.monotonic()
+
+        # there's a single terminal, no serial console can be attached
+        installer = self._create(name, facts)
+        installer.start(wait=wait, console=False)
+        return installer
+
+    def _duration(self, name: str) -> float:
+        started = self._started.get(name, time.monotonic())
+        return round(time.monotonic() - started, 3)
+
+    def _report(self, result: Dict[str, Any], done: int, total: int) -> None:
+        status = "failed" if result["error"] else "installed"
+        print(
+            f"[{done}/{total}] {result['host']} "
+            f"({result['target']}): {status} in {result['duration']:.1f}s"
+        )
+        if result["error"]:
+            log.error(result["error"])
+
+    def run(
+        self, hosts: List[Tuple[str, Dict[str, Any]]], wait: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Install all the hosts.
+
+        The installations are started by up to 'jobs' threads. Hosts installed
+        from cloud images are then waited for to accept SSH connections all
+        at once in a single event loop.
+
+        :param hosts: list of (host name, host facts) tuples
+        :param wait: whether to wait for each installation to complete
+        :returns: list of per-host results (dicts) in the order of hosts, each
+                  containing the host name, its target OS, the error message
+                  if the installation failed (None otherwise) and the
+                  wall-clock duration in seconds
+        """
+
+        results: Dict[str, Dict[str, Any]] = {}
+        installers: Dict[str, VirtInstall] = {}
+        done = 0
+
+        def _fail(name: str, error: Exception) -> None:
+            nonlocal done
+
+            result = results[name]
+            result["error"] = str(error)
+            result["duration"] = self._duration(name)
+            done += 1
+            self._report(result, done, len(hosts))
+
+        self._started = {}
+        for name, facts in hosts:
+            results[name] = {"host": name, "target": facts["target"], "error": None}
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {
+                executor.submit(self._start_one, name, facts, wait): name
+                for name, facts in hosts
+            }
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    installers[name] = future.result()
+                except (LcitoolError, OSError) as ex:
+                    _fail(name, ex)
+
+        errors: Dict[str, Optional[BaseException]] = {}
+        ssh_keys: Dict[str, str] = {}
+        for name, installer in installers.items():
+            if installer.ssh_key is not None:
+                ssh_keys[name] = installer.ssh_key
+        if wait and ssh_keys:
+            prober = VirtInstall.ssh_prober()
+            errors = prober.wait_all(ssh_keys)
+
+        for name, _ in hosts:
+            if name not in installers:
+                continue
+
+            try:
+                error = errors.get(name)
+                if error is not None:
+                    raise InstallerError(f"Failed to install host '{name}': {error}")
+                installers[name].finish()
+            except (LcitoolError, OSError) as ex:
+                _fail(name, ex)
+                continue
+
+            result = results[name]
+            result["duration"] = self._duration(name)
+            done += 1
+            self._report(result, done, len(hosts))
+
+        return [results[name] for name, _ in hosts]
@@ -4,18 +4,21 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import hashlib
+import json
 import logging
 import os
+import re
+import time
 import yaml
 
 import lcitool.install.osinfo as osinfo
 
 from collections import UserDict
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 
 from lcitool import util, LcitoolError
-from typing import Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 log = logging.getLogger(__name__)
 
@@ -41,9 +44,14 @@ class Metadata(UserDict):
     @staticmethod
     def _validate(dict_: Union["Metadata", Dict[str, str]]) -> None:
         schema = set(["target", "image", "url", "arch", "format", "libosinfo_id"])
+
+        # recorded by downloads verifying the image, missing in older metadata
+        optional = set(["sha256", "verified"])
+
         actual = set(dict_.keys())
-        if actual != schema:
-            raise ValueError(actual - schema)
+        invalid = (schema - actual) | (actual - schema - optional)
+        if invalid:
+            raise ValueError(invalid)
 
     def load(self, file: Path) -> "Metadata":
         # load image metadata
@@ -81,6 +89,26 @@ class Metadata(UserDict):
 
 
 class Images:
+    """
+    Manages the cache of downloaded vendor images.
+
+    The images are tracked in an index (stored in the lcitool cache dir)
+    recording their metadata, size and the last time they were used, so that
+    the image metadata files don't need to be loaded every time. The index is
+    rebuilt from the metadata files whenever the cache directory changes
+    behind lcitool's back.
+
+    Resolving the URL of a target OS image needs the osinfo database which is
+    slow to load, so the resolved URLs are cached too (keyed by the database
+    fingerprint) and the database is only loaded when the lookup misses.
+    """
+
+    INDEX_FILE = "images.json"
+    INDEX_VERSION = 1
+
+    OSINFO_CACHE_FILE = "osinfo.json"
+    OSINFO_CACHE_VERSION = 1
+
     @staticmethod
     def _get_cache_dir() -> Path:
         cache_dir = Path(util.get_cache_dir(), "images")
@@ -88,10 +116,24 @@ class Images:
             cache_dir.mkdir()
         return cache_dir
 
-    def __init__(self) -> None:
+    def __init__(self, offline: bool = False) -> None:
+        """
+        :param offline: resolve the image URLs from the lookup cache only,
+                        even if the osinfo database changed since (the
+                        database is never loaded)
+        """
+
+        self._offline = offline
         self._cache_dir: Path = self._get_cache_dir()
-        self._osinfodb: osinfo.OSinfoDB = osinfo.OSinfoDB()
-        self._target_images = self._load(self._cache_dir)
+        self._osinfodb: Optional[osinfo.OSinfoDB] = None
+        self._index = self._load_index()
+        self._target_images = self._load(self._cache_dir, self._index)
+
+    @property
+    def osinfodb(self) -> osinfo.OSinfoDB:
+        if self._osinfodb is None:
+            self._osinfodb = osinfo.OSinfoDB()
+        return self._osinfodb
 
     def get(
         self,
@@ -113,44 +155,229 @@ class Images:
             raise ImageError(
                 f"Expected libosinfo_id to be a string, got {type(libosinfo_id)}"
             )
-        osinfo_img = self._load_osinfo_image_data(
-            self._osinfodb, libosinfo_id, arch, format_
-        )
         metadata = Metadata(
             target=target,
             arch=arch,
             format=format_,
             libosinfo_id=libosinfo_id,
-            url=osinfo_img.url,
+            url=self._lookup_url(libosinfo_id, arch, format_),
         )
 
         self._target_images[target] = Image(metadata, self._cache_dir)
         return self._target_images[target]
 
-    @staticmethod
-    def _load(dir_: Path) -> Dict[str, "Image"]:
-        images: Dict[str, Image] = {}
+    def _lookup_url(self, libosinfo_id: str, arch: str, format_: str) -> str:
+        key = f"{libosinfo_id} {arch} {format_}"
+        fingerprint = osinfo.OSinfoDB.fingerprint()
 
-        # load all image metadata files and store it in the ascending order,
-        # i.e. from newest to oldest
-        for entry in sorted(
-            dir_.glob("*.metadata"), reverse=True, key=lambda x: x.stat().st_mtime
+        lookups: Dict[str, Dict[str, Any]] = {}
+        cache = util.load_cache_file(self.OSINFO_CACHE_FILE)
+        if (
+            isinstance(cache, dict)
+            and cache.get("version") == self.OSINFO_CACHE_VERSION
+            and (self._offline or cache.get("db") == fingerprint)
         ):
+            lookups = cache["images"]
+            if key in lookups:
+                return str(lookups[key]["url"])
+
+        if self._offline:
+            raise ImageError(
+                f"Cloud image of '{libosinfo_id}' ({arch}, {format_}) was never "
+                "looked up, can't resolve it offline"
+            )
+
+        log.debug(f"Looking up cloud image of '{libosinfo_id}' in osinfo database")
+        osinfo_img = self._load_osinfo_image_data(
+            self.osinfodb, libosinfo_id, arch, format_
+        )
+        lookups[key] = {"url": osinfo_img.url, "variants": osinfo_img.variants}
+
+        cache = {
+            "version": self.OSINFO_CACHE_VERSION,
+            "db": fingerprint,
+            "images": lookups,
+        }
+        util.dump_cache_file(self.OSINFO_CACHE_FILE, cache)
+        return osinfo_img.url
+
+    def _dir_mtime(self) -> int:
+        return self._cache_dir.stat().st_mtime_ns
 
-            # check if image with the path exists, log warning and skip
-            if not Path(dir_, entry.stem).exists():
+    def _scan(self, previous: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Build the index entries from the image metadata files."""
+
+        entries: Dict[str, Dict[str, Any]] = {}
+        for entry in self._cache_dir.glob("*.metadata"):
+            try:
+                metadata = Metadata().load(entry)
+            except ImageError as ex:
+                log.warning(f"Ignoring image metadata '{entry}': {ex}")
+                continue
+
+            path = Path(self._cache_dir, Path(metadata["image"]).name)
+            if not path.exists():
                 log.warning("Metadata found, but image is missing, skipping")
                 continue
 
-            # load image metadata
-            metadata = Metadata().load(entry)
+            st = path.stat()
+            last_used = previous.get(path.name, {}).get("last_used")
+            entries[path.name] = {
+                "metadata": dict(metadata.data, image=path.as_posix()),
+                "size": st.st_size,
+                "downloaded": entry.stat().st_mtime,
+                "last_used": last_used,
+            }
+
+        return entries
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        index = util.load_cache_file(self.INDEX_FILE)
+        if (
+            isinstance(index, dict)
+            and index.get("version") == self.INDEX_VERSION
+            and index.get("dir") == self._cache_dir.as_posix()
+            and index.get("dir_mtime") == self._dir_mtime()
+        ):
+            entries: Dict[str, Dict[str, Any]] = index["images"]
+            return entries
+
+        log.debug(f"Rebuilding the index of images in '{self._cache_dir}'")
+        previous: Dict[str, Dict[str, Any]] = {}
+        if isinstance(index, dict) and index.get("dir") == self._cache_dir.as_posix():
+            previous = index.get("images") or {}
+
+        entries = self._scan(previous)
+        self._store_index(entries)
+        return entries
+
+    def _store_index(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        index = {
+            "version": self.INDEX_VERSION,
+            "dir": self._cache_dir.as_posix(),
+            "dir_mtime": self._dir_mtime(),
+            "images": entries,
+        }
+        util.dump_cache_file(self.INDEX_FILE, index)
+
+    @staticmethod
+    def _load(dir_: Path, index: Dict[str, Dict[str, Any]]) -> Dict[str, "Image"]:
+        images: Dict[str, Image] = {}
 
-            # consider only the latest image/metadata of a given target, ignore
-            # the old ones
+        # consider only the latest image of a given target, ignore the old
+        # ones
+        for entry in sorted(
+            index.values(), reverse=True, key=lambda x: float(x["downloaded"])
+        ):
+            metadata = Metadata(entry["metadata"])
             images.setdefault(metadata["target"], Image(metadata, dir_))
 
         return images
 
+    def add(self, image: "Image") -> None:
+        """Record a freshly downloaded image in the index."""
+
+        if image.path is None:
+            raise ImageError("Only downloaded images can be added to the index")
+
+        self._index[image.path.name] = {
+            "metadata": dict(image.metadata.data),
+            "size": image.path.stat().st_size,
+            "downloaded": time.time(),
+            "last_used": None,
+        }
+        self._target_images[image.metadata["target"]] = image
+        self._store_index(self._index)
+
+    def mark_used(self, image: "Image") -> None:
+        """Record that an image was just used to install a host."""
+
+        if image.path is None or image.path.name not in self._index:
+            return
+
+        self._index[image.path.name]["last_used"] = time.time()
+        self._store_index(self._index)
+
+    def list(self) -> List[Dict[str, Any]]:
+        """
+        List the cached images.
+
+        :returns: list of index entries (dicts) containing the image
+                  'metadata', 'size' in bytes, 'downloaded' and 'last_used'
+                  (None if never used) timestamps and whether the image is
+                  the 'latest' one of its target OS, sorted by target OS and
+                  download time
+        """
+
+        latest = [image.path for image in self._target_images.values()]
+
+        entries = []
+        for entry in self._index.values():
+            path = Path(entry["metadata"]["image"])
+            entries.append(dict(entry, latest=path in latest))
+
+        return sorted(entries, key=lambda e: (e["metadata"]["target"], e["downloaded"]))
+
+    def prune(
+        self,
+        max_size: Optional[int] = None,
+        keep: Optional[Set[Path]] = None,
+        dry_run: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Evict images from the cache.
+
+        Images which were superseded by a newer image of the same target OS
+        are evicted first. Then, if the cache is larger than 'max_size', the
+        least recently used images are evicted until it fits. Images listed
+        in 'keep' are never evicted.
+
+        :param max_size: size budget of the cache in bytes (None if unbounded)
+        :param keep: paths of the images to keep no matter what, most notably
+                     images used as backing stores by existing volumes
+        :param dry_run: only report the images which would be evicted
+        :returns: list of the evicted index entries, see list()
+        """
+
+        keep_resolved = set(path.resolve() for path in keep or set())
+
+        entries = self.list()
+        candidates = [
+            e
+            for e in entries
+            if Path(e["metadata"]["image"]).resolve() not in keep_resolved
+        ]
+
+        evicted = [e for e in candidates if not e["latest"]]
+        if max_size is not None:
+            size = sum(e["size"] for e in entries if e not in evicted)
+            lru = sorted(
+                (e for e in candidates if e["latest"]),
+                key=lambda e: e["last_used"] or e["downloaded"],
+            )
+            for entry in lru:
+                if size <= max_size:
+                    break
+                evicted.append(entry)
+                size -= entry["size"]
+
+        if dry_run:
+            return evicted
+
+        for entry in evicted:
+            path = Path(entry["metadata"]["image"])
+            log.info(f"Evicting image '{path.name}' from the cache")
+            path.unlink(missing_ok=True)
+            path.with_suffix(".metadata").unlink(missing_ok=True)
+            del self._index[path.name]
+
+            target = entry["metadata"]["target"]
+            if entry["latest"]:
+                del self._target_images[target]
+
+        self._store_index(self._index)
+        return evicted
+
     @staticmethod
     def _load_osinfo_image_data(
         osinfo_db: osinfo.OSinfoDB, libosinfo_id: str, arch: str, format_: str
@@ -196,6 +423,19 @@ class Image:
         :ivar metadata: metadata for this image (as dict)
     """
 
+    CHUNK_SIZE = 8 * (1 << 20)
+
+    # size of the ranges fetched by parallel downloads
+    PARALLEL_CHUNK_SIZE = 64 * (1 << 20)
+
+    # number of times an interrupted download (or range) is resumed
+    RETRIES = 5
+    TIMEOUT = 60
+
+    # where vendors publish the checksums, relative to the image
+    CHECKSUM_SUFFIXES = [".sha256", ".sha256sum"]
+    CHECKSUM_FILES = ["SHA256SUMS", "CHECKSUM", "sha256sum.txt"]
+
     def __init__(self, metadata: Metadata, download_dir: Path):
         """
         Instantiates a base image handler.
@@ -225,54 +465,390 @@ class Image:
     def metadata(self) -> Metadata:
         return self._metadata
 
-    def download(self) -> str:
+    def _fetch_checksum(self) -> Optional[str]:
+        """
+        Look up the SHA-256 checksum published next to the image.
+
+        Vendors publish the checksums either in a file named after the image
+        or in a list covering the whole directory, using the GNU
+        ('<hash>  <file>') or BSD ('SHA256 (<file>) = <hash>') format.
+
+        :returns: the checksum or None if none could be found
+        """
+
         import requests
+
+        url = self._metadata["url"]
+        base_url, _, filename = url.rpartition("/")
+        candidates = [url + suffix for suffix in self.CHECKSUM_SUFFIXES]
+        candidates += [f"{base_url}/{name}" for name in self.CHECKSUM_FILES]
+
+        for checksum_url in candidates:
+            try:
+                r = requests.get(checksum_url, timeout=self.TIMEOUT)
+                if r.status_code != 200:
+                    continue
+            except requests.RequestException as ex:
+                log.debug(f"Failed to fetch '{checksum_url}': {ex}")
+                continue
+
+            for line in r.text.splitlines():
+                line = line.strip()
+                match = re.match(r"^([0-9a-fA-F]{64})(?:\s+\*?(\S+))?$", line)
+                if match and match.group(2) in [None, filename]:
+                    checksum = match.group(1)
+                else:
+                    match = re.match(r"^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$", line)
+                    if not match or match.group(1) != filename:
+                        continue
+                    checksum = match.group(2)
+
+                log.debug(f"Found checksum of '{filename}' in '{checksum_url}'")
+                return checksum.lower()
+
+        return None
+
+    @staticmethod
+    def _get_validator(headers: Any) -> Optional[str]:
+        """
+        Get the validator to resume a download of the response's data with.
+
+        :param headers: headers of the response
+        :returns: the ETag or the Last-Modified date, None if the response has
+                  neither (If-Range only accepts strong ETags)
+        """
+
+        validator = headers.get("etag")
+        if not validator or validator.startswith("W/"):
+            validator = headers.get("last-modified")
+        return str(validator) if validator else None
+
+    @staticmethod
+    def _validator_path(part_path: Path) -> Path:
+        return part_path.with_name(part_path.name + ".validator")
+
+    def _download_stream(self, part_path: Path, progress: Any) -> str:
+        """
+        Download the image sequentially, resuming from the partial file.
+
+        The validator (ETag or Last-Modified) of the data is recorded next to
+        the partial file and a download is only resumed if the server confirms
+        the data haven't changed since (If-Range), otherwise it restarts.
+
+        :returns: SHA-256 checksum of the downloaded data
+        """
+
+        import requests
+
+        url = self._metadata["url"]
+        hasher = hashlib.sha256()
+        validator_path = self._validator_path(part_path)
+
+        # whatever was downloaded by a previous (interrupted) run is kept,
+        # unless it can't be told whether the data on the server changed since
+        offset = 0
+        validator = None
+        if part_path.exists() and validator_path.exists():
+            validator = validator_path.read_text()
+            with open(part_path, "rb") as fd:
+                for chunk in iter(lambda: fd.read(self.CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+            log.info(f"Resuming the download at {offset} bytes")
+
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                delay = min(2**attempt, 30)
+                log.warning(
+                    f"Resuming the download in {delay}s ({attempt}/{self.RETRIES})"
+                )
+                time.sleep(delay)
+
+            if offset and validator is None:
+                log.warning("Server provides no ETag nor Last-Modified, restarting")
+                hasher = hashlib.sha256()
+                offset = 0
+
+            headers = {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = str(validator)
+
+            try:
+                with requests.get(
+                    url, headers=headers, stream=True, timeout=self.TIMEOUT
+                ) as r:
+                    if offset and r.status_code == 416:
+                        # the previous run got all the data, but didn't finish
+                        return hasher.hexdigest()
+
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        log.warning(
+                            "Image changed on the server or server doesn't "
+                            "support resuming, restarting"
+                        )
+                        hasher = hashlib.sha256()
+                        offset = 0
+
+                    if not offset:
+                        validator = self._get_validator(r.headers)
+                        if validator is not None:
+                            validator_path.write_text(validator)
+                        else:
+                            validator_path.unlink(missing_ok=True)
+
+                    total = None
+                    if "content-length" in r.headers:
+                        total = offset + int(r.headers["content-length"])
+                    progress.reset(total=total)
+                    progress.update(offset)
+
+                    with open(part_path, "ab" if offset else "wb") as fd:
+                        for chunk in r.iter_content(self.CHUNK_SIZE):
+                            fd.write(chunk)
+                            hasher.update(chunk)
+                            offset += len(chunk)
+                            progress.update(len(chunk))
+
+                    if total is not None and offset < total:
+                        log.warning(f"Download interrupted at {offset}/{total} bytes")
+                        continue
+
+                    return hasher.hexdigest()
+
+            except requests.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code < 500:
+                    raise ImageError(f"Failed to download '{url}': {ex}")
+                log.warning(f"Download interrupted: {ex}")
+            except requests.RequestException as ex:
+                log.warning(f"Download interrupted: {ex}")
+
+        raise ImageError(f"Failed to download '{url}': too many failed attempts")
+
+    def _fetch_range(
+        self,
+        part_path: Path,
+        start: int,
+        end: int,
+        validator: str,
+        progress: Any,
+        lock: Any,
+    ) -> None:
+        import requests
+
+        url = self._metadata["url"]
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                time.sleep(min(2**attempt, 30))
+
+            offset = start
+            try:
+                # the whole image is sent instead if it changed on the server
+                headers = {"Range": f"bytes={start}-{end}", "If-Range": validator}
+                with requests.get(
+                    url, headers=headers, stream=True, timeout=self.TIMEOUT
+                ) as r:
+                    if r.status_code == 200:
+                        raise ImageError(
+                            f"Failed to download '{url}': the image changed on "
+                            "the server during the download"
+                        )
+                    if r.status_code != 206:
+                        raise ImageError(
+                            f"Failed to download '{url}': unexpected response "
+                            f"to a range request ({r.status_code})"
+                        )
+
+                    with open(part_path, "r+b") as fd:
+                        fd.seek(start)
+                        for chunk in r.iter_content(self.CHUNK_SIZE):
+                            chunk = chunk[: end + 1 - offset]
+                            fd.write(chunk)
+                            offset += len(chunk)
+                            with lock:
+                                progress.update(len(chunk))
+
+                if offset == end + 1:
+                    return
+                log.warning(f"Range {start}-{end} interrupted at {offset} bytes")
+            except requests.RequestException as ex:
+                log.warning(f"Range {start}-{end} interrupted: {ex}")
+
+            # the range is fetched again as a whole
+            with lock:
+                progress.update(start - offset)
+
+        raise ImageError(f"Failed to download '{url}': too many failed attempts")
+
+    def _download_parallel(
+        self, part_path: Path, size: int, validator: str, jobs: int, progress: Any
+    ) -> str:
+        """
+        Download the image in ranges fetched in parallel.
+
+        The ranges fetched completely are recorded in a state file next to the
+        partial file along with the validator (ETag or Last-Modified) of the
+        data, so that only the missing ones are fetched again when the
+        download is resumed and the data on the server haven't changed since.
+
+        :returns: SHA-256 checksum of the downloaded data
+        """
+
+        import threading
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        url = self._metadata["url"]
+        state_path = part_path.with_name(part_path.name + ".ranges")
+        state: Dict[str, Any] = {}
+        if state_path.exists() and part_path.exists():
+            try:
+                state = json.loads(state_path.read_text())
+            except ValueError:
+                pass
+        if (
+            state.get("url") != url
+            or state.get("size") != size
+            or state.get("validator") != validator
+        ):
+            state = {"url": url, "size": size, "validator": validator, "done": []}
+            with open(part_path, "wb") as fd:
+                fd.truncate(size)
+
+        chunk_size = self.PARALLEL_CHUNK_SIZE
+        ranges = [
+            (start, min(start + chunk_size, size) - 1)
+            for start in range(0, size, chunk_size)
+            if start not in state["done"]
+        ]
+
+        progress.reset(total=size)
+        progress.update(size - sum(end + 1 - start for start, end in ranges))
+        if state["done"]:
+            log.info(f"Resuming the download, {len(ranges)} ranges left")
+
+        lock = threading.Lock()
+
+        def _fetch(start: int, end: int) -> None:
+            self._fetch_range(part_path, start, end, validator, progress, lock)
+            with lock:
+                state["done"].append(start)
+                state_path.write_text(json.dumps(state))
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_fetch, *range_) for range_ in ranges]
+            for future in futures:
+                future.result()
+
+        state_path.unlink()
+
+        hasher = hashlib.sha256()
+        with open(part_path, "rb") as part:
+            for chunk in iter(lambda: part.read(self.CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _probe_ranges(self, jobs: int) -> Optional[Tuple[int, str]]:
+        """
+        Probe whether the image can be fetched in parallel.
+
+        :returns: the size and validator (ETag or Last-Modified) of the image,
+                  None if it can't be fetched in parallel
+        """
+
+        import requests
+
+        if jobs < 2:
+            return None
+
+        try:
+            r = requests.head(
+                self._metadata["url"], allow_redirects=True, timeout=self.TIMEOUT
+            )
+            r.raise_for_status()
+        except requests.RequestException:
+            return None
+
+        size = int(r.headers.get("content-length", 0))
+        if r.headers.get("accept-ranges") != "bytes":
+            return None
+        if size < 2 * self.PARALLEL_CHUNK_SIZE:
+            return None
+
+        # the ranges can't be told to come from the same data otherwise
+        validator = self._get_validator(r.headers)
+        if validator is None:
+            return None
+        return size, validator
+
+    def download(self, jobs: int = 1) -> str:
+        """
+        Download the image.
+
+        The image is downloaded to a partial file first, which is kept when
+        the download fails, so that the next attempt can resume where the
+        previous one left off. Once complete, the data are verified against
+        the SHA-256 checksum published by the vendor (if any).
+
+        :param jobs: number of ranges of the image to fetch in parallel (if
+                     the server supports range requests)
+        :returns: path to the downloaded image
+        """
+
         from tqdm import tqdm
 
         url = self._metadata["url"]
         target = self._metadata["target"]
         suffix = self._metadata["format"]
 
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        part_path = Path(self._download_dir, f".{target}_{url_hash}.{suffix}.part")
+
+        expected = self._fetch_checksum()
+        if expected is None:
+            log.warning(f"No SHA-256 checksum published for '{url}'")
+
         log.info(f"Downloading from {url}")
-        with requests.get(url, stream=True) as r:
-            total_size = int(r.headers.get("content-length", 0))
-            with tqdm(
-                ascii=" #",
-                total=total_size,
-                ncols=80,
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as progress:
-
-                with NamedTemporaryFile(
-                    "wb",
-                    prefix=f"{target}_",
-                    suffix="." + suffix,
-                    dir=self._download_dir,
-                    delete=False,
-                ) as fd:
-                    chunk_size = 8 * (1 << 20)
-                    for chunk in r.iter_content(chunk_size):
-                        how_much = fd.write(chunk)
-                        progress.update(how_much)
-                    filepath = fd.name
+        with tqdm(
+            ascii=" #",
+            ncols=80,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as progress:
+            probe = self._probe_ranges(jobs)
+            if probe is not None:
+                size, validator = probe
+                checksum = self._download_parallel(
+                    part_path, size, validator, jobs, progress
+                )
+            else:
+                checksum = self._download_stream(part_path, progress)
 
         print()
+        self._validator_path(part_path).unlink(missing_ok=True)
+
+        if expected is not None and checksum != expected:
+            # the data are broken, don't resume from them next time
+            part_path.unlink()
+            raise ImageError(
+                f"Checksum mismatch for '{url}': expected {expected}, got {checksum}"
+            )
+
+        filepath = Path(self._download_dir, f"{target}_{checksum[:16]}.{suffix}")
+        os.replace(part_path, filepath)
 
         # We need to set 0644 permissions on the vendor image so that guestfs
         # tools can mount the backing chains utilizing with these vendor
         # images since owner:group permissions are never restored with
         # libvirt's dynamic ownership on any but the top image in the backing
         # chain.
-        #
-        # NOTE: we also couldn't have simply used umask when downloading the
-        # vendor image, because the downloaded file is created using
-        # NamedTemporaryFile which for security reasons has hardcoded
-        # permissions 0600
         os.chmod(filepath, 0o644)
 
         # update missing metadata and dump it
-        self._metadata["image"] = filepath
-        self._metadata.dump(Path(fd.name).with_suffix(".metadata"))
-        return fd.name
+        self._metadata["image"] = filepath.as_posix()
+        self._metadata["sha256"] = checksum
+        self._metadata["verified"] = expected is not None
+        self._metadata.dump(filepath.with_suffix(".metadata"))
+        return filepath.as_posix()
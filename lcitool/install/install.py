@@ -2,10 +2,10 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-import errno
 import logging
 import os
 import subprocess
+import threading
 
 from pathlib import Path
 from tempfile import NamedTemporaryFile
@@ -34,6 +34,35 @@ class InstallationNotSupported(InstallerError):
 
 class VirtInstall:
 
+    # Serializes the steps shared by all the hosts of the same target OS,
+    # i.e. the base image download and the creation of volumes backed by it
+    _target_locks: Dict[str, threading.Lock] = {}
+    _target_locks_lock = threading.Lock()
+
+    # Base images resolved by concurrent installs, but not backing their
+    # volumes yet (image path -> number of installs), which must survive the
+    # eviction of images from the cache; guarded by the lock which serializes
+    # looking images up with evicting them
+    _held_images: Dict[Path, int] = {}
+    _images_lock = threading.Lock()
+
+    @classmethod
+    def _target_lock(cls, target: str) -> threading.Lock:
+        with cls._target_locks_lock:
+            return cls._target_locks.setdefault(target, threading.Lock())
+
+    @classmethod
+    def _hold_image(cls, path: Path) -> None:
+        # must be called with the images lock held
+        cls._held_images[path] = cls._held_images.get(path, 0) + 1
+
+    @classmethod
+    def _release_image(cls, path: Path) -> None:
+        with cls._images_lock:
+            cls._held_images[path] -= 1
+            if not cls._held_images[path]:
+                del cls._held_images[path]
+
     @classmethod
     def from_url(
         cls, config: Config, name: str, facts: Dict[str, Any]
@@ -63,31 +92,93 @@ class VirtInstall:
         config: Config,
         facts: Dict[str, Any],
         force_download: bool = False,
+        offline: bool = False,
     ) -> "VirtInstall":
-        """Shortcut constructor for a cloud-init image-based installation."""
+        """
+        Shortcut constructor for a cloud-init image-based installation.
+
+        With 'offline', only the images already in the cache are used.
+        """
 
         arch = config.values["install"]["arch"]
         target = facts["target"]
 
+        with cls._target_lock(target):
+            images = Images(offline=offline)
+            download = force_download
+            with cls._images_lock:
+                try:
+                    image = images.get(target, facts, arch)
+                except NoImageError:
+                    raise InstallerError(f"Host {name} doesn't support installation")
+
+                if image.path is None:
+                    download = True
+                elif not download:
+                    cls._hold_image(image.path)
+
+            # Download the cloud base image if needed
+            if download:
+                if offline:
+                    raise InstallerError(
+                        f"No cloud image of '{target}' in the cache, can't "
+                        f"download '{image.metadata['url']}' offline"
+                    )
+                image.download(jobs=config.values["install"]["download_jobs"])
+                images.add(image)
+                if image.path is None:
+                    raise InstallerError(f"Host {name} image path is None")
+                with cls._images_lock:
+                    cls._hold_image(image.path)
+                cls._evict_images(config)
+            images.mark_used(image)
+
+        runner = cls(name, facts)
+        path = image.path
+        assert path is not None
         try:
-            image = Images().get(target, facts, arch)
-        except NoImageError:
-            raise InstallerError(f"Host {name} doesn't support installation")
+            return cls._from_image(runner, config, path)
+        finally:
+            # once the volume is created, the image is one of its backing
+            # stores, which are never evicted
+            cls._release_image(path)
 
-        # Download the cloud base image if needed
-        if image.path is None or force_download:
-            image.download()
+    @classmethod
+    def _evict_images(cls, config: Config) -> None:
+        cache_size = config.values["install"]["image_cache_size"]
+        if not cache_size:
+            return
 
-        runner = cls(name, facts)
-        if image.path is None:
-            raise InstallerError(f"Host {name} image path is None")
-        return cls._from_image(runner, config, image.path)
+        with cls._images_lock:
+            keep = LibvirtWrapper().backing_stores()
+            keep.update(cls._held_images)
+            Images().prune(max_size=cache_size * (1 << 30), keep=keep)
 
     @classmethod
     def from_template_image(
-        cls, name: str, config: Any, facts: Dict[str, Any], template_path: str
+        cls,
+        name: str,
+        config: Any,
+        facts: Dict[str, Any],
+        template_path: Optional[str] = None,
     ) -> "VirtInstall":
-        """Shortcut constructor for a template image-based installation."""
+        """
+        Shortcut constructor for a template image-based installation.
+
+        Without 'template_path', the latest template built for the target OS
+        by 'lcitool template build' is used.
+        """
+
+        if template_path is None:
+            from .template import Templates
+
+            template = Templates().latest(facts["target"])
+            if template is None:
+                raise InstallerError(
+                    f"No template built for '{facts['target']}', "
+                    "run 'lcitool template build' first or pass --template"
+                )
+            template_path = template.path.as_posix()
 
         runner = cls(name, facts)
         return cls._from_image(runner, config, Path(template_path))
@@ -107,6 +198,7 @@ class VirtInstall:
         self._cmd = "virt-install"
         self._ssh_keypair: Optional[Any] = None
         self._wait_callback: Optional[Any] = None
+        self.volume: Optional[Any] = None
 
     def __call__(self, wait: bool = False) -> None:
         """
@@ -125,6 +217,23 @@ class VirtInstall:
     def __str__(self) -> str:
         return " ".join([self._cmd] + self.args)
 
+    @staticmethod
+    def _get_volume_options(config: Config) -> Dict[str, Any]:
+        install = config.values["install"]
+
+        features = []
+        if install["disk_lazy_refcounts"]:
+            features.append("lazy_refcounts")
+        if install["disk_extended_l2"]:
+            features.append("extended_l2")
+
+        # no preallocation, libvirt can't preallocate volumes with a backing
+        # store (see Config._validate)
+        return {
+            "cluster_size": install["disk_cluster_size"] or None,
+            "features": features,
+        }
+
     @staticmethod
     def _from_image(
         runner: "VirtInstall", config: Config, baseimg_path: Path, **kwargs: Any
@@ -136,15 +245,17 @@ class VirtInstall:
         # To force user/group permissions on the target volume, we have to
         # create it ourselves as virt-install doesn't accept file permissions
         # or mode for the file-based volumes it creates
-        libvirt_pool = LibvirtWrapper().pool_by_name(conf_pool)
-        storage_vol = libvirt_pool.create_volume(
-            runner.name + ".qcow2",
-            conf_size,
-            units="G",
-            owner=str(os.getuid()),
-            group=str(os.getgid()),
-            backing_store=baseimg_path,
-        )
+        with runner._target_lock(runner._facts["target"]):
+            libvirt_pool = LibvirtWrapper().pool_by_name(conf_pool)
+            storage_vol = libvirt_pool.create_volume(
+                runner.name + ".qcow2",
+                conf_size,
+                units="G",
+                owner=str(os.getuid()),
+                group=str(os.getgid()),
+                backing_store=baseimg_path,
+                **runner._get_volume_options(config),
+            )
 
         # Dump the edited cloud-init template for virt-install to use
         ssh_keypair = util.SSHKeyPair(config.values["install"]["ssh_key"])
@@ -164,6 +275,7 @@ class VirtInstall:
             fd.write(config_data)
             runner.args.extend(["--cloud-init", f"user-data={fd.name}"])
 
+        runner.volume = storage_vol
         disk_arg = f"vol={libvirt_pool.name}/{storage_vol.name},bus=virtio"
         runner.args.extend(["--import", "--disk", disk_arg])
         runner.args.extend(runner._get_common_args(config))
@@ -280,96 +392,100 @@ class VirtInstall:
         ]
         return url_args
 
-    def _ssh_wait_cb(self, timeout: int = 60) -> None:
-        import paramiko
-        from paramiko import PKey
-        from paramiko.client import SSHClient
+    @property
+    def ssh_key(self) -> Optional[str]:
+        """Path to the private key to wait for the host's SSH with, if any."""
 
-        from socket import EAI_NONAME
-        from time import sleep
+        if self._wait_callback is None or self._ssh_keypair is None:
+            return None
 
-        hostname = self.name
-        if self._ssh_keypair is None:
-            raise InstallerError("SSH keypair not initialized")
-        private_key_path = self._ssh_keypair.private_key.path.as_posix()
-
-        log.debug(
-            f"Establishing SSH connection: hostname={hostname},"
-            f"ssh_key={private_key_path}"
-        )
-
-        # We're mostly creating throwaway VMs, we don't want nor need to
-        # add the VM's hostkey to user's KnownHostKeyFile
-        class _IgnorePolicy(paramiko.MissingHostKeyPolicy):
-            def missing_host_key(
-                self, client: SSHClient, hostname: str, key: PKey
-            ) -> None:
-                return
-
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(_IgnorePolicy)
-
-        # we need to give the machine a head start (up to timeout seconds)
-        # to get an IP lease first and only then we can try SSHing into the
-        # machine (wait in 2s increments)
-        seconds = 2
-        for _ in range(timeout // seconds):
-            sleep(seconds)
-            try:
-                client.connect(
-                    hostname=hostname, username="root", key_filename=private_key_path
-                )
-                return
-
-            except paramiko.ssh_exception.NoValidConnectionsError as ex:
-                # NoValidConnectionsError is a subclass of various socket
-                # errors which in turn is a subclass of OSError. We're
-                # specifically interested in EHOSTUNREACH and ECONNREFUSED
-                # errnos which we can ignore for the duration of the timeout
-                # period
-                for error in ex.errors.values():
-                    if isinstance(error, OSError):
-                        if (
-                            error.errno == errno.EHOSTUNREACH
-                            or error.errno == errno.ECONNREFUSED
-                        ):
-                            break
-                else:
-                    raise InstallerError(f"Failed to connect to instance: {ex}")
-
-            except OSError as ex:
-                if ex.errno == EAI_NONAME:  # Name or service not known
-                    continue
-                raise InstallerError(f"Failed to connect to instance: {ex}")
-
-        raise InstallerError(f"Failed to connect to {hostname}: timeout reached")
-
-    def run(self, wait: bool = False) -> None:
+        path: str = self._ssh_keypair.private_key.path.as_posix()
+        return path
+
+    @staticmethod
+    def ssh_prober(timeout: int = 60) -> Any:
         """
-        Kick off the VM installation.
+        Create a prober waiting for SSH on the installed hosts.
 
-        The 'wait' parameter also controls how we wait for the installation
-        process to finish. In case of URL-based install whether a serial
-        console should be attached to the installation process. On the other
-        hand, in case of installing from a cloud-init base image it controls
-        whether we apply a wait callback until we can ping the machine.
+        The prober learns the hosts' addresses from libvirt (DHCP leases,
+        guest agent) as soon as they're known, falling back to the host
+        names otherwise.
 
-        :param wait: whether to wait for the installation to complete (boolean)
+        :param timeout: maximum number of seconds to wait for each host
+        :returns: SSHReadinessProber object
+        """
+
+        from .readiness import SSHReadinessProber
+
+        libvirt = LibvirtWrapper()
+        return SSHReadinessProber(timeout=timeout, resolver=libvirt.domain_address)
+
+    def _ssh_wait_cb(self, timeout: int = 60) -> None:
+        import asyncio
+
+        private_key_path = self.ssh_key
+        if private_key_path is None:
+            raise InstallerError("SSH keypair not initialized")
+
+        prober = self.ssh_prober(timeout)
+        asyncio.run(prober.wait(self.name, private_key_path))
+
+    def start(self, wait: bool = False, console: bool = True) -> None:
+        """
+        Run virt-install, without waiting for the host to accept SSH.
+
+        See run() for the meaning of the parameters. Once the host is ready,
+        finish() needs to be called.
         """
 
         if not wait:
             self.args.append("--noautoconsole")
+        elif not console and not self._wait_callback:
+            self.args.extend(["--noautoconsole", "--wait", "-1"])
+
+        # facts Ansible cached for a previous host of the same name are stale
+        # and so is the fingerprint of its last update
+        Path(util.get_ansible_facts_dir(), self.name).unlink(missing_ok=True)
+        Path(util.get_update_fingerprints_dir(), self.name).unlink(missing_ok=True)
 
         self.args.extend(["--name", self.name])
         cmd = [self._cmd] + self.args
         log.debug(f"Running {cmd}")
         try:
             subprocess.check_call(cmd)
+        except Exception as ex:
+            raise InstallerError(f"Failed to install host '{self.name}': {ex}")
 
-            if wait and self._wait_callback:
-                self._wait_callback()
+    def finish(self) -> None:
+        """Mark the installed host as an lcitool host of its target OS."""
 
+        try:
             # mark the host XML using XML metadata
             LibvirtWrapper().set_target(self.name, self._facts["target"])
         except Exception as ex:
             raise InstallerError(f"Failed to install host '{self.name}': {ex}")
+
+    def run(self, wait: bool = False, console: bool = True) -> None:
+        """
+        Kick off the VM installation.
+
+        The 'wait' parameter also controls how we wait for the installation
+        process to finish. In case of URL-based install whether a serial
+        console should be attached to the installation process. On the other
+        hand, in case of installing from a cloud-init base image it controls
+        whether we apply a wait callback until we can ping the machine.
+
+        :param wait: whether to wait for the installation to complete (boolean)
+        :param console: whether a serial console may be attached to a
+                        URL-based installation we wait for; if not,
+                        virt-install waits for the installation to finish
+                        on its own (boolean)
+        """
+
+        self.start(wait, console)
+        if wait and self._wait_callback:
+            try:
+                self._wait_callback()
+            except Exception as ex:
+                raise InstallerError(f"Failed to install host '{self.name}': {ex}")
+        self.finish()
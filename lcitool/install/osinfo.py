@@ -5,7 +5,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import abc
+import hashlib
+import json
+import os
 
+from pathlib import Path
 from typing import Any, List
 from gi.repository import Libosinfo  # type: ignore[import-untyped,attr-defined]
 
@@ -16,6 +20,43 @@ class OSinfoAbstractObject(abc.ABC):
 
 
 class OSinfoDB:
+    @staticmethod
+    def _default_paths() -> List[Path]:
+        # the same locations Libosinfo.Loader.process_default_path() loads
+        config_home = os.environ.get(
+            "XDG_CONFIG_HOME", Path(Path.home(), ".config").as_posix()
+        )
+        return [
+            Path(os.environ.get("OSINFO_DATA_DIR", "/usr/share/libosinfo/db")),
+            Path(os.environ.get("OSINFO_SYSTEM_DIR", "/usr/share/osinfo")),
+            Path(os.environ.get("OSINFO_LOCAL_DIR", "/etc/osinfo")),
+            Path(os.environ.get("OSINFO_USER_DIR", Path(config_home, "osinfo"))),
+        ]
+
+    @classmethod
+    def fingerprint(cls) -> str:
+        """
+        Fingerprint of the osinfo database, computed without loading it.
+
+        The fingerprint changes whenever the database is updated, i.e. when
+        its version or the mtime of any of its directories change.
+        """
+
+        state = []
+        for path in cls._default_paths():
+            for entry in [path, Path(path, "os")]:
+                try:
+                    state.append([entry.as_posix(), entry.stat().st_mtime_ns])
+                except OSError:
+                    continue
+
+            try:
+                state.append([path.as_posix(), Path(path, "VERSION").read_text()])
+            except OSError:
+                pass
+
+        return hashlib.sha256(json.dumps(state).encode()).hexdigest()[:16]
+
     def __init__(self) -> None:
         loader: Libosinfo.Loader = Libosinfo.Loader()
         loader.process_default_path()
@@ -0,0 +1,168 @@
+# readiness.py - module probing freshly installed hosts for SSH readiness
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import logging
+import random
+
+from typing import Callable, Dict, Optional
+
+from .install import InstallerError
+
+log = logging.getLogger(__name__)
+
+
+class SSHReadinessProber:
+    """
+    Waits for hosts to accept SSH connections.
+
+    Each attempt first does a cheap non-blocking TCP connect to the SSH port
+    and only once the port is open a full SSH handshake (including the
+    authentication) is tried. Failed attempts are retried with exponential
+    backoff and jitter until the timeout is reached. All the waiting happens
+    in a single asyncio event loop, so any number of hosts can be waited for
+    at once.
+
+    :ivar timeout: maximum number of seconds to wait for each host
+    :ivar port: SSH port
+    :ivar username: user to authenticate as during the handshake
+    """
+
+    INITIAL_DELAY = 0.5
+    MAX_DELAY = 8.0
+    CONNECT_TIMEOUT = 3.0
+
+    def __init__(
+        self,
+        timeout: float = 60,
+        port: int = 22,
+        username: str = "root",
+        resolver: Optional[Callable[[str], Optional[str]]] = None,
+    ) -> None:
+        """
+        :param timeout: maximum number of seconds to wait for each host
+        :param port: SSH port
+        :param username: user to authenticate as during the handshake
+        :param resolver: callable returning the IP address of a host as soon
+                         as it's known (e.g. from the DHCP leases), or None
+                         in which case the host name is used
+        """
+
+        self.timeout = timeout
+        self.port = port
+        self.username = username
+        self._resolver = resolver
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.MAX_DELAY, self.INITIAL_DELAY * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def _resolve(self, hostname: str) -> str:
+        if self._resolver is None:
+            return hostname
+
+        loop = asyncio.get_running_loop()
+        address = await loop.run_in_executor(None, self._resolver, hostname)
+        return address or hostname
+
+    async def _port_open(self, address: str) -> bool:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, self.port), self.CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as ex:
+            log.debug(f"SSH port of '{address}' not reachable yet: {ex}")
+            return False
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    def _handshake(self, address: str, key_filename: str) -> None:
+        import paramiko
+
+        # We're mostly creating throwaway VMs, we don't want nor need to
+        # add the VM's hostkey to user's KnownHostKeyFile
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+        try:
+            client.connect(
+                hostname=address,
+                port=self.port,
+                username=self.username,
+                key_filename=key_filename,
+                timeout=self.CONNECT_TIMEOUT,
+                banner_timeout=self.CONNECT_TIMEOUT,
+                auth_timeout=self.CONNECT_TIMEOUT,
+                allow_agent=False,
+                look_for_keys=False,
+            )
+        finally:
+            client.close()
+
+    async def wait(self, hostname: str, key_filename: str) -> str:
+        """
+        Wait for a host to accept SSH connections.
+
+        :param hostname: name of the host
+        :param key_filename: path to the private SSH key to authenticate with
+        :returns: the address the host was reached at
+        :raises: InstallerError if the host isn't ready in time
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        last_error: Optional[BaseException] = None
+
+        log.debug(f"Waiting for SSH on '{hostname}': ssh_key={key_filename}")
+        attempt = 0
+        while loop.time() < deadline:
+            address = await self._resolve(hostname)
+            if await self._port_open(address):
+                try:
+                    await loop.run_in_executor(
+                        None, self._handshake, address, key_filename
+                    )
+                    log.debug(f"Host '{hostname}' is reachable at '{address}'")
+                    return address
+                except Exception as ex:
+                    # sshd might be up before cloud-init installs the keys
+                    log.debug(f"SSH handshake with '{address}' failed: {ex}")
+                    last_error = ex
+
+            delay = min(self._backoff(attempt), max(0, deadline - loop.time()))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        message = f"Failed to connect to {hostname}: timeout reached"
+        if last_error is not None:
+            message += f" ({last_error})"
+        raise InstallerError(message)
+
+    async def _wait_all(
+        self, hosts: Dict[str, str]
+    ) -> Dict[str, Optional[BaseException]]:
+        names = list(hosts)
+        results = await asyncio.gather(
+            *(self.wait(name, hosts[name]) for name in names),
+            return_exceptions=True,
+        )
+        return {
+            name: (result if isinstance(result, BaseException) else None)
+            for name, result in zip(names, results)
+        }
+
+    def wait_all(self, hosts: Dict[str, str]) -> Dict[str, Optional[BaseException]]:
+        """
+        Wait for a number of hosts at once.
+
+        :param hosts: host name -> private SSH key path dictionary
+        :returns: host name -> exception (None if the host is ready)
+                  dictionary
+        """
+
+        return asyncio.run(self._wait_all(hosts))
@@ -0,0 +1,265 @@
+# template.py - builds and manages pre-provisioned VM template images
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import subprocess
+import time
+import yaml
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from lcitool import util
+from lcitool.config import Config
+from lcitool.libvirt_wrapper import LibvirtWrapper
+
+from .install import InstallerError, VirtInstall
+
+log = logging.getLogger(__name__)
+
+
+class Template:
+    """
+    Attributes:
+        :ivar path: path to the template image
+        :ivar metadata: metadata of the template (as dict)
+    """
+
+    def __init__(self, path: Path, metadata: Dict[str, Any]) -> None:
+        self.path = path
+        self.metadata = metadata
+
+    @property
+    def target(self) -> str:
+        return str(self.metadata["target"])
+
+    @property
+    def version(self) -> str:
+        return str(self.metadata["version"])
+
+
+class Templates:
+    """
+    Manages the template images stored in the image cache.
+
+    Each template is a standalone qcow2 image named '<target>-<version>.qcow2'
+    accompanied by a '.metadata' file, the version being the UTC time the
+    template was sealed at, so that the latest template sorts last.
+    """
+
+    @staticmethod
+    def _get_cache_dir() -> Path:
+        cache_dir = Path(util.get_cache_dir(), "images", "templates")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return cache_dir
+
+    def __init__(self) -> None:
+        self._cache_dir = self._get_cache_dir()
+
+    def list(self, target: Optional[str] = None) -> List[Template]:
+        """
+        List the available templates, oldest first.
+
+        :param target: only list the templates of this target OS
+        """
+
+        templates = []
+        for entry in sorted(self._cache_dir.glob("*.metadata")):
+            path = entry.with_suffix(".qcow2")
+            if not path.exists():
+                log.warning(f"Metadata '{entry}' found, but template is missing")
+                continue
+
+            with open(entry, "r") as fd:
+                try:
+                    metadata = yaml.safe_load(fd)
+                except yaml.YAMLError as ex:
+                    log.warning(f"Failed to load template metadata '{entry}': {ex}")
+                    continue
+
+            if not isinstance(metadata, dict) or "target" not in metadata:
+                log.warning(f"Invalid template metadata '{entry}', skipping")
+                continue
+
+            if target is None or metadata["target"] == target:
+                templates.append(Template(path, metadata))
+
+        return sorted(templates, key=lambda t: (t.target, t.version))
+
+    def latest(self, target: str) -> Optional[Template]:
+        """Return the latest template of the target OS (None if there's none)."""
+
+        templates = self.list(target)
+        if not templates:
+            return None
+        return templates[-1]
+
+    def add(self, target: str, image: Path, **metadata: Any) -> Template:
+        """
+        Store a new version of the target OS template.
+
+        :param target: target OS of the template
+        :param image: path to a standalone qcow2 image to turn into the
+                      template (the image is moved into the cache)
+        :param metadata: any other metadata to record with the template
+        :returns: Template object
+        """
+
+        version = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        path = Path(self._cache_dir, f"{target}-{version}.qcow2")
+
+        # the template is going to be a read-only backing image of VMs whose
+        # volumes are owned by whoever runs QEMU, see Image.download
+        os.chmod(image, 0o644)
+        os.replace(image, path)
+
+        metadata = dict(metadata, target=target, version=version)
+        with open(path.with_suffix(".metadata"), "w") as fd:
+            yaml.safe_dump(metadata, fd)
+
+        log.info(f"Template '{path.name}' stored in '{self._cache_dir}'")
+        return Template(path, metadata)
+
+
+class TemplateBuilder:
+    """
+    Builds a template image of a target OS.
+
+    The template is built by installing a temporary VM from the vendor cloud
+    image. Once the VM is provisioned (which is up to the caller, usually by
+    running the 'update' playbook on it), it's sealed: the per-instance state
+    (cloud-init, machine ID, SSH host keys) is wiped, the VM is shut down and
+    its disk is flattened into a standalone template image. VMs installed from
+    the template are then only thin qcow2 overlays on top of it.
+    """
+
+    SEAL_COMMANDS = [
+        "cloud-init clean --logs",
+        "rm -f /etc/ssh/ssh_host_*",
+        "if test -f /etc/machine-id; then : > /etc/machine-id; fi",
+        "sync",
+    ]
+
+    def __init__(
+        self,
+        config: Config,
+        target: str,
+        facts: Dict[str, Any],
+        force_download: bool = False,
+    ) -> None:
+        """
+        :param config: Config object
+        :param target: target OS to build the template of
+        :param facts: facts of the target OS
+        :param force_download: download the vendor image even if it's cached
+        """
+
+        self.name = f"lcitool-template-{target}"
+        self.target = target
+        self._config = config
+        self._facts = facts
+        self._force_download = force_download
+        self._installer: Optional[VirtInstall] = None
+
+    def _exists(self) -> bool:
+        return any(name == self.name for name, _ in LibvirtWrapper().domains)
+
+    def install(self) -> None:
+        """Install the builder VM and wait for it to accept SSH connections."""
+
+        if self._exists():
+            raise InstallerError(
+                f"Template builder VM '{self.name}' already exists, "
+                "remove it before building a new template"
+            )
+
+        self._installer = VirtInstall.from_vendor_image(
+            name=self.name,
+            config=self._config,
+            facts=self._facts,
+            force_download=self._force_download,
+        )
+        self._installer.run(wait=True, console=False)
+
+    def _ssh_run(self, command: str) -> None:
+        import paramiko
+
+        assert self._installer is not None
+        address = LibvirtWrapper().domain_address(self.name) or self.name
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
+        try:
+            client.connect(
+                hostname=address,
+                username="root",
+                key_filename=self._installer.ssh_key,
+                allow_agent=False,
+                look_for_keys=False,
+            )
+            _, stdout, stderr = client.exec_command(command)
+            if stdout.channel.recv_exit_status() != 0:
+                error = stderr.read().decode(errors="replace").strip()
+                raise InstallerError(
+                    f"Failed to seal template builder VM '{self.name}': {error}"
+                )
+        except (paramiko.SSHException, OSError) as ex:
+            raise InstallerError(
+                f"Failed to connect to template builder VM '{self.name}': {ex}"
+            )
+        finally:
+            client.close()
+
+    def seal(self, **metadata: Any) -> Template:
+        """
+        Seal the builder VM into a new version of the target OS template.
+
+        :param metadata: any other metadata to record with the template
+        :returns: Template object
+        """
+
+        if self._installer is None or self._installer.volume is None:
+            raise InstallerError(f"Template builder VM '{self.name}' not installed")
+
+        self._ssh_run(" && ".join(self.SEAL_COMMANDS))
+        LibvirtWrapper().shutdown(self.name)
+
+        # flatten the backing chain, so that the template doesn't depend on
+        # the vendor image which may get replaced by a newer one
+        templates = Templates()
+        tmp_path = Path(templates._get_cache_dir(), f".{self.name}.qcow2")
+        cmd = [
+            "qemu-img",
+            "convert",
+            "-O",
+            "qcow2",
+            self._installer.volume.path,
+            tmp_path.as_posix(),
+        ]
+        log.debug(f"Running {cmd}")
+        try:
+            subprocess.check_call(cmd)
+        except (subprocess.CalledProcessError, OSError) as ex:
+            tmp_path.unlink(missing_ok=True)
+            raise InstallerError(f"Failed to seal template of '{self.target}': {ex}")
+
+        return templates.add(self.target, tmp_path, **metadata)
+
+    def cleanup(self) -> None:
+        """
+        Remove the builder VM along with its volume.
+
+        Only a VM installed by this builder is removed, a builder VM which
+        already existed when install() refused to run is left alone.
+        """
+
+        if self._installer is None:
+            return
+
+        if self._exists():
+            LibvirtWrapper().remove(self.name)
+        if self._installer.volume is not None:
+            self._installer.volume.delete()
+            self._installer.volume = None
@@ -4,7 +4,15 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import ast
+import copy
+import hashlib
+import json
 import logging
+import os
+import re
+import shlex
+import yaml
 
 from pathlib import Path
 
@@ -13,7 +21,7 @@ from lcitool.packages import package_names_by_type
 from lcitool.config import Config
 from lcitool.projects import Projects
 from lcitool.targets import BuildTarget, Targets
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 log = logging.getLogger(__name__)
 
@@ -25,18 +33,387 @@ class InventoryError(LcitoolError):
         super().__init__(message, "Inventory")
 
 
+class StaticInventory:
+    """
+    In-process parser for static Ansible inventories.
+
+    Understands the YAML and INI inventory formats as well as dictionaries
+    following the YAML inventory structure (e.g. the libvirt inventory) and
+    resolves them into the same structure 'ansible-inventory --list' would
+    report. Sources this parser can't handle faithfully (executable dynamic
+    inventories, inventory plugin configurations, host ranges, group_vars or
+    host_vars directories, or anything it fails to parse) are rejected by
+    add_source() and need to go through ansible-inventory instead.
+    """
+
+    # the default of Ansible's INVENTORY_IGNORE_EXTS, applied to directory
+    # contents unless Ansible's own configuration can be read
+    IGNORED_EXTS = (
+        ".pyc",
+        ".pyo",
+        ".swp",
+        ".bak",
+        "~",
+        ".rpm",
+        ".md",
+        ".txt",
+        ".rst",
+        ".orig",
+        ".cfg",
+        ".retry",
+    )
+    _ignored_exts: Optional[Tuple[str, ...]] = None
+    YAML_EXTS = ["", ".yml", ".yaml", ".json"]
+
+    _INI_SECTION = re.compile(r"^\[([^:\]\s]+)(?::(\w+))?\]\s*(?:#.*)?$")
+    _INI_GROUPNAME = re.compile(r"^([^:\]\s]+)\s*(?:#.*)?$")
+
+    def __init__(self) -> None:
+        self._groups: Dict[str, Dict[str, Any]] = {}
+        self._hosts: Dict[str, Dict[str, Any]] = {}
+        self._add_group("all")
+        self._add_group("ungrouped")
+
+    def _add_group(self, name: str) -> Dict[str, Any]:
+        if name not in self._groups:
+            self._groups[name] = {"vars": {}, "hosts": [], "children": []}
+        return self._groups[name]
+
+    def _descendants(self, name: str) -> List[str]:
+        children = self._groups[name]["children"]
+        result = list(children)
+        for child in children:
+            result.extend(self._descendants(child))
+        return result
+
+    def _add_child(self, parent: str, child: str) -> bool:
+        self._add_group(parent)
+        self._add_group(child)
+
+        # ansible-inventory reports group cycles in its own way
+        if child == parent or parent in self._descendants(child):
+            return False
+
+        if child not in self._groups[parent]["children"]:
+            self._groups[parent]["children"].append(child)
+        return True
+
+    def _add_host(self, pattern: str, group: str, variables: Dict[str, Any]) -> bool:
+        # host ranges (e.g. 'host[01:10]') are left to ansible-inventory
+        if "[" in pattern:
+            return False
+
+        name, port = pattern, None
+        if pattern.count(":") == 1:
+            name, port = pattern.split(":")
+            if not port.isdigit():
+                return False
+
+        host_vars = self._hosts.setdefault(name, {})
+        if port is not None:
+            host_vars["ansible_port"] = int(port)
+        host_vars.update(variables)
+
+        hosts = self._add_group(group)["hosts"]
+        if name not in hosts:
+            hosts.append(name)
+        return True
+
+    @staticmethod
+    def _parse_value(value: str) -> Any:
+        # INI values are interpreted as Python literals where possible
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+    def _parse_yaml_group(self, name: str, data: Any) -> bool:
+        self._add_group(name)
+        if data is None:
+            return True
+        if not isinstance(data, dict):
+            return False
+
+        for key, value in data.items():
+            if value is None:
+                continue
+
+            if key == "vars" and isinstance(value, dict):
+                self._groups[name]["vars"].update(value)
+            elif key == "children" and isinstance(value, dict):
+                for child, child_data in value.items():
+                    if not self._parse_yaml_group(child, child_data):
+                        return False
+                    if not self._add_child(name, child):
+                        return False
+            elif key == "hosts" and isinstance(value, dict):
+                for host, host_vars in value.items():
+                    if host_vars is not None and not isinstance(host_vars, dict):
+                        return False
+                    if not self._add_host(str(host), name, host_vars or {}):
+                        return False
+            else:
+                return False
+
+        return True
+
+    def _parse_yaml(self, data: Dict[str, Any]) -> bool:
+        # inventory plugin configuration, e.g. 'plugin: constructed'
+        if "plugin" in data:
+            return False
+
+        for name, group_data in data.items():
+            if not self._parse_yaml_group(name, group_data):
+                return False
+        return True
+
+    def _parse_ini(self, lines: List[str]) -> bool:
+        group, state = "ungrouped", "hosts"
+        declared = set(self._groups)
+        pending = set()
+
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+
+            match = self._INI_SECTION.match(line)
+            if match:
+                group, state = match.group(1), match.group(2) or "hosts"
+                if state not in ["hosts", "children", "vars"]:
+                    return False
+                if state != "vars":
+                    declared.add(group)
+                self._add_group(group)
+                continue
+            elif line.startswith("["):
+                return False
+
+            if state == "hosts":
+                try:
+                    tokens = shlex.split(line, comments=True)
+                except ValueError:
+                    return False
+
+                variables = {}
+                for token in tokens[1:]:
+                    if "=" not in token:
+                        return False
+                    key, value = token.split("=", 1)
+                    variables[key] = self._parse_value(value)
+
+                if not self._add_host(tokens[0], group, variables):
+                    return False
+            elif state == "vars":
+                if "=" not in line:
+                    return False
+                key, value = [e.strip() for e in line.split("=", 1)]
+                self._groups[group]["vars"][key] = self._parse_value(value)
+            else:
+                match = self._INI_GROUPNAME.match(line)
+                if not match:
+                    return False
+                pending.add(match.group(1))
+                if not self._add_child(group, match.group(1)):
+                    return False
+
+        # references to undeclared groups are errors ansible-inventory
+        # should report
+        return not (pending - declared)
+
+    def _add_file(self, path: Path) -> bool:
+        if os.access(path, os.X_OK):
+            log.debug(f"Inventory source '{path}' is an executable")
+            return False
+
+        try:
+            content = path.read_text()
+        except (OSError, UnicodeError):
+            return False
+
+        if path.suffix in self.YAML_EXTS:
+            try:
+                data = yaml.safe_load(content)
+            except yaml.YAMLError:
+                data = None
+
+            if isinstance(data, dict):
+                return self._parse_yaml(data)
+
+        return self._parse_ini(content.splitlines())
+
+    @classmethod
+    def _get_ignored_exts(cls) -> Tuple[str, ...]:
+        # importing the constants reads the Ansible config, which may set
+        # INVENTORY_IGNORE_EXTS to something else than the default
+        if cls._ignored_exts is None:
+            try:
+                from ansible import constants  # type: ignore
+
+                cls._ignored_exts = tuple(constants.INVENTORY_IGNORE_EXTS)
+            except ImportError:
+                cls._ignored_exts = cls.IGNORED_EXTS
+        return cls._ignored_exts
+
+    def _add_dir(self, path: Path) -> bool:
+        ignored_exts = self._get_ignored_exts()
+        for entry in sorted(path.iterdir()):
+            if entry.name.startswith(".") or entry.name.endswith(ignored_exts):
+                continue
+
+            # variable files are only picked up by ansible's vars plugins
+            if entry.name in ["group_vars", "host_vars", "vars_plugins"]:
+                return False
+
+            if entry.is_dir():
+                ret = self._add_dir(entry)
+            else:
+                ret = self._add_file(entry)
+            if not ret:
+                return False
+        return True
+
+    def add_source(self, source: Union[Path, Dict[str, Any]]) -> bool:
+        """
+        Add an inventory source.
+
+        :param source: path to an inventory file or directory, or a
+                       dictionary following the YAML inventory structure
+        :returns: False if the source can't be parsed in-process, in which
+                  case the object must not be used any further
+        """
+
+        if isinstance(source, dict):
+            return self._parse_yaml(source)
+        if source.is_dir():
+            return self._add_dir(source)
+        return self._add_file(source)
+
+    def _depths(self) -> Dict[str, int]:
+        depths = {name: 0 for name in self._groups}
+
+        def _rec(name: str, depth: int) -> None:
+            for child in self._groups[name]["children"]:
+                if depths[child] < depth + 1:
+                    depths[child] = depth + 1
+                    _rec(child, depth + 1)
+
+        _rec("all", 0)
+        return depths
+
+    def _host_vars(
+        self,
+        host: str,
+        host_groups: Dict[str, List[str]],
+        depths: Dict[str, int],
+        group_vars: Dict[str, Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        groups = set(host_groups[host])
+        for group in host_groups[host]:
+            groups.update(g for g in self._groups if group in self._descendants(g))
+
+        ordered = sorted(groups, key=lambda g: (depths[g], g))
+
+        # same precedence as ansible: inventory group vars, group_vars files,
+        # inventory host vars
+        variables: Dict[str, Any] = {}
+        for group in ordered:
+            variables.update(self._groups[group]["vars"])
+        for group in ordered:
+            variables.update(group_vars.get(group, {}))
+        variables.update(self._hosts[host])
+        return copy.deepcopy(variables)
+
+    def resolve(
+        self, group_vars: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Resolve the inventory.
+
+        :param group_vars: per-group variables as they would be provided in
+                           a group_vars directory
+        :returns: the inventory in the 'ansible-inventory --list' structure
+                  with all the variables of each host resolved
+        """
+
+        if group_vars is None:
+            group_vars = {}
+
+        # top level groups are children of 'all' and hosts which don't
+        # belong to any group are 'ungrouped'
+        for name in list(self._groups):
+            if name == "all":
+                continue
+            if not any(name in g["children"] for g in self._groups.values()):
+                self._add_child("all", name)
+
+        host_groups: Dict[str, List[str]] = {host: [] for host in self._hosts}
+        for name, group in self._groups.items():
+            for host in group["hosts"]:
+                host_groups[host].append(name)
+        for host, groups in host_groups.items():
+            if groups == ["all"]:
+                self._add_host(host, "ungrouped", {})
+                groups.append("ungrouped")
+        self._groups["all"]["hosts"] = []
+
+        depths = self._depths()
+        resolved = {
+            host: self._host_vars(host, host_groups, depths, group_vars)
+            for host in self._hosts
+        }
+
+        def _dump(name: str) -> Dict[str, Any]:
+            group = self._groups[name]
+            data: Dict[str, Any] = {}
+            if group["hosts"]:
+                data["hosts"] = {h: resolved[h] for h in group["hosts"]}
+            if group["children"]:
+                data["children"] = {c: _dump(c) for c in group["children"]}
+            return data
+
+        return {"all": _dump("all")}
+
+
 class Inventory:
 
+    # resolved inventories keyed by the inventory path
+    CACHE_FILE = "inventory.json"
+
     def __init__(
         self,
         targets: Targets,
         config: Config,
         inventory_path: Optional[Path] = None,
+        refresh: bool = False,
+        ansible_runner: Any = None,
     ):
+        """
+        :param targets: Targets object
+        :param config: Config object
+        :param inventory_path: path to the inventory to use instead of the
+                               default sources (libvirt and the inventory in
+                               the lcitool config dir)
+        :param refresh: ignore the cached resolved inventory
+        :param ansible_runner: AnsibleWrapper object whose environment to
+                               query the inventory in if it needs
+                               ansible-inventory, so that it can be shared
+                               with the playbook execution
+        """
+
         self._targets = targets
         self._config = config
         self._host_facts: Optional[Dict[str, Dict[str, Any]]] = None
         self._ansible_inventory: Optional[Dict[str, Dict[str, Any]]] = None
+        self._refresh = refresh
+        self._libvirt: Any = None
+        self._ansible_runner = ansible_runner
+
+        # we only call into libvirt when we need to use default inventory
+        # sources, i.e. user didn't provide one via datadir
+        self._use_libvirt = inventory_path is None
+        if inventory_path is None:
+            inventory_path = Path(util.get_config_dir(), "inventory")
         self._inventory_path = inventory_path
 
     @property
@@ -47,7 +424,7 @@ class Inventory:
         Dict[str, Any],
     ]:
         if self._ansible_inventory is None:
-            self._ansible_inventory = self._get_ansible_inventory()
+            self._ansible_inventory = self._get_cached_ansible_inventory()
         assert isinstance(self._ansible_inventory, dict)
         return self._ansible_inventory
 
@@ -62,17 +439,81 @@ class Inventory:
     def hosts(self) -> List[str]:
         return list(self.host_facts.keys())
 
+    def _libvirt_wrapper(self) -> Any:
+        from lcitool.libvirt_wrapper import LibvirtWrapper
+
+        if self._libvirt is None:
+            self._libvirt = LibvirtWrapper()
+        return self._libvirt
+
+    def _fingerprint(self) -> Optional[str]:
+        """
+        Compute a fingerprint of everything the resolved inventory depends on.
+
+        :returns: a hex digest or None if the inventory can't be cached
+        """
+
+        files = []
+        if self._inventory_path.exists():
+            paths = [self._inventory_path]
+            if self._inventory_path.is_dir():
+                paths.extend(sorted(self._inventory_path.rglob("*")))
+
+            for path in paths:
+                # the output of dynamic inventories can change at any time
+                if path.is_file() and os.access(path, os.X_OK):
+                    return None
+
+                st = path.stat()
+                files.append([path.as_posix(), st.st_mtime_ns, st.st_size])
+
+        data: Dict[str, Any] = {
+            "files": files,
+            "target_facts": self._targets.target_facts,
+        }
+
+        if self._use_libvirt:
+            libvirt = self._libvirt_wrapper()
+            data["libvirt"] = {
+                "domains": libvirt.domains,
+                "metadata_generation": libvirt.metadata_generation,
+            }
+
+        serialized = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _get_cached_ansible_inventory(self) -> Any:
+        key = self._inventory_path.as_posix()
+        fingerprint = self._fingerprint()
+        if fingerprint is None:
+            log.debug(f"Inventory '{key}' is dynamic, not using the cache")
+            return self._get_ansible_inventory()
+
+        cache = util.load_cache_file(self.CACHE_FILE)
+        if not isinstance(cache, dict):
+            cache = {}
+
+        entry = cache.get(key)
+        if self._refresh:
+            log.debug(f"Inventory cache for '{key}': refresh requested")
+        elif isinstance(entry, dict) and entry.get("fingerprint") == fingerprint:
+            log.debug(f"Inventory cache for '{key}': hit")
+            return entry["inventory"]
+        else:
+            log.debug(f"Inventory cache for '{key}': miss")
+
+        inventory = self._get_ansible_inventory()
+        cache[key] = {"fingerprint": fingerprint, "inventory": inventory}
+        util.dump_cache_file(self.CACHE_FILE, cache)
+        return inventory
+
     def _get_ansible_inventory(
         self,
     ) -> Any:
         from lcitool.ansible_wrapper import AnsibleWrapper, AnsibleWrapperError
 
         inventory_sources: List[Union[Path, Dict[str, Any]]] = []
-        if self._inventory_path is None:
-            self._inventory_path = Path(util.get_config_dir(), "inventory")
-
-            # we only call into libvirt when we need to use default inventory
-            # sources, i.e. user didn't provide one via datadir
+        if self._use_libvirt:
             log.debug("Querying libvirt for lcitool hosts")
             inventory_sources.append(self._get_libvirt_inventory())
 
@@ -80,27 +521,43 @@ class Inventory:
             log.debug(f"Adding '{self._inventory_path}' to Ansible inventory sources")
             inventory_sources.append(self._inventory_path)
 
-        ansible_runner = AnsibleWrapper()
-        ansible_runner.prepare_env(
-            inventories=inventory_sources, group_vars=self._targets.target_facts
-        )
+        static_inventory = StaticInventory()
+        for source in inventory_sources:
+            if not static_inventory.add_source(source):
+                log.debug(f"Can't parse '{source}' as a static inventory")
+                break
+        else:
+            log.debug("Resolved static Ansible inventory in-process")
+            return static_inventory.resolve(self._targets.target_facts)
+
+        ansible_runner = self._ansible_runner
+        if ansible_runner is None:
+            ansible_runner = AnsibleWrapper()
+        ansible_runner.prepare_env(inventories=inventory_sources)
 
         log.debug(f"Running ansible-inventory on '{inventory_sources}'")
         try:
-            inventory = ansible_runner.get_inventory()
+            inventory = ansible_runner.get_inventory(export=True)
         except AnsibleWrapperError as ex:
             log.debug("Failed to load Ansible inventory")
             raise InventoryError(f"Failed to load Ansible inventory: {ex}")
 
-        return inventory
+        # the exported inventory keeps the inventory group vars apart from the
+        # host vars, so the target OS facts can be merged in-process with the
+        # same precedence as with static inventories, rather than dumping
+        # group_vars of every single target OS only to find out which hosts
+        # there are
+        exported_inventory = StaticInventory()
+        if not exported_inventory.add_source(inventory or {}):
+            raise InventoryError("Failed to parse the Ansible inventory")
+        return exported_inventory.resolve(self._targets.target_facts)
 
     def _get_libvirt_inventory(self) -> Dict[str, Any]:
-        from lcitool.libvirt_wrapper import LibvirtWrapper
-
         inventory: Dict[str, Any] = {"all": {"children": {}}}
         children = inventory["all"]["children"]
 
-        for host, target in LibvirtWrapper().hosts.items():
+        libvirt = self._libvirt_wrapper()
+        for host, target in libvirt.get_hosts(refresh=self._refresh).items():
             inventory_target = children.setdefault(target, {})
             inventory_hosts = inventory_target.setdefault("hosts", {})
             inventory_hosts.setdefault(host, {})
@@ -184,6 +641,33 @@ class Inventory:
         assert isinstance(target, str)
         return target
 
+    def get_ansible_inventory_subset(self, hosts: List[str]) -> Dict[str, Any]:
+        """
+        Build an inventory of just the given hosts.
+
+        The hosts are placed in their target OS groups and only their vars
+        which differ from the target OS facts are kept, the facts are
+        expected to be provided as group_vars.
+
+        :param hosts: list of host names
+        :returns: a dictionary corresponding to the Ansible YAML format
+        """
+
+        children: Dict[str, Any] = {}
+        for host in hosts:
+            target = self.get_host_target_name(host)
+            target_facts = self._targets.target_facts[target]
+
+            host_vars = {
+                key: value
+                for key, value in self.host_facts[host].items()
+                if key not in target_facts or target_facts[key] != value
+            }
+            group = children.setdefault(target, {"hosts": {}})
+            group["hosts"][host] = host_vars
+
+        return {"all": {"children": children}}
+
     def get_group_vars(
         self, target: BuildTarget, projects: Projects, projects_expanded: List[str]
     ) -> Dict[str, Union[Dict[str, str], str, List[str]]]:
@@ -8,14 +8,15 @@ import abc
 import libvirt
 import logging
 import textwrap
+import threading
 
 import xml.etree.ElementTree as ET
 
 from pathlib import Path
 from libvirt import virConnect, virStoragePool, virStorageVol
 
-from lcitool import LcitoolError
-from typing import Any, Dict, Optional, List
+from lcitool import util, LcitoolError
+from typing import Any, Dict, Optional, List, Set
 
 log = logging.getLogger(__name__)
 
@@ -34,53 +35,237 @@ class LibvirtWrapperError(LcitoolError):
         super().__init__(message, "LibvirtWrapper")
 
 
+# libvirt connections shared by all LibvirtWrapper instances, keyed by URI
+_connections: Dict[Optional[str], virConnect] = {}
+_connections_lock = threading.Lock()
+
+
+def _get_connection(uri: Optional[str]) -> virConnect:
+    with _connections_lock:
+        if uri not in _connections:
+
+            def nop_error_handler(_T: Any, iterable: List[Any]) -> None:
+                return None
+
+            # Disable libvirt's default console error logging
+            libvirt.registerErrorHandler(nop_error_handler, None)
+
+            log.debug(f"Opening libvirt connection to '{uri or 'default'}'")
+            try:
+                _connections[uri] = libvirt.open(uri)
+            except libvirt.libvirtError as e:
+                raise LibvirtWrapperError(f"Failed to connect to libvirt: {e}")
+        return _connections[uri]
+
+
 class LibvirtWrapper:
-    def __init__(self) -> None:
-        def nop_error_handler(_T: Any, iterable: List[Any]) -> None:
-            return None
 
-        # Disable libvirt's default console error logging
-        libvirt.registerErrorHandler(nop_error_handler, None)
-        self._conn: virConnect = libvirt.open()
+    # lcitool bumps this counter in the cache dir whenever it changes the
+    # lcitool metadata of a domain, so that consumers caching data derived
+    # from the metadata don't need to query it for every single domain
+    METADATA_GENERATION_FILE = "libvirt-metadata.json"
+
+    # domain UUID -> name, persistence and lcitool target (or None) of the
+    # domains scanned during previous runs, valid for as long as the
+    # generation matches; a domain redefined under another name or with a
+    # different persistence is scanned again, but the metadata changed by
+    # other means than lcitool (e.g. 'virsh metadata') can't be noticed
+    HOSTS_CACHE_FILE = "libvirt-hosts.json"
+
+    def __init__(self, uri: Optional[str] = None) -> None:
+        """
+        :param uri: libvirt connection URI (libvirt's default if None), the
+                    connection is opened lazily and shared by all the
+                    instances using the same URI
+        """
+
+        self._uri = uri
 
     @property
-    def hosts(self) -> Dict[str, str]:
-        """Return all lcitool hosts."""
+    def _conn(self) -> virConnect:
+        return _get_connection(self._uri)
+
+    @property
+    def domains(self) -> List[List[str]]:
+        """Return the names and UUIDs of all domains."""
 
-        hosts = {}
         try:
             doms = self._conn.listAllDomains()
         except libvirt.libvirtError as e:
-            raise LibvirtWrapperError("Failed to load libvirt domains: " + e)
+            raise LibvirtWrapperError("Failed to load libvirt domains: " + str(e))
 
-        for dom in doms:
-            try:
-                domain_metadata_flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
-                if not dom.isPersistent():
-                    domain_metadata_flags = libvirt.VIR_DOMAIN_AFFECT_LIVE
-                xml = dom.metadata(
-                    libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-                    LCITOOL_XMLNS,
-                    domain_metadata_flags,
-                )
-            except libvirt.libvirtError as e:
-                if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
-                    # skip hosts which don't have lcitool's metadata
-                    continue
+        return sorted([dom.name(), dom.UUIDString()] for dom in doms)
 
-                raise LibvirtWrapperError(
-                    f"Failed to query metadata for '{dom.name()}': " + str(e)
-                )
+    @property
+    def metadata_generation(self) -> int:
+        data = util.load_cache_file(self.METADATA_GENERATION_FILE)
+        if not isinstance(data, dict):
+            return 0
+        return int(data.get("generation", 0))
+
+    def _bump_metadata_generation(self) -> int:
+        generation = self.metadata_generation + 1
+        util.dump_cache_file(
+            self.METADATA_GENERATION_FILE,
+            {"generation": generation},
+        )
+        return generation
+
+    def _load_hosts_cache(self) -> Dict[str, Dict[str, Any]]:
+        data = util.load_cache_file(self.HOSTS_CACHE_FILE)
+        if not isinstance(data, dict):
+            return {}
+
+        entry = data.get(self._uri or "")
+        if (
+            not isinstance(entry, dict)
+            or entry.get("generation") != self.metadata_generation
+            or not isinstance(entry.get("domains"), dict)
+        ):
+            return {}
+
+        domains: Dict[str, Dict[str, Any]] = entry["domains"]
+        return domains
+
+    def _store_hosts_cache(
+        self, domains: Dict[str, Dict[str, Any]], generation: int
+    ) -> None:
+        data = util.load_cache_file(self.HOSTS_CACHE_FILE)
+        if not isinstance(data, dict):
+            data = {}
+
+        data[self._uri or ""] = {"generation": generation, "domains": domains}
+        util.dump_cache_file(self.HOSTS_CACHE_FILE, data)
+
+    def _list_domains(self, flags: int) -> List[Any]:
+        try:
+            return list(self._conn.listAllDomains(flags))
+        except libvirt.libvirtError as e:
+            raise LibvirtWrapperError("Failed to load libvirt domains: " + str(e))
 
-            xmltree = ET.fromstring(xml)
-            target = xmltree.find("target")
-            if xmltree.tag != "host" or target is None or target.text is None:
-                continue
+    def _query_target(self, dom: Any, persistent: bool) -> Optional[str]:
+        domain_metadata_flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if not persistent:
+            domain_metadata_flags = libvirt.VIR_DOMAIN_AFFECT_LIVE
 
-            hosts[dom.name()] = target.text
+        try:
+            xml = dom.metadata(
+                libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                LCITOOL_XMLNS,
+                domain_metadata_flags,
+            )
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+                # skip hosts which don't have lcitool's metadata
+                return None
+
+            raise LibvirtWrapperError(
+                f"Failed to query metadata for '{dom.name()}': " + str(e)
+            )
+
+        xmltree = ET.fromstring(xml)
+        target = xmltree.find("target")
+        if xmltree.tag != "host" or target is None or target.text is None:
+            return None
+
+        return target.text
+
+    def get_hosts(self, refresh: bool = False) -> Dict[str, str]:
+        """
+        Return all lcitool hosts.
+
+        Libvirt has no API to fetch the metadata of many domains at once, so
+        the lcitool target of every domain scanned once is remembered in the
+        lcitool cache dir and only new domains (i.e. unknown UUIDs, or known
+        UUIDs with another name or persistence) need to be queried later.
+        The persistence of the domains (which determines where the metadata
+        is looked up) is learned from two bulk listings rather than
+        per-domain queries.
+
+        :param refresh: query the metadata of all the domains again
+        :returns: a host name -> target OS name dictionary
+        """
+
+        generation = self.metadata_generation
+        cached = {} if refresh else self._load_hosts_cache()
+
+        domains = [
+            (dom, True)
+            for dom in self._list_domains(libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT)
+        ]
+        domains.extend(
+            (dom, False)
+            for dom in self._list_domains(libvirt.VIR_CONNECT_LIST_DOMAINS_TRANSIENT)
+        )
 
+        hosts = {}
+        scanned: Dict[str, Dict[str, Any]] = {}
+        queries = 0
+        for dom, persistent in domains:
+            uuid = dom.UUIDString()
+            entry = cached.get(uuid)
+            if (
+                not isinstance(entry, dict)
+                or entry.get("name") != dom.name()
+                or entry.get("persistent") != persistent
+            ):
+                entry = {
+                    "name": dom.name(),
+                    "persistent": persistent,
+                    "target": self._query_target(dom, persistent),
+                }
+                queries += 1
+
+            scanned[uuid] = entry
+            if entry["target"] is not None:
+                hosts[dom.name()] = entry["target"]
+
+        log.debug(
+            f"Scanned {len(domains)} libvirt domains, {queries} metadata queries"
+        )
+        if scanned != cached:
+            self._store_hosts_cache(scanned, generation)
         return hosts
 
+    @property
+    def hosts(self) -> Dict[str, str]:
+        """Return all lcitool hosts."""
+
+        return self.get_hosts()
+
+    def domain_address(self, name: str) -> Optional[str]:
+        """
+        Look up the IPv4 address of a domain.
+
+        The DHCP leases of libvirt managed networks are consulted first,
+        followed by the QEMU guest agent (if running in the guest).
+
+        :param name: name of the domain
+        :returns: the address or None if it isn't known (yet)
+        """
+
+        try:
+            dom = self._conn.lookupByName(name)
+        except libvirt.libvirtError:
+            return None
+
+        for source in [
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE,
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT,
+        ]:
+            try:
+                interfaces = dom.interfaceAddresses(source)
+            except libvirt.libvirtError:
+                # e.g. there's no guest agent
+                continue
+
+            for interface in interfaces.values():
+                for addr in interface.get("addrs") or []:
+                    if addr.get("type") == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                        return str(addr["addr"])
+
+        return None
+
     def set_target(self, host: str, target: str) -> None:
         """Inject target OS to host's XML metadata."""
 
@@ -104,8 +289,85 @@ class LibvirtWrapper:
                 ),
             )
         except libvirt.libvirtError as e:
+            self._bump_metadata_generation()
             raise LibvirtWrapperError(f"Failed to set metadata for '{host}': " + str(e))
 
+        # keep the scanned metadata valid, only this domain changed
+        domains = self._load_hosts_cache()
+        entry = domains.get(dom.UUIDString())
+        if isinstance(entry, dict):
+            entry["target"] = target
+        self._store_hosts_cache(domains, self._bump_metadata_generation())
+
+    def shutdown(self, name: str, timeout: int = 300) -> None:
+        """
+        Gracefully shut a domain down and wait for it to stop.
+
+        :param name: name of the domain
+        :param timeout: number of seconds to wait before forcing the domain off
+        """
+
+        import time
+
+        try:
+            dom = self._conn.lookupByName(name)
+            if not dom.isActive():
+                return
+
+            log.debug(f"Shutting down domain '{name}'")
+            dom.shutdown()
+            deadline = time.monotonic() + timeout
+            while dom.isActive():
+                if time.monotonic() > deadline:
+                    log.warning(f"Domain '{name}' didn't shut down in time, forcing off")
+                    dom.destroy()
+                    break
+                time.sleep(1)
+        except libvirt.libvirtError as e:
+            raise LibvirtWrapperError(f"Failed to shut down '{name}': " + str(e))
+
+    def remove(self, name: str) -> None:
+        """Stop and undefine a domain (its storage is left untouched)."""
+
+        try:
+            dom = self._conn.lookupByName(name)
+            if dom.isActive():
+                dom.destroy()
+            if dom.isPersistent():
+                dom.undefine()
+        except libvirt.libvirtError as e:
+            raise LibvirtWrapperError(f"Failed to remove '{name}': " + str(e))
+
+    def backing_stores(self) -> Set[Path]:
+        """
+        Return the paths of all images used as backing stores.
+
+        Both the volumes in all active storage pools and the disks of all
+        domains are considered.
+        """
+
+        paths = set()
+        try:
+            for pool in self._conn.listAllStoragePools():
+                if not pool.isActive():
+                    continue
+
+                for vol in pool.listAllVolumes():
+                    root = ET.fromstring(vol.XMLDesc())
+                    for node in root.findall("backingStore/path"):
+                        if node.text:
+                            paths.add(Path(node.text))
+
+            for dom in self._conn.listAllDomains():
+                root = ET.fromstring(dom.XMLDesc())
+                for node in root.findall("devices/disk//backingStore/source"):
+                    if node.get("file"):
+                        paths.add(Path(node.attrib["file"]))
+        except libvirt.libvirtError as e:
+            raise LibvirtWrapperError("Failed to query backing stores: " + str(e))
+
+        return paths
+
     def pool_by_name(self, name: str) -> "LibvirtStoragePoolObject":
         try:
             poolobj = self._conn.storagePoolLookupByName(name)
@@ -146,6 +408,12 @@ class LibvirtAbstractObject(abc.ABC):
 
 
 class LibvirtStoragePoolObject(LibvirtAbstractObject):
+
+    # Formats of the backing stores probed so far, keyed by path and
+    # validated by the mtime of the backing store
+    BACKING_FORMATS_CACHE_FILE = "libvirt-backing-formats.json"
+    _backing_formats_lock = threading.Lock()
+
     def __init__(self, conn: virConnect, obj: virStoragePool) -> None:
         super().__init__(conn, obj)
         self.name = obj.name()
@@ -195,10 +463,81 @@ class LibvirtStoragePoolObject(LibvirtAbstractObject):
         conn.storagePoolCreateXML(pool_xml)
         return conn.storagePoolLookupByName(name)
 
-    def _create_from_xml(self, name: str, xmlstr: str) -> "LibvirtStorageVolObject":
-        self.raw.createXML(xmlstr)
+    def _create_from_xml(
+        self, name: str, xmlstr: str, flags: int = 0
+    ) -> "LibvirtStorageVolObject":
+        self.raw.createXML(xmlstr, flags)
         return LibvirtStorageVolObject(self, self.raw.storageVolLookupByName(name))
 
+    @classmethod
+    def _cached_backing_format(cls, path: Path) -> Optional[str]:
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+        data = util.load_cache_file(cls.BACKING_FORMATS_CACHE_FILE)
+        if not isinstance(data, dict):
+            return None
+
+        entry = data.get(path.as_posix())
+        if not isinstance(entry, dict) or entry.get("mtime") != mtime:
+            return None
+        return entry.get("format")
+
+    @classmethod
+    def _cache_backing_format(cls, path: Path, format_: str) -> None:
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            return
+
+        with cls._backing_formats_lock:
+            data = util.load_cache_file(cls.BACKING_FORMATS_CACHE_FILE)
+            if not isinstance(data, dict):
+                data = {}
+
+            # forget the images which are gone, e.g. evicted from the cache
+            data = {p: e for p, e in data.items() if Path(p).exists()}
+            data[path.as_posix()] = {"mtime": mtime, "format": format_}
+            util.dump_cache_file(cls.BACKING_FORMATS_CACHE_FILE, data)
+
+    def _backing_store_format(self, backing_store: Path) -> str:
+        format_ = self._cached_backing_format(backing_store)
+        if format_ is not None:
+            return format_
+
+        backing_store_path_str = backing_store.as_posix()
+        volobj = self._volume_by_path(backing_store_path_str)
+        if volobj and volobj.format:
+            format_ = volobj.format
+        else:
+            import uuid
+
+            # We could not locate the backing store in any storage pool.
+            # In order to fill in the backingStore volume data correctly we
+            # need to create a transient pool of type dir which contains
+            # the backingStore file storage volume to let libvirt fetch the
+            # information for us. We'll destroy the pool afterwards.
+
+            pool_dir = backing_store.parent.as_posix()
+            pool_name = "lcitool_" + str(uuid.uuid1())
+            poolobj = self._create_transient_pool(self._conn, pool_name, pool_dir)
+            try:
+                volobj = self._volume_by_path(backing_store_path_str)
+            finally:
+                poolobj.destroy()
+
+            if volobj and volobj.format:
+                format_ = volobj.format
+            else:
+                raise LibvirtWrapperError(
+                    f"Could not determine format of backing store '{backing_store}'"
+                )
+
+        self._cache_backing_format(backing_store, format_)
+        return format_
+
     def create_volume(
         self,
         name: str,
@@ -210,7 +549,21 @@ class LibvirtStoragePoolObject(LibvirtAbstractObject):
         group: Optional[str] = None,
         mode: Optional[str] = None,
         backing_store: Optional[Path] = None,
+        preallocation: Optional[str] = None,
+        cluster_size: Optional[int] = None,
+        features: Optional[List[str]] = None,
     ) -> "LibvirtStorageVolObject":
+        """
+        Create a new storage volume in the pool.
+
+        :param preallocation: 'metadata' to preallocate the qcow2 metadata,
+                              'full' to also reserve the space of the whole
+                              volume upfront (qemu-img 'preallocation=falloc');
+                              not supported with a backing store
+        :param cluster_size: qcow2 cluster size in KiB
+        :param features: qcow2 features to enable, e.g. 'lazy_refcounts' or
+                         'extended_l2'
+        """
 
         import re
 
@@ -233,14 +586,46 @@ class LibvirtStoragePoolObject(LibvirtAbstractObject):
 
         root_el = ET.fromstring(volume_xml)
 
+        # libvirt refuses to preallocate a volume on top of a backing store
+        if preallocation is not None and backing_store:
+            raise ValueError(
+                "'create_volume().preallocation' can't be combined with "
+                "'create_volume().backing_store'"
+            )
+
+        flags = 0
+        if preallocation == "metadata":
+            flags |= libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+        elif preallocation == "full":
+            # with the flag, libvirt asks qemu-img for 'preallocation=falloc'
+            # rather than 'metadata' when the allocation matches the capacity
+            flags |= libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+            allocation = str(capacity)
+        elif preallocation is not None:
+            raise ValueError(
+                f"Invalid value '{preallocation}' passed to "
+                "'create_volume().preallocation'"
+            )
+
         if allocation:
-            allocation_el = ET.SubElement(root_el, "allocation")
+            allocation_el = ET.SubElement(root_el, "allocation", {"unit": units})
             allocation_el.text = allocation
 
         if _format:
             target_el = ET.SubElement(root_el, "target")
             ET.SubElement(target_el, "format", {"type": _format})
 
+            if cluster_size:
+                cluster_size_el = ET.SubElement(
+                    target_el, "clusterSize", {"unit": "KiB"}
+                )
+                cluster_size_el.text = str(cluster_size)
+
+            if features:
+                features_el = ET.SubElement(target_el, "features")
+                for feature in features:
+                    ET.SubElement(features_el, feature)
+
         if any([owner, group, mode]):
             target_el = ET.SubElement(root_el, "target")
             perms_el = ET.SubElement(target_el, "permissions")
@@ -255,35 +640,10 @@ class LibvirtStoragePoolObject(LibvirtAbstractObject):
             path_el = ET.SubElement(backingStore_el, "path")
             format_el = ET.SubElement(backingStore_el, "format")
             path_el.text = backing_store_path_str
-
-            volobj = self._volume_by_path(backing_store_path_str)
-            if volobj and volobj.format:
-                format_ = volobj.format
-            else:
-                import uuid
-
-                # We could not locate the backing store in any storage pool.
-                # In order to fill in the backingStore volume data correctly we
-                # need to create a transient pool of type dir which contains
-                # the backingStore file storage volume to let libvirt fetch the
-                # information for us. We'll destroy the pool afterwards.
-
-                pool_dir = backing_store.parent.as_posix()
-                pool_name = "lcitool_" + str(uuid.uuid1())
-                poolobj = self._create_transient_pool(self._conn, pool_name, pool_dir)
-                volobj = self._volume_by_path(backing_store_path_str)
-                if volobj and volobj.format:
-                    format_ = volobj.format
-                else:
-                    raise LibvirtWrapperError(
-                        f"Could not determine format of backing store '{backing_store}'"
-                    )
-                poolobj.destroy()
-
-            format_el.attrib["type"] = format_
+            format_el.attrib["type"] = self._backing_store_format(backing_store)
 
         volume_xml_str = ET.tostring(root_el, encoding="UTF-8", method="xml")
-        return self._create_from_xml(name, volume_xml_str.decode("UTF-8"))
+        return self._create_from_xml(name, volume_xml_str.decode("UTF-8"), flags)
 
 
 class LibvirtStorageVolObject(LibvirtAbstractObject):
@@ -301,3 +661,11 @@ class LibvirtStorageVolObject(LibvirtAbstractObject):
             if format_node is not None:
                 self._format = format_node.attrib["type"]
         return self._format
+
+    def delete(self) -> None:
+        try:
+            self.raw.delete()
+        except libvirt.libvirtError as e:
+            raise LibvirtWrapperError(
+                f"Failed to delete volume '{self.name}': " + str(e)
+            )
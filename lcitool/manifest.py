@@ -4,6 +4,8 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import hashlib
+import json
 import logging
 import yaml
 from pathlib import Path
@@ -18,7 +20,7 @@ from lcitool.targets import Targets, BuildTarget
 from io import TextIOWrapper
 from lcitool.packages import Packages
 from lcitool.projects import Projects
-from typing import Any, Callable, Dict, List, Union, Optional
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple, Union, Optional
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +34,14 @@ class ManifestError(LcitoolError):
 
 class Manifest:
 
+    # variables which identify the entries of the parallel:matrix jobs
+    CONTAINER_MATRIX_KEYS = ["NAME"]
+    BUILD_MATRIX_KEYS = ["NAME", "CROSS", "TARGET_BASE_IMAGE"]
+    CIRRUS_MATRIX_KEYS = ["NAME"]
+
+    # number of hex digits of the content-addressed container image tags
+    CONTAINER_TAG_LENGTH = 16
+
     def __init__(
         self,
         targets: Targets,
@@ -53,6 +63,7 @@ class Manifest:
             self.basedir = Path()
         else:
             self.basedir = basedir
+        self._container_tags: Dict[Tuple[str, Optional[str]], str] = {}
 
     # Fully expand any shorthand / syntax sugar in the config
     # so that later stages have a consistent view of the
@@ -83,6 +94,9 @@ class Manifest:
         gitlabinfo.setdefault("enabled", True)
         gitlabinfo.setdefault("containers", True)
         gitlabinfo.setdefault("builds", True)
+        gitlabinfo.setdefault("parallel-matrix", False)
+        gitlabinfo.setdefault("container-cache", False)
+        gitlabinfo.setdefault("content-tags", False)
 
         if gitlabinfo["enabled"]:
             if "namespace" not in gitlabinfo:
@@ -329,7 +343,13 @@ class Manifest:
         includes = []
         if gitlabinfo["containers"]:
             path = Path(gitlabdir, "container-templates.yml")
-            content = [gitlab.container_template(self.cidir)]
+            content = [
+                gitlab.container_template(
+                    self.cidir,
+                    gitlabinfo["container-cache"],
+                    gitlabinfo["content-tags"],
+                )
+            ]
             self._replace_file(content, path, dryrun)
             if len(content) > 0:
                 includes.append(path)
@@ -337,9 +357,17 @@ class Manifest:
         path = Path(gitlabdir, "build-templates.yml")
         content = []
         if have_native:
-            content.append(gitlab.native_build_template(project, self.cidir))
+            content.append(
+                gitlab.native_build_template(
+                    project, self.cidir, gitlabinfo["content-tags"]
+                )
+            )
         if have_cross:
-            content.append(gitlab.cross_build_template(project, self.cidir))
+            content.append(
+                gitlab.cross_build_template(
+                    project, self.cidir, gitlabinfo["content-tags"]
+                )
+            )
         if gitlabinfo["cirrus"]:
             content.append(gitlab.cirrus_template(self.cidir))
         self._replace_file(content, path, dryrun)
@@ -399,8 +427,9 @@ class Manifest:
         ]
         self._replace_file(content, path, dryrun)
 
-    def _generate_gitlab_container_jobs(self, cross: bool) -> List[str]:
-        jobs = []
+    def _gitlab_container_jobs(
+        self, cross: bool
+    ) -> Iterator[Tuple[str, str, bool, bool]]:
         for target, targetinfo in self.values["targets"].items():
             if not targetinfo["enabled"]:
                 continue
@@ -433,15 +462,130 @@ class Manifest:
                     if thatjobinfo["builds"]:
                         optional = False
 
-                if cross:
-                    containerbuildjob = gitlab.cross_container_job(
-                        target, arch, allow_failure, optional
-                    )
-                else:
-                    containerbuildjob = gitlab.native_container_job(
-                        target, allow_failure, optional
+                yield target, arch, allow_failure, optional
+
+    def _gitlab_container_matrix(
+        self, cross: bool
+    ) -> List[Tuple[str, bool, List[Tuple[str, str, Dict[str, str]]]]]:
+        """
+        Group the container jobs into parallel:matrix jobs.
+
+        The jobs are grouped by whether they're allowed to fail, as that
+        can't be set per matrix entry.
+
+        :returns: list of (job name, allow failure, [(target, arch, variables)])
+        """
+
+        kind = "cross" if cross else "native"
+        groups: Dict[bool, List[Tuple[str, str, Dict[str, str]]]] = {}
+        for target, arch, allow_failure, optional in self._gitlab_container_jobs(cross):
+            container_arch = arch if cross else None
+            jobvars = gitlab.container_job_vars(
+                target,
+                container_arch,
+                optional,
+                self._container_tag(target, container_arch),
+            )
+            groups.setdefault(allow_failure, []).append((target, arch, jobvars))
+
+        matrix = []
+        for allow_failure, jobs in groups.items():
+            name = f"{kind}-containers"
+            if allow_failure:
+                name += "-allow-failure"
+            matrix.append((name, allow_failure, jobs))
+        return matrix
+
+    def _gitlab_container_needs(
+        self,
+    ) -> Dict[Tuple[bool, str, str], Tuple[str, Dict[str, str]]]:
+        """
+        Map the container built for each (cross, target, arch) to the
+        parallel:matrix job and matrix entry building it.
+        """
+
+        needs = {}
+        for cross in [False, True]:
+            for name, _, jobs in self._gitlab_container_matrix(cross):
+                if len(jobs) < 2:
+                    continue
+                _, matrix = gitlab.matrix_variables(
+                    [jobvars for _, _, jobvars in jobs], self.CONTAINER_MATRIX_KEYS
+                )
+                for (target, arch, _), entry in zip(jobs, matrix):
+                    if not cross:
+                        arch = "x86_64"
+                    needs[(cross, target, arch)] = (name, entry)
+        return needs
+
+    def _generate_gitlab_container_matrix_jobs(self, cross: bool) -> List[str]:
+        jobs = []
+        for name, allow_failure, group in self._gitlab_container_matrix(cross):
+            if len(group) > 1:
+                variables, matrix = gitlab.matrix_variables(
+                    [jobvars for _, _, jobvars in group], self.CONTAINER_MATRIX_KEYS
+                )
+                jobs.append(
+                    gitlab.container_matrix_job(name, allow_failure, variables, matrix)
+                )
+                continue
+
+            target, arch, jobvars = group[0]
+            optional = "JOB_OPTIONAL" in jobvars
+            tag = jobvars.get("CONTAINER_TAG")
+            if cross:
+                jobs.append(
+                    gitlab.cross_container_job(
+                        target, arch, allow_failure, optional, tag
                     )
-                jobs.append(containerbuildjob)
+                )
+            else:
+                jobs.append(
+                    gitlab.native_container_job(target, allow_failure, optional, tag)
+                )
+        return jobs
+
+    def _container_tag(self, target: str, arch: Optional[str]) -> Optional[str]:
+        """
+        Return the content-addressed tag of a container image, which is the
+        digest of its Dockerfile, or None if content tags are disabled.
+
+        :param target: target OS of the container
+        :param arch: cross architecture of the container (None if native)
+        """
+
+        if not self.values["gitlab"]["content-tags"]:
+            return None
+
+        key = (target, arch)
+        if key not in self._container_tags:
+            tgt = BuildTarget(self._targets, self._packages, target, "x86_64", arch)
+            wantprojects = self.values["targets"][target]["projects"]
+            payload = DockerfileFormatter(self._projects).format(tgt, wantprojects)
+
+            # the file header is left out, it only records how lcitool was run;
+            # the prefix keeps the tag from being loaded as a number from YAML
+            digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            self._container_tags[key] = "sha256-" + digest[: self.CONTAINER_TAG_LENGTH]
+        return self._container_tags[key]
+
+    def _generate_gitlab_container_jobs(self, cross: bool) -> List[str]:
+        if self.values["gitlab"]["parallel-matrix"]:
+            return self._generate_gitlab_container_matrix_jobs(cross)
+
+        jobs = []
+        for target, arch, allow_failure, optional in self._gitlab_container_jobs(cross):
+            if cross:
+                tag = self._container_tag(target, arch)
+                containerbuildjob = gitlab.cross_container_job(
+                    target, arch, allow_failure, optional, tag
+                )
+            else:
+                tag = self._container_tag(target, None)
+                containerbuildjob = gitlab.native_container_job(
+                    target, allow_failure, optional, tag
+                )
+            jobs.append(containerbuildjob)
         return jobs
 
     def _generate_gitlab_native_container_jobs(self) -> List[str]:
@@ -456,13 +600,9 @@ class Manifest:
             jobs = ["\n\n# Cross container jobs"] + jobs
         return jobs
 
-    def _generate_build_jobs(
-        self,
-        targettype: str,
-        cross: bool,
-        jobfunc: Callable[[str, Dict[str, Any], Dict[str, Any]], str],
-    ) -> List[str]:
-        jobs = []
+    def _build_jobs(
+        self, targettype: str, cross: bool
+    ) -> Iterator[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
         for target, targetinfo in self.values["targets"].items():
             if not targetinfo["enabled"]:
                 continue
@@ -480,10 +620,135 @@ class Manifest:
                 if jobinfo["cross-build"] != cross:
                     continue
 
-                jobs.append(jobfunc(target, facts, jobinfo))
+                yield target, facts, jobinfo
+
+    def _generate_build_jobs(
+        self,
+        targettype: str,
+        cross: bool,
+        jobfunc: Callable[[str, Dict[str, Any], Dict[str, Any]], str],
+    ) -> List[str]:
+        return [
+            jobfunc(target, facts, jobinfo)
+            for target, facts, jobinfo in self._build_jobs(targettype, cross)
+        ]
+
+    @staticmethod
+    def _matrix_group(
+        keys: List[str], group: List[Tuple[str, Dict[str, str]]], matrix_name: str
+    ) -> List[Tuple[str, Dict[str, str], Optional[List[Dict[str, str]]]]]:
+        """
+        Merge a group of jobs into a parallel:matrix job, falling back to
+        separate jobs when there's a single job or when the matrix entries
+        can't be told apart.
+
+        :param keys: variables which are always part of the matrix entries
+        :param group: list of (job name, variables) of the jobs to merge
+        :param matrix_name: name of the parallel:matrix job
+        :returns: list of (job name, variables, matrix entries or None)
+        """
+
+        if len(group) > 1:
+            variables, matrix = gitlab.matrix_variables(
+                [jobvars for _, jobvars in group], keys
+            )
+            entries = {tuple(sorted(entry.items())) for entry in matrix}
+            if len(entries) == len(matrix):
+                return [(matrix_name, variables, matrix)]
+
+        return [(name, jobvars, None) for name, jobvars in group]
+
+    def _generate_gitlab_build_matrix_jobs(self, cross: bool) -> List[str]:
+        """
+        Group the build jobs into parallel:matrix jobs.
+
+        Only the jobs sharing the very same container job, template, failure
+        policy and artifacts are merged, so that each of them keeps needing
+        exactly the container it's built in. A merged job is named after that
+        container, '<arch>-<target>-builds' (with '-allow-failure' appended
+        if it's allowed to fail and a number if that's still ambiguous).
+        """
+
+        container_needs = self._gitlab_container_needs()
+        groups: Dict[str, List[Tuple[str, Dict[str, str]]]] = {}
+        groupinfo: Dict[str, Tuple[Dict[str, Any], str, str]] = {}
+        for target, facts, jobinfo in self._build_jobs("containers", cross):
+            arch = jobinfo["arch"]
+            image = facts["containers"]["base"]
+            optional = not jobinfo["builds"]
+            if cross:
+                jobvars = gitlab.cross_build_vars(
+                    target,
+                    image,
+                    arch,
+                    jobinfo["variables"],
+                    optional,
+                    self._container_tag(target, arch),
+                )
+            else:
+                jobvars = gitlab.native_build_vars(
+                    target,
+                    image,
+                    jobinfo["variables"],
+                    optional,
+                    self._container_tag(target, None),
+                )
+                arch = "x86_64"
+
+            container, entry = container_needs.get(
+                (cross, target, arch), (f"{arch}-{target}-container", None)
+            )
+            needs = gitlab.format_needs(container, entry)
+            key = json.dumps(
+                [
+                    needs,
+                    jobinfo["template"],
+                    jobinfo["allow-failure"],
+                    jobinfo["artifacts"],
+                ],
+                sort_keys=True,
+            )
+            name = f"{arch}-{target}{jobinfo['suffix']}"
+            groups.setdefault(key, []).append((name, jobvars))
+            groupinfo.setdefault(key, (jobinfo, needs, f"{arch}-{target}-builds"))
+
+        jobs = []
+        matrix_names: Set[str] = set()
+        for key, group in groups.items():
+            jobinfo, needs, matrix_name = groupinfo[key]
+            if jobinfo["allow-failure"]:
+                matrix_name += "-allow-failure"
+            if len(group) > 1:
+                unique_name, n = matrix_name, 1
+                while unique_name in matrix_names:
+                    n += 1
+                    unique_name = f"{matrix_name}-{n}"
+                matrix_name = unique_name
+                matrix_names.add(matrix_name)
+
+            for name, variables, matrix in self._matrix_group(
+                self.BUILD_MATRIX_KEYS, group, matrix_name
+            ):
+                jobs.append(
+                    gitlab.build_job(
+                        name,
+                        jobinfo["template"],
+                        needs,
+                        jobinfo["allow-failure"],
+                        variables,
+                        jobinfo["artifacts"],
+                        matrix,
+                    )
+                )
         return jobs
 
     def _generate_gitlab_native_build_jobs(self) -> List[str]:
+        if self.values["gitlab"]["parallel-matrix"]:
+            jobs = self._generate_gitlab_build_matrix_jobs(False)
+            if len(jobs) > 0:
+                jobs = ["\n# Native build jobs"] + jobs
+            return jobs
+
         def jobfunc(target: str, facts: Dict[str, Any], jobinfo: Dict[str, Any]) -> str:
             return gitlab.native_build_job(
                 target,
@@ -494,6 +759,7 @@ class Manifest:
                 jobinfo["allow-failure"],
                 not jobinfo["builds"],
                 jobinfo["artifacts"],
+                self._container_tag(target, None),
             )
 
         jobs = self._generate_build_jobs("containers", False, jobfunc)
@@ -502,6 +768,12 @@ class Manifest:
         return jobs
 
     def _generate_gitlab_cross_build_jobs(self) -> List[str]:
+        if self.values["gitlab"]["parallel-matrix"]:
+            jobs = self._generate_gitlab_build_matrix_jobs(True)
+            if len(jobs) > 0:
+                jobs = ["\n\n# Cross build jobs"] + jobs
+            return jobs
+
         def jobfunc(target: str, facts: Dict[str, Any], jobinfo: Dict[str, Any]) -> str:
             return gitlab.cross_build_job(
                 target,
@@ -513,6 +785,7 @@ class Manifest:
                 jobinfo["allow-failure"],
                 not jobinfo["builds"],
                 jobinfo["artifacts"],
+                self._container_tag(target, jobinfo["arch"]),
             )
 
         jobs = self._generate_build_jobs("containers", True, jobfunc)
@@ -520,7 +793,40 @@ class Manifest:
             jobs = ["\n\n# Cross build jobs"] + jobs
         return jobs
 
+    def _generate_gitlab_cirrus_build_matrix_jobs(self) -> List[str]:
+        groups: Dict[bool, List[Tuple[str, Dict[str, str]]]] = {}
+        for target, facts, jobinfo in self._build_jobs("cirrus", False):
+            jobvars = gitlab.cirrus_build_vars(
+                target,
+                facts["cirrus"]["instance_type"],
+                facts["cirrus"]["image_selector"],
+                facts["cirrus"]["image_name"],
+                facts["packaging"]["command"],
+                jobinfo["variables"],
+                not jobinfo["builds"],
+            )
+            name = f"{facts['cirrus']['arch']}-{target}{jobinfo['suffix']}"
+            groups.setdefault(jobinfo["allow-failure"], []).append((name, jobvars))
+
+        jobs = []
+        for allow_failure, group in groups.items():
+            # the jobs don't need anything, name them after what they are
+            matrix_name = "cirrus-builds"
+            if allow_failure:
+                matrix_name += "-allow-failure"
+            for name, variables, matrix in self._matrix_group(
+                self.CIRRUS_MATRIX_KEYS, group, matrix_name
+            ):
+                jobs.append(gitlab.cirrus_job(name, allow_failure, variables, matrix))
+        return jobs
+
     def _generate_gitlab_cirrus_build_jobs(self) -> List[str]:
+        if self.values["gitlab"]["parallel-matrix"]:
+            jobs = self._generate_gitlab_cirrus_build_matrix_jobs()
+            if len(jobs) > 0:
+                jobs = ["\n# Native cirrus build jobs"] + jobs
+            return jobs
+
         def jobfunc(target: str, facts: Dict[str, Any], jobinfo: Dict[str, Any]) -> str:
             return gitlab.cirrus_build_job(
                 target,
@@ -8,7 +8,6 @@ import logging
 from pathlib import Path
 import requests
 from urllib.parse import urlparse
-import yaml
 
 from lcitool import util, LcitoolError
 from lcitool.packages import Package, PyPIPackage, CPANPackage
@@ -249,7 +248,7 @@ class Project:
 
         try:
             data = self._load_data()
-            yaml_packages = yaml.safe_load(data)
+            yaml_packages = util.load_yaml(data)
             packages = yaml_packages["packages"]
             if not isinstance(packages, list):
                 raise ProjectError(
@@ -7,6 +7,7 @@
 import copy
 import errno
 import fnmatch
+import json
 import logging
 import os
 import sys
@@ -22,6 +23,19 @@ _tempdir = None
 
 log = logging.getLogger(__name__)
 
+# the libyaml based loader is way faster, which matters with the package
+# mappings, but PyYAML may be built without it
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader  # type: ignore[assignment]
+
+
+def load_yaml(stream: Any) -> Any:
+    """Parse YAML data (a string or a file object) like yaml.safe_load."""
+
+    return yaml.load(stream, Loader=YAMLLoader)
+
 
 class SSHKey:
     """
@@ -268,6 +282,56 @@ def get_cache_dir() -> Path:
     return Path(cache_dir, "lcitool")
 
 
+def get_ansible_facts_dir() -> Path:
+    """Directory the persistent Ansible workspace caches host facts in."""
+
+    return Path(get_cache_dir(), "ansible-facts")
+
+
+def get_update_fingerprints_dir() -> Path:
+    """Directory the fingerprints of the hosts' last successful update are in."""
+
+    return Path(get_cache_dir(), "update-fingerprints")
+
+
+def load_cache_file(name: str) -> Any:
+    """
+    Load JSON data previously stored in the lcitool cache dir.
+
+    :param name: name of the cache file relative to the cache dir
+    :returns: the deserialized data or None if the file doesn't exist or
+              couldn't be parsed
+    """
+
+    path = Path(get_cache_dir(), name)
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        log.debug(f"Ignoring unreadable cache file '{path}': {ex}")
+        return None
+
+
+def dump_cache_file(name: str, data: Any) -> None:
+    """
+    Atomically store JSON data in the lcitool cache dir.
+
+    Failing to write the cache is not fatal, the failure is only logged.
+
+    :param name: name of the cache file relative to the cache dir
+    :param data: JSON serializable data
+    """
+
+    path = Path(get_cache_dir(), name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, json.dumps(data))
+    except (OSError, TypeError, ValueError) as ex:
+        log.debug(f"Failed to write cache file '{path}': {ex}")
+
+
 def get_config_dir() -> Path:
     try:
         config_dir = Path(os.environ["XDG_CONFIG_HOME"])
@@ -405,7 +469,7 @@ class DataDir:
         for file in self._search(resource_path, name + ".yml"):
             log.debug(f"Loading facts from '{file}'")
             with open(file, "r") as infile:
-                merge_dict(yaml.safe_load(infile), result)
+                merge_dict(load_yaml(infile), result)
         return result
 
 
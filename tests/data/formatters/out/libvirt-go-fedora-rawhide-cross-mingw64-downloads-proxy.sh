@@ -0,0 +1,30 @@
+function install_buildenv() {
+    (
+        PACKAGE_PROXY="${PACKAGE_PROXY:-http://proxy.example.com:3128}"
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        sed -i '/^max_parallel_downloads=/d' /etc/dnf/dnf.conf
+        echo 'max_parallel_downloads=10' >> /etc/dnf/dnf.conf
+        dnf --quiet update -y --nogpgcheck fedora-gpg-keys
+        dnf --quiet distro-sync -y
+        dnf --quiet install -y \
+                ca-certificates \
+                ccache \
+                git \
+                glibc-langpack-en \
+                golang
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        dnf --quiet install -y \
+                mingw64-gcc \
+                mingw64-headers \
+                mingw64-pkg-config
+        rpm -qa | sort > /packages.txt
+        mkdir -p /usr/libexec/ccache-wrappers
+        ln -s /usr/bin/ccache /usr/libexec/ccache-wrappers/x86_64-w64-mingw32-cc
+        ln -s /usr/bin/ccache /usr/libexec/ccache-wrappers/x86_64-w64-mingw32-gcc
+    )
+}
+
+export CCACHE_WRAPPERSDIR="/usr/libexec/ccache-wrappers"
+export LANG="en_US.UTF-8"
+
+export ABI="x86_64-w64-mingw32"
\ No newline at end of file
@@ -0,0 +1,21 @@
+function install_buildenv() {
+    (
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        sed -i '/^max_parallel_downloads=/d' /etc/dnf/dnf.conf
+        echo 'max_parallel_downloads=10' >> /etc/dnf/dnf.conf
+        dnf --quiet update -y
+        dnf --quiet install 'dnf-command(config-manager)' -y
+        dnf --quiet config-manager --set-enabled -y crb
+        dnf --quiet install -y epel-release
+        dnf --quiet install almalinux-release-devel -y
+        dnf --quiet config-manager --set-enabled -y devel
+        dnf --quiet install -y \
+                ca-certificates \
+                git \
+                glibc-langpack-en \
+                golang
+        rpm -qa | sort > /packages.txt
+    )
+}
+
+export LANG="en_US.UTF-8"
\ No newline at end of file
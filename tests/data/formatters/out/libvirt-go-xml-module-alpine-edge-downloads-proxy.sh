@@ -0,0 +1,15 @@
+function install_buildenv() {
+    (
+        PACKAGE_PROXY="${PACKAGE_PROXY:-http://proxy.example.com:3128}"
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        apk update
+        apk upgrade
+        apk add \
+        ca-certificates \
+        git \
+        go
+        apk list --installed | sort > /packages.txt
+    )
+}
+
+export LANG="en_US.UTF-8"
\ No newline at end of file
@@ -0,0 +1,19 @@
+function install_buildenv() {
+    (
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        printf 'Acquire::Queue-Mode "host";\nAcquire::http::Pipeline-Depth "20";\nAcquire::Retries "3";\n' > /etc/apt/apt.conf.d/90lcitool-downloads
+        export DEBIAN_FRONTEND=noninteractive
+        apt-get update
+        apt-get dist-upgrade -y
+        apt-get install --no-install-recommends -y \
+            ca-certificates \
+            git \
+            golang \
+            locales
+        sed -Ei 's,^# (en_US\.UTF-8 .*)$,\1,' /etc/locale.gen
+        dpkg-reconfigure locales
+        dpkg-query --showformat '${Package}_${Version}_${Architecture}\n' --show > /packages.txt
+    )
+}
+
+export LANG="en_US.UTF-8"
\ No newline at end of file
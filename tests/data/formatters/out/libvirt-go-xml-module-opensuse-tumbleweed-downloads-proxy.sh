@@ -0,0 +1,16 @@
+function install_buildenv() {
+    (
+        PACKAGE_PROXY="${PACKAGE_PROXY:-http://proxy.example.com:3128}"
+        if test -n "$PACKAGE_PROXY"; then export http_proxy="$PACKAGE_PROXY" https_proxy="$PACKAGE_PROXY"; fi
+        export ZYPP_PCK_PRELOAD=1
+        zypper dist-upgrade -y
+        zypper install -y \
+           ca-certificates \
+           git \
+           glibc-locale \
+           go
+        rpm -qa | sort > /packages.txt
+    )
+}
+
+export LANG="en_US.UTF-8"
\ No newline at end of file
@@ -0,0 +1,291 @@
+# test_ansible_wrapper: test the Ansible runner environment
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import pytest
+
+from pathlib import Path
+
+import test_utils.utils as test_utils
+
+from lcitool import ansible_wrapper, util
+from lcitool.ansible_wrapper import AnsibleWrapper, ExecutionError, TaskTimings
+from lcitool.application import Application
+from lcitool.util import DataDir
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(Path(tmp_path, "cache")))
+
+
+def inodes(path):
+    return {p.relative_to(path): p.stat().st_ino for p in path.rglob("*.yml")}
+
+
+def test_persistent_workspace(tmp_path):
+    sources = Path(tmp_path, "sources")
+    sources.mkdir()
+    Path(sources, "hosts").write_text("[fedora-43]\nfedora-1\n")
+
+    def prepare(group_vars):
+        wrapper = AnsibleWrapper(persistent=True)
+        assert wrapper.persistent
+        wrapper.prepare_env(
+            inventories=[sources, {"all": {"hosts": {"extra": {}}}}],
+            group_vars=group_vars,
+            extravars={"base": "/base"},
+        )
+        return wrapper._private_data_dir
+
+    workspace = prepare({"fedora-43": {"packages": ["a"]}, "debian-12": {}})
+    assert workspace == Path(util.get_cache_dir(), AnsibleWrapper.WORKSPACE_DIR)
+    before = inodes(workspace)
+
+    # nothing changed, nothing is rewritten
+    assert prepare({"fedora-43": {"packages": ["a"]}, "debian-12": {}}) == workspace
+    assert inodes(workspace) == before
+
+    # only what changed is rewritten and the stale files are removed
+    Path(sources, "hosts").write_text("[fedora-43]\nfedora-1\nfedora-2\n")
+    prepare({"fedora-43": {"packages": ["b"]}})
+    after = inodes(workspace)
+
+    inventory_yml = Path("inventory/lcitool-inventory-1.yml")
+    group_vars_yml = Path("inventory/group_vars/fedora-43.yml")
+    assert set(after) == {inventory_yml, group_vars_yml}
+    assert after[inventory_yml] == before[inventory_yml]
+    assert after[group_vars_yml] != before[group_vars_yml]
+    assert "fedora-2" in Path(workspace, "inventory/hosts").read_text()
+
+
+def test_persistent_workspace_playbookdir(tmp_path):
+    playbookdirs = [Path(tmp_path, "playbooks-1"), Path(tmp_path, "playbooks-2")]
+    for playbookdir in playbookdirs:
+        playbookdir.mkdir()
+
+    def prepare(playbookdir):
+        wrapper = AnsibleWrapper(persistent=True)
+        assert wrapper.persistent
+        wrapper.prepare_env(playbookdir=playbookdir)
+        return Path(wrapper._private_data_dir, "project")
+
+    # the project symlink is reused by the following runs...
+    project = prepare(playbookdirs[0])
+    inode = project.lstat().st_ino
+    assert prepare(playbookdirs[0]).lstat().st_ino == inode
+    assert project.resolve() == playbookdirs[0]
+
+    # ... unless it points somewhere else
+    assert prepare(playbookdirs[1]).resolve() == playbookdirs[1]
+
+
+def test_persistent_workspace_in_use():
+    wrapper = AnsibleWrapper(persistent=True)
+    assert wrapper.persistent
+
+    # another lcitool process would fall back to a temporary workspace
+    other = AnsibleWrapper(persistent=True)
+    assert not other.persistent
+    assert other._private_data_dir != wrapper._private_data_dir
+
+    del wrapper
+    assert AnsibleWrapper(persistent=True).persistent
+
+
+def test_persistent_params():
+    envvars = AnsibleWrapper()._get_default_params()["envvars"]
+    assert "ANSIBLE_CACHE_PLUGIN" not in envvars
+
+    params = AnsibleWrapper(persistent=True)._get_default_params()
+    envvars = params["envvars"]
+    assert envvars["ANSIBLE_GATHERING"] == "smart"
+    assert envvars["ANSIBLE_CACHE_PLUGIN"] == "jsonfile"
+    assert envvars["ANSIBLE_CACHE_PLUGIN_CONNECTION"] == (
+        util.get_ansible_facts_dir().as_posix()
+    )
+    assert "ControlPersist=600s" in envvars["ANSIBLE_SSH_ARGS"]
+    assert params["rotate_artifacts"] == AnsibleWrapper.KEEP_ARTIFACTS
+
+
+def test_default_forks(monkeypatch):
+    monkeypatch.setattr(ansible_wrapper.os, "cpu_count", lambda: 4)
+    assert AnsibleWrapper.default_forks(3) == 3
+    assert AnsibleWrapper.default_forks(150) == 16
+    assert AnsibleWrapper.default_forks(150, jobs=4) == 4
+    assert AnsibleWrapper.default_forks(150, jobs=32) == 1
+
+
+def test_run_playbook_scheduling(monkeypatch):
+    runs = []
+    monkeypatch.setattr(
+        AnsibleWrapper, "_run", lambda self, params: runs.append(params)
+    )
+
+    AnsibleWrapper().run_playbook(limit=["a", "b"])
+    AnsibleWrapper().run_playbook(limit=["a", "b"], forks=2, strategy="free")
+
+    assert runs[0]["envvars"]["ANSIBLE_FORKS"] == "16"
+    assert "ANSIBLE_STRATEGY" not in runs[0]["envvars"]
+    assert runs[1]["envvars"]["ANSIBLE_FORKS"] == "2"
+    assert runs[1]["envvars"]["ANSIBLE_STRATEGY"] == "free"
+    assert runs[1]["limit"] == "a,b"
+
+
+def test_run_playbook_batches():
+    class FakeRunner:
+        def __init__(self, error=None):
+            self.error = error
+            self.runs = []
+
+        def run_playbook(self, **kwargs):
+            self.runs.append(kwargs)
+            if self.error:
+                raise self.error
+
+    runners = [
+        FakeRunner(),
+        FakeRunner(ExecutionError("host unreachable", failed_hosts=["host-3"])),
+        FakeRunner(ExecutionError("no stats")),
+    ]
+    batches = [["host-0", "host-1"], ["host-2", "host-3"], ["host-4"]]
+    timings = TaskTimings()
+
+    with pytest.raises(ExecutionError) as excinfo:
+        Application._run_playbook_batches(runners, batches, 0, 2, "free", timings)
+
+    # the failures of all the batches are merged
+    assert excinfo.value.failed_hosts == ["host-3", "host-4"]
+    assert "2 of 5 hosts failed" in str(excinfo.value)
+    for runner, batch in zip(runners, batches):
+        assert runner.runs == [
+            {
+                "limit": batch,
+                "verbosity": 0,
+                "forks": 2,
+                "strategy": "free",
+                "timings": timings,
+            }
+        ]
+
+
+def event(name, host, task, duration, play="Setup", **data):
+    data.update(host=host, task=task, task_uuid=task, play=play, duration=duration)
+    return {"event": name, "event_data": data}
+
+
+def test_task_timings(monkeypatch, capsys):
+    runs = []
+
+    def run(self, params):
+        runs.append(params)
+        handler = params["event_handler"]
+        for ev in [
+            {"event": "playbook_on_play_start", "event_data": {"play": "Setup"}},
+            event("runner_on_ok", "fedora-1", "Install packages", 30.0),
+            event("runner_on_ok", "fedora-2", "Install packages", 50.0),
+            event("runner_on_ok", "debian-1", "Install packages", 10.0),
+            event("runner_on_ok", "fedora-1", "Update system", 5.0),
+            event("runner_on_failed", "fedora-2", "Update system", 1.0),
+            event(
+                "runner_on_failed", "debian-1", "Update system", 2.0, ignore_errors=True
+            ),
+        ]:
+            assert handler(ev)
+
+    monkeypatch.setattr(AnsibleWrapper, "_run", run)
+
+    hosts = ["fedora-1", "fedora-2", "debian-1"]
+    timings = AnsibleWrapper().run_playbook(limit=hosts)
+    assert "quiet" not in runs[0]
+    assert [t["status"] for t in timings.tasks] == ["ok"] * 4 + ["failed", "ok"]
+
+    host_targets = {"fedora-1": "fedora-43", "fedora-2": "fedora-43"}
+    host_targets["debian-1"] = "debian-12"
+    report = timings.report(host_targets, top=1)
+    assert report["hosts"]["fedora-1"]["target"] == "fedora-43"
+    assert report["hosts"]["fedora-1"]["duration"] == 35.0
+    assert [t["task"] for t in report["hosts"]["fedora-1"]["tasks"]] == [
+        "Install packages"
+    ]
+    assert report["targets"]["fedora-43"] == {
+        "hosts": 2,
+        "tasks": [
+            {
+                "play": "Setup",
+                "task": "Install packages",
+                "path": "",
+                "hosts": 2,
+                "total": 80.0,
+                "max": 50.0,
+            }
+        ],
+    }
+
+    # the progress view replaces the Ansible output
+    timings = TaskTimings(hosts, progress=True)
+    AnsibleWrapper().run_playbook(limit=hosts, timings=timings)
+    assert runs[1]["quiet"]
+    timings.close()
+    assert capsys.readouterr().err == "Setup: 2/3 hosts done, 1 failed\n"
+
+
+def test_update_skip_unchanged(monkeypatch, tmp_path):
+    data_dir = Path(tmp_path, "data")
+    Path(data_dir, "ansible").mkdir(parents=True)
+    Path(data_dir, "ansible/inventory").write_text(
+        "[fedora-43]\nfedora-1\n[debian-12]\ndebian-1\n"
+    )
+    Path(data_dir, "projects").mkdir()
+    Path(data_dir, "projects/libvirt.yml").write_text(
+        Path(test_utils.base_data_dir(), "projects/libvirt.yml").read_text()
+    )
+    config_path = Path(test_utils.base_data_dir(), "inventory/in/config.yml")
+
+    runs = []
+
+    def prepare_env(self, **kwargs):
+        if "playbookdir" in kwargs:
+            inventory = kwargs["inventories"][0]["all"]["children"]
+            runs.append(
+                sorted(
+                    host
+                    for group in inventory.values()
+                    for host, host_vars in group["hosts"].items()
+                    if host_vars.get("host_unchanged")
+                )
+            )
+
+    failed_hosts = []
+
+    def run_playbook(self, **kwargs):
+        if failed_hosts:
+            raise ExecutionError("failed", failed_hosts=failed_hosts)
+
+    monkeypatch.setattr(AnsibleWrapper, "prepare_env", prepare_env)
+    monkeypatch.setattr(AnsibleWrapper, "run_playbook", run_playbook)
+
+    def update(projects=None, skip_unchanged=True):
+        Application()._execute_playbook(
+            "update",
+            "all",
+            projects,
+            config_path,
+            DataDir(data_dir),
+            skip_unchanged=skip_unchanged,
+        )
+        return runs[-1]
+
+    assert update() == []
+    assert update() == ["debian-1", "fedora-1"]
+
+    # different package lists
+    assert update(projects="libvirt") == []
+    assert update() == []
+
+    # hosts which failed are fully updated the next time
+    failed_hosts.append("debian-1")
+    with pytest.raises(ExecutionError):
+        update(skip_unchanged=False)
+    failed_hosts.clear()
+    assert update() == ["fedora-1"]
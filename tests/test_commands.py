@@ -9,6 +9,8 @@ import subprocess
 import sys
 from pathlib import Path
 
+from lcitool.commandline import CommandLine
+
 
 cli_args = [
     ["--help"],
@@ -40,3 +42,27 @@ def test_commands(test_cli_args):
         [lcitool_path, "-d", Path(__file__).parent.joinpath("data")] + test_cli_args,
         stdout=subprocess.DEVNULL,
     )
+
+
+@pytest.mark.parametrize(
+    "max_size,valid",
+    [
+        ("2G", True),
+        ("500M", True),
+        ("1.5G", True),
+        ("1024", True),
+        ("2GB", False),
+        ("-1G", False),
+        ("G", False),
+        ("2 G", False),
+    ],
+)
+def test_ccache_max_size(monkeypatch, max_size, valid):
+    argv = ["lcitool", "container", "run", "--script", "build.sh", "alpine"]
+    monkeypatch.setattr(sys, "argv", argv + ["--ccache-max-size", max_size])
+
+    if valid:
+        assert CommandLine().parse().ccache_max_size == max_size
+    else:
+        with pytest.raises(SystemExit):
+            CommandLine().parse()
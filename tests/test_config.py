@@ -36,6 +36,11 @@ def test_config(assert_equal, config_filename):
     [
         "missing_gitlab_section_with_gitlab_flavor.yml",
         "root_password_none.yml",
+        "download_jobs_invalid.yml",
+        "cpan_jobs_invalid.yml",
+        "disk_cluster_size_invalid.yml",
+        "disk_preallocation_invalid.yml",
+        "disk_preallocation_overlay.yml",
     ],
 )
 def test_config_invalid(config_filename):
@@ -0,0 +1,262 @@
+# test_container_api: test the container engine REST API backend
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import json
+import pytest
+import struct
+import tarfile
+import threading
+import socketserver
+
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from lcitool.containers import ContainerError, ContainerExecError, Docker, Podman
+from lcitool.containers.api import EngineAPIClient, create_spec
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    """Serves a tiny subset of the Docker-compatible engine API."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def _lookup_image(self, name):
+        # like the engines, resolve image ID prefixes and untagged names
+        images = self.server.state["images"]
+        for ref, image_id in images.items():
+            if image_id.startswith(name) or ref in [name, f"{name}:latest"]:
+                return ref, image_id
+        return None
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        state["requests"].append(("GET", url.path))
+
+        if url.path == "/_ping":
+            return self._reply(200, b"OK", "text/plain")
+
+        if url.path.startswith("/images/") and url.path.endswith("/json"):
+            name = url.path[len("/images/") : -len("/json")]
+            image = self._lookup_image(name)
+            if image is not None:
+                return self._reply(200, {"Id": image[1], "RepoTags": [image[0]]})
+            return self._reply(404, {"message": f"no such image: {name}"})
+
+        if url.path.endswith("/logs"):
+            frames = b""
+            for stream, data in [(1, b"hello\n"), (2, b"oops\n")]:
+                frames += struct.pack(">BxxxL", stream, len(data)) + data
+            return self._reply(200, frames, "application/vnd.docker.raw-stream")
+
+        self._reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        state["requests"].append(("POST", url.path))
+        body = self._body()
+
+        if url.path == "/build":
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                state["build_context"] = tar.getnames()
+            state["build_params"] = parse_qs(url.query)
+            lines = [{"stream": "STEP 1/1\n"}, {"stream": "done\n"}]
+            out = "".join(json.dumps(line) + "\n" for line in lines)
+            return self._reply(200, out.encode())
+
+        if url.path == "/containers/create":
+            state["create_spec"] = json.loads(body)
+            return self._reply(201, {"Id": "c0ffee"})
+
+        if url.path.endswith("/start"):
+            return self._reply(204)
+
+        if url.path.endswith("/wait"):
+            return self._reply(200, {"StatusCode": state["exit_code"]})
+
+        self._reply(404, {"message": "not found"})
+
+    def do_DELETE(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        state["requests"].append(("DELETE", url.path))
+
+        if url.path.startswith("/images/"):
+            name = url.path[len("/images/") :]
+            image = self._lookup_image(name)
+            if image is not None:
+                del state["images"][image[0]]
+                return self._reply(200, [{"Deleted": image[1]}])
+            return self._reply(404, {"message": f"no such image: {name}"})
+
+        self._reply(204)
+
+
+class FakeEngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(str(path), FakeEngineHandler)
+        self.connections = 0
+        self.state = {
+            "requests": [],
+            "images": {"lcitool.fedora-rawhide:latest": "3f2a9c61d0e4"},
+            "exit_code": 0,
+        }
+
+    def get_request(self):
+        self.connections += 1
+        return super().get_request()
+
+
+@pytest.fixture
+def engine_server(tmp_path):
+    server = FakeEngineServer(Path(tmp_path, "engine.sock"))
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=[Podman, Docker], ids=["podman", "docker"])
+def engine(request, engine_server, monkeypatch):
+    monkeypatch.setenv("CONTAINER_HOST", f"unix://{engine_server.server_address}")
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{engine_server.server_address}")
+    return request.param(use_api=True)
+
+
+def test_available(engine):
+    assert engine.available
+
+
+def test_image_exists(engine, engine_server):
+    assert engine.image_exists("lcitool.fedora-rawhide", "latest")
+    assert not engine.image_exists("lcitool.fedora-rawhide", "invalid")
+    assert not engine.image_exists("", "")
+
+    # no full image listing is ever requested
+    assert ("GET", "/images/json") not in engine_server.state["requests"]
+
+
+def test_connection_reuse(engine, engine_server):
+    for _ in range(5):
+        engine.image_exists("lcitool.fedora-rawhide", "latest")
+    assert engine_server.connections == 1
+
+
+def test_rmi(engine, engine_server):
+    assert engine.rmi("lcitool.fedora-rawhide:latest")
+    assert not engine.rmi("lcitool.fedora-rawhide:latest")
+
+
+def test_build(engine, engine_server, tmp_path, capsys):
+    context = Path(tmp_path, "context")
+    context.mkdir()
+    dockerfile = Path(context, "Dockerfile")
+    dockerfile.write_text("FROM scratch\n")
+
+    assert engine.build(dockerfile, context, "lcitool.test") == 0
+    assert capsys.readouterr().out == "STEP 1/1\ndone\n"
+    assert "./Dockerfile" in engine_server.state["build_context"]
+    assert engine_server.state["build_params"]["t"] == ["lcitool.test"]
+    assert engine_server.state["build_params"]["dockerfile"] == ["Dockerfile"]
+
+
+def test_build_dockerfile_outside_context(engine_server, tmp_path):
+    dockerfile = Path(tmp_path, "Dockerfile")
+    dockerfile.write_text("FROM scratch\n")
+    context = Path(tmp_path, "context")
+    context.mkdir()
+
+    client = EngineAPIClient(engine_server.server_address)
+    list(client.build(dockerfile, context, "lcitool.test"))
+    assert ".lcitool.Dockerfile" in engine_server.state["build_context"]
+
+
+def test_run(engine, engine_server, capfd):
+    args = ["--rm", "--interactive", "--user", "0:0", "--env=FOO=bar"]
+    assert engine._run("lcitool.fedora-rawhide", "./script", args) == 0
+
+    out, err = capfd.readouterr()
+    assert out == "hello\n"
+    assert err == "oops\n"
+
+    spec = engine_server.state["create_spec"]
+    assert spec["Image"] == "lcitool.fedora-rawhide"
+    assert spec["Cmd"] == ["./script"]
+    assert spec["User"] == "0:0"
+    assert spec["Env"] == ["FOO=bar"]
+    assert ("DELETE", "/containers/c0ffee") in engine_server.state["requests"]
+
+
+@pytest.mark.parametrize("image", ["3f2a9c61d0e4", "3f2a9c", "lcitool.fedora-rawhide"])
+def test_run_image_reference(engine, engine_server, image):
+    assert engine._run(image, "./script", ["--user", "0:0"]) == 0
+
+    # the reference is never turned into '<id>:latest'
+    assert ("GET", f"/images/{image}/json") in engine_server.state["requests"]
+    assert engine_server.state["create_spec"]["Image"] == image
+
+
+def test_run_tagged_image(engine, engine_server):
+    engine._run("lcitool.fedora-rawhide:latest", "./script", ["--user", "0:0"])
+    assert engine_server.state["create_spec"]["Image"] == (
+        "lcitool.fedora-rawhide:latest"
+    )
+
+    with pytest.raises(ContainerError, match="not found"):
+        engine._run("lcitool.fedora-rawhide:43", "./script", ["--user", "0:0"])
+
+
+def test_run_failure(engine, engine_server):
+    engine_server.state["exit_code"] = 3
+    with pytest.raises(ContainerExecError) as excinfo:
+        engine._run("lcitool.fedora-rawhide", "./script", ["--user", "0:0"])
+    assert excinfo.value.returncode == 3
+
+
+def test_create_spec():
+    args = [
+        ("--volume", "/src:/root/datadir:z"),
+        ("--user", "1000:1000"),
+        ("--workdir", "/home/user"),
+        ("--ulimit", "nofile=1024:1024"),
+        ("--cap-add", "SYS_PTRACE"),
+        ("--env=FOO=bar",),
+    ]
+    spec = create_spec("foo:latest", "./script", args)
+    assert spec["HostConfig"] == {
+        "Binds": ["/src:/root/datadir:z"],
+        "CapAdd": ["SYS_PTRACE"],
+        "Ulimits": [{"Name": "nofile", "Soft": 1024, "Hard": 1024}],
+    }
+    assert spec["WorkingDir"] == "/home/user"
+
+    # podman ID mappings can't be expressed through the compat API
+    assert create_spec("foo", "./script", [("--uidmap", "0:1:1000")]) is None
+
+
+def test_fallback_without_socket(monkeypatch, tmp_path):
+    monkeypatch.setenv("CONTAINER_HOST", f"unix://{tmp_path}/missing.sock")
+    assert Podman(use_api=True).api is None
@@ -1,10 +1,19 @@
+import json
+import os
 import pwd
 import pytest
+import shutil
+import subprocess
+import threading
+import time
 
 from pathlib import Path
 from io import TextIOBase
 
-from lcitool.containers import ContainerError, Docker, Podman
+from lcitool.application import Application, ApplicationError
+from lcitool.containers import ContainerError, ContainerExecError, Docker, Podman
+from lcitool.containers.ccache import CompilerCache
+from lcitool.containers.matrix import ContainerMatrix
 
 
 id_mapping = [
@@ -302,3 +311,186 @@ class TestContainerReference:
     )
     def test_podman_image_reference_error(self, args, podman):
         assert podman.image_exists(*args) is False
+
+    def test_image_index_single_listing(self, monkeypatch):
+        calls = []
+
+        def podman_images(_self):
+            calls.append(1)
+            return self.podman_images()
+
+        monkeypatch.setattr(Podman, "_images", podman_images)
+        podman = Podman()
+        for _ in range(5):
+            assert podman.image_exists("alpine", "3.15")
+            assert not podman.image_exists("alpine", "latest")
+
+        assert len(calls) == 1
+
+
+class TestEngineProbeCache:
+
+    @pytest.fixture(autouse=True)
+    def patch_engine(self, monkeypatch, tmp_path):
+        self.calls = []
+        self.returncode = 0
+
+        def mock_exec(command, **kwargs):
+            self.calls.append(command)
+            return subprocess.CompletedProcess(command, self.returncode, stdout="")
+
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+        monkeypatch.setattr(shutil, "which", lambda cmd: f"/usr/bin/{cmd}")
+        monkeypatch.setattr(Podman, "_exec", staticmethod(mock_exec))
+
+    def test_probe_cached_in_process(self):
+        podman = Podman()
+        assert podman.available
+        assert podman.available
+        assert len(self.calls) == 1
+
+    def test_probe_cached_across_instances(self):
+        assert Podman().available
+        assert Podman().available
+        assert len(self.calls) == 1
+
+    def test_probe_cache_expired(self, monkeypatch):
+        assert Podman().available
+        monkeypatch.setattr(Podman, "PROBE_CACHE_TTL", -1)
+        assert Podman().available
+        assert len(self.calls) == 2
+
+    def test_probe_failure_not_cached(self):
+        self.returncode = 1
+        assert not Podman().available
+
+        # the engine was started right after the failed check
+        self.returncode = 0
+        assert Podman().available
+        assert Podman().available
+        assert len(self.calls) == 2
+
+    def test_probe_cache_engine_path_changed(self, monkeypatch):
+        assert Podman().available
+        monkeypatch.setattr(shutil, "which", lambda cmd: f"/usr/local/bin/{cmd}")
+        assert Podman().available
+        assert len(self.calls) == 2
+
+
+class TestContainerMatrix:
+
+    class FakeEngine(Podman):
+        def __init__(self):
+            super().__init__()
+            self.lock = threading.Lock()
+            self.running = 0
+            self.max_running = 0
+
+        def run(self, image, container_cmd, user, tempdir, **kwargs):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+
+            time.sleep(0.05)
+            kwargs["stdout"].write(f"{image} {container_cmd} {user}\n".encode())
+
+            with self.lock:
+                self.running -= 1
+
+            if image == "missing":
+                raise ContainerError("Image 'missing' not found")
+            if image.startswith("fail"):
+                raise ContainerExecError(2)
+            return 0
+
+    def test_matrix(self, tmp_path):
+        engine = self.FakeEngine()
+        images = ["foo", "fail:1", "bar/baz:2", "missing"]
+        report = Path(tmp_path, "report.json")
+        matrix = ContainerMatrix(engine, images, Path(tmp_path, "logs"), jobs=2)
+
+        results = matrix.run("./script", user=0, report=report)
+
+        assert [r["image"] for r in results] == images
+        assert [r["returncode"] for r in results] == [0, 2, 0, None]
+        assert results[3]["error"] == "Image 'missing' not found"
+        assert engine.max_running == 2
+
+        log = Path(tmp_path, "logs", "bar_baz_2.log")
+        assert results[2]["log"] == log.as_posix()
+        assert log.read_text() == "bar/baz:2 ./script 0\n"
+
+        with open(report) as fd:
+            data = json.load(fd)
+        assert data["jobs"] == 2
+        assert data["results"] == results
+
+    def test_expand_images(self, targets):
+        expand = Application._expand_matrix_images
+        assert expand("fedora-rawhide,alpine:3.15", targets) == [
+            "lcitool.fedora-rawhide",
+            "alpine:3.15",
+        ]
+        assert "lcitool.debian-12" in expand("debian-*", targets)
+        assert expand("registry.example.com/ci-*:latest", targets) == [
+            "registry.example.com/ci-*:latest"
+        ]
+        with pytest.raises(ApplicationError):
+            expand("nonexistent-*", targets)
+
+
+class TestCompilerCache:
+
+    @pytest.fixture(autouse=True)
+    def patch_host_arch(self, monkeypatch):
+        monkeypatch.setattr("lcitool.util.get_host_arch", lambda: "x86_64")
+
+    @pytest.mark.parametrize(
+        "image, key",
+        [
+            pytest.param("lcitool.fedora-rawhide", ("fedora-rawhide", "x86_64")),
+            pytest.param(
+                "registry.gitlab.com/libvirt/libvirt/ci-debian-12-cross-s390x:latest",
+                ("debian-12", "s390x"),
+                id="upstream-cross",
+            ),
+            pytest.param(
+                "registry.gitlab.com/libvirt/libvirt/ci-fedora-43",
+                ("fedora-43", "x86_64"),
+                id="upstream-native",
+            ),
+            pytest.param("docker.io/library/alpine:3.15", ("alpine", "x86_64")),
+        ],
+    )
+    def test_key(self, image, key):
+        assert CompilerCache.key(image) == key
+
+    def test_engine_args(self, tmp_path):
+        ccache = CompilerCache("lcitool.fedora-rawhide", "1G", base_dir=tmp_path)
+        args = ccache.engine_args(os.getuid(), os.getgid(), "/home/user")
+
+        path = Path(tmp_path, "fedora-rawhide", "x86_64")
+        assert path.is_dir()
+        assert args == [
+            ("--volume", f"{path}:/home/user/.ccache:z"),
+            ("--env=CCACHE_DIR=/home/user/.ccache",),
+            ("--env=CCACHE_MAXSIZE=1G",),
+        ]
+
+    def test_cleanup(self, tmp_path):
+        stale = Path(tmp_path, "debian-12", "x86_64")
+        fresh = Path(tmp_path, "debian-12", "s390x")
+        for path in [stale, fresh]:
+            path.mkdir(parents=True)
+
+        old = time.time() - (CompilerCache.MAX_AGE_DAYS + 1) * 24 * 3600
+        os.utime(stale, (old, old))
+
+        CompilerCache("lcitool.fedora-rawhide", base_dir=tmp_path).cleanup()
+        assert not stale.exists()
+        assert fresh.exists()
+
+    def test_build_args(self, tmp_path, mock_pwd, docker):
+        ccache = CompilerCache("lcitool.fedora-rawhide", base_dir=tmp_path)
+        args = docker._build_args(user=0, tempdir=tmp_path, ccache=ccache)
+        assert ("--env=CCACHE_DIR=/root/.ccache",) in args
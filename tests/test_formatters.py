@@ -143,6 +143,45 @@ layer_scenarios = [
     ),
 ]
 
+downloads_scenarios = [
+    # Faster package downloads, with and without a default package proxy
+    pytest.param(
+        "libvirt-go-xml-module",
+        "debian-12",
+        None,
+        None,
+        id="libvirt-go-xml-module-debian-12-downloads",
+    ),
+    pytest.param(
+        "libvirt-go-xml-module",
+        "almalinux-10",
+        None,
+        None,
+        id="libvirt-go-xml-module-almalinux-10-downloads",
+    ),
+    pytest.param(
+        "libvirt-go-xml-module",
+        "opensuse-tumbleweed",
+        None,
+        "http://proxy.example.com:3128",
+        id="libvirt-go-xml-module-opensuse-tumbleweed-downloads-proxy",
+    ),
+    pytest.param(
+        "libvirt-go-xml-module",
+        "alpine-edge",
+        None,
+        "http://proxy.example.com:3128",
+        id="libvirt-go-xml-module-alpine-edge-downloads-proxy",
+    ),
+    pytest.param(
+        "libvirt-go-module",
+        "fedora-rawhide",
+        "mingw64",
+        "http://proxy.example.com:3128",
+        id="libvirt-go-fedora-rawhide-cross-mingw64-downloads-proxy",
+    ),
+]
+
 
 @pytest.mark.parametrize("project,target,native_arch,cross_arch", scenarios)
 def test_dockerfiles(
@@ -272,3 +311,45 @@ def test_prepbuildenv(
         test_utils.test_data_outdir(__file__), request.node.callspec.id + ".sh"
     )
     assert_equal(actual, expected_path)
+
+
+@pytest.mark.parametrize("project,target,cross_arch,proxy", downloads_scenarios)
+def test_dockerfile_downloads(
+    assert_equal,
+    packages,
+    projects,
+    targets,
+    project,
+    target,
+    cross_arch,
+    proxy,
+    request,
+):
+    gen = DockerfileFormatter(projects, fastdownloads=True, package_proxy=proxy)
+    target_obj = BuildTarget(targets, packages, target, "x86_64", cross_arch)
+    actual = gen.format(target_obj, [project])
+    expected_path = Path(
+        test_utils.test_data_outdir(__file__), request.node.callspec.id + ".Dockerfile"
+    )
+    assert_equal(actual, expected_path)
+
+
+@pytest.mark.parametrize("project,target,cross_arch,proxy", downloads_scenarios)
+def test_prepbuildenv_downloads(
+    assert_equal,
+    packages,
+    projects,
+    targets,
+    project,
+    target,
+    cross_arch,
+    proxy,
+    request,
+):
+    gen = ShellBuildEnvFormatter(projects, fastdownloads=True, package_proxy=proxy)
+    target_obj = BuildTarget(targets, packages, target, "x86_64", cross_arch)
+    actual = gen.format(target_obj, [project])
+    expected_path = Path(
+        test_utils.test_data_outdir(__file__), request.node.callspec.id + ".sh"
+    )
+    assert_equal(actual, expected_path)
@@ -0,0 +1,302 @@
+# test_download: test resumable and verified image downloads
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import hashlib
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import lcitool.install.image as image
+
+pytest.importorskip("tqdm")
+
+DATA = bytes(range(256)) * 4096
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # files served by the server: name -> content
+    files = {}
+
+    # strong validators of the files: name -> ETag
+    etags = {}
+
+    # whether range requests are honoured
+    ranges = True
+
+    # drop the connection after sending that many bytes of the next image
+    drop_after = None
+
+    requests = []
+    if_ranges = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body):
+        name = self.path.lstrip("/")
+        if name not in self.files:
+            self.send_error(404)
+            return
+
+        data = self.files[name]
+        Handler.requests.append((self.command, name, self.headers.get("Range")))
+        Handler.if_ranges.append(self.headers.get("If-Range"))
+
+        # the range is only sent if the file didn't change since
+        etag = self.etags.get(name)
+        if_range = self.headers.get("If-Range")
+        unchanged = if_range is None or (etag is not None and if_range == etag)
+
+        start, end = 0, len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if self.ranges and match and unchanged:
+            start = int(match.group(1))
+            if match.group(2):
+                end = int(match.group(2))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+
+        if not body:
+            return
+
+        payload = data[start : end + 1]
+        if name.endswith(".qcow2") and Handler.drop_after is not None:
+            payload = payload[: Handler.drop_after]
+            Handler.drop_after = None
+        self.wfile.write(payload)
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+
+@pytest.fixture
+def server():
+    Handler.files = {"debian-12.qcow2": DATA}
+    Handler.etags = {"debian-12.qcow2": '"v1"'}
+    Handler.ranges = True
+    Handler.drop_after = None
+    Handler.requests = []
+    Handler.if_ranges = []
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def img(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(image.Image, "CHUNK_SIZE", 64 * 1024)
+    monkeypatch.setattr(image.time, "sleep", lambda seconds: None)
+
+    metadata = image.Metadata(
+        target="debian-12",
+        arch="x86_64",
+        format="qcow2",
+        libosinfo_id="http://debian.org/debian/12",
+        url=f"{server}/debian-12.qcow2",
+    )
+    return image.Image(metadata, tmp_path)
+
+
+def gets(name):
+    return [r for r in Handler.requests if r[:2] == ("GET", name)]
+
+
+@pytest.mark.parametrize(
+    "checksum_file,content",
+    [
+        pytest.param("SHA256SUMS", f"{SHA256}  debian-12.qcow2\n", id="gnu"),
+        pytest.param("CHECKSUM", f"SHA256 (debian-12.qcow2) = {SHA256}\n", id="bsd"),
+        pytest.param("debian-12.qcow2.sha256", f"{SHA256}\n", id="single"),
+    ],
+)
+def test_download_verified(img, tmp_path, checksum_file, content):
+    Handler.files[checksum_file] = content.encode()
+
+    path = Path(img.download())
+
+    assert path.read_bytes() == DATA
+    assert path.stat().st_mode & 0o777 == 0o644
+    assert img.metadata["sha256"] == SHA256
+    assert img.metadata["verified"]
+
+    # the metadata is stored next to the image and passes validation
+    metadata = image.Metadata().load(path.with_suffix(".metadata"))
+    assert metadata["image"] == path.as_posix()
+    assert not list(tmp_path.glob(".*.part"))
+
+
+def test_download_unverified(img):
+    Path(img.download())
+    assert img.metadata["sha256"] == SHA256
+    assert not img.metadata["verified"]
+
+
+def test_download_checksum_mismatch(img, tmp_path):
+    Handler.files["SHA256SUMS"] = f"{'0' * 64}  debian-12.qcow2\n".encode()
+
+    with pytest.raises(image.ImageError, match="Checksum mismatch"):
+        img.download()
+
+    # broken data aren't resumed from
+    assert not list(tmp_path.iterdir())
+
+
+def test_download_resume(img):
+    Handler.files["SHA256SUMS"] = f"{SHA256}  debian-12.qcow2\n".encode()
+    Handler.drop_after = 256 * 1024
+
+    path = Path(img.download())
+
+    assert path.read_bytes() == DATA
+    assert img.metadata["verified"]
+    assert gets("debian-12.qcow2") == [
+        ("GET", "debian-12.qcow2", None),
+        ("GET", "debian-12.qcow2", f"bytes={256 * 1024}-"),
+    ]
+
+
+def test_download_resume_partial_file(img, tmp_path, monkeypatch):
+    # an earlier run gives up after the connection drops
+    monkeypatch.setattr(image.Image, "RETRIES", 0)
+    Handler.drop_after = 128 * 1024
+    with pytest.raises(image.ImageError):
+        img.download()
+
+    parts = list(tmp_path.glob(".*.part"))
+    assert len(parts) == 1 and parts[0].stat().st_size == 128 * 1024
+
+    path = Path(img.download())
+    assert path.read_bytes() == DATA
+    assert gets("debian-12.qcow2")[-1][2] == f"bytes={128 * 1024}-"
+
+
+def test_download_no_range_support(img, tmp_path):
+    Handler.ranges = False
+    Handler.drop_after = 128 * 1024
+
+    path = Path(img.download())
+
+    # the server can't resume, so the download restarted from scratch
+    assert path.read_bytes() == DATA
+    assert len(gets("debian-12.qcow2")) == 2
+
+
+def test_download_parallel(img, monkeypatch):
+    monkeypatch.setattr(image.Image, "PARALLEL_CHUNK_SIZE", 128 * 1024)
+    Handler.files["SHA256SUMS"] = f"{SHA256}  debian-12.qcow2\n".encode()
+    Handler.drop_after = 10 * 1024
+
+    path = Path(img.download(jobs=4))
+
+    assert path.read_bytes() == DATA
+    assert img.metadata["verified"]
+
+    # 8 ranges, one of them fetched again after the connection dropped
+    ranges = [r[2] for r in gets("debian-12.qcow2")]
+    assert len(ranges) == 9
+    assert all(re.match(r"bytes=\d+-\d+$", r) for r in ranges)
+
+
+def test_download_resume_changed_image(img, tmp_path, monkeypatch):
+    # an earlier run gives up after the connection drops
+    monkeypatch.setattr(image.Image, "RETRIES", 0)
+    Handler.drop_after = 128 * 1024
+    with pytest.raises(image.ImageError):
+        img.download()
+
+    # ... and the "latest" image is replaced in the meantime
+    data = DATA[::-1]
+    Handler.files["debian-12.qcow2"] = data
+    Handler.etags["debian-12.qcow2"] = '"v2"'
+
+    path = Path(img.download())
+    assert path.read_bytes() == data
+    assert img.metadata["sha256"] == hashlib.sha256(data).hexdigest()
+    assert gets("debian-12.qcow2")[-1][2] == f"bytes={128 * 1024}-"
+    assert Handler.if_ranges[-1] == '"v1"'
+    assert not list(tmp_path.glob(".*.validator"))
+
+
+def test_download_resume_without_validator(img, tmp_path, monkeypatch):
+    Handler.etags = {}
+    monkeypatch.setattr(image.Image, "RETRIES", 0)
+    Handler.drop_after = 128 * 1024
+    with pytest.raises(image.ImageError):
+        img.download()
+
+    # it can't be told whether the image changed since, so it's not resumed
+    path = Path(img.download())
+    assert path.read_bytes() == DATA
+    assert gets("debian-12.qcow2")[-1][2] is None
+
+
+def test_download_parallel_changed_image(img, tmp_path, monkeypatch):
+    monkeypatch.setattr(image.Image, "PARALLEL_CHUNK_SIZE", 128 * 1024)
+    monkeypatch.setattr(image.Image, "RETRIES", 0)
+    Handler.drop_after = 10 * 1024
+    with pytest.raises(image.ImageError):
+        img.download(jobs=2)
+    assert list(tmp_path.glob(".*.ranges"))
+
+    data = DATA[::-1]
+    Handler.files["debian-12.qcow2"] = data
+    Handler.etags["debian-12.qcow2"] = '"v2"'
+    Handler.requests = []
+
+    # none of the ranges fetched before are reused
+    path = Path(img.download(jobs=2))
+    assert path.read_bytes() == data
+    assert len(gets("debian-12.qcow2")) == 8
+    assert Handler.if_ranges[-1] == '"v2"'
+
+
+def test_download_parallel_image_changed_during_download(img, monkeypatch):
+    monkeypatch.setattr(image.Image, "PARALLEL_CHUNK_SIZE", 128 * 1024)
+
+    probe_ranges = image.Image._probe_ranges
+
+    def _probe_ranges(self, jobs):
+        probe = probe_ranges(self, jobs)
+        Handler.etags["debian-12.qcow2"] = '"v2"'
+        return probe
+
+    monkeypatch.setattr(image.Image, "_probe_ranges", _probe_ranges)
+    with pytest.raises(image.ImageError, match="changed on the server"):
+        img.download(jobs=2)
+
+
+def test_download_parallel_without_validator(img, monkeypatch):
+    monkeypatch.setattr(image.Image, "PARALLEL_CHUNK_SIZE", 128 * 1024)
+    Handler.etags = {}
+
+    # the ranges can't be told to come from the same data
+    path = Path(img.download(jobs=4))
+    assert path.read_bytes() == DATA
+    assert gets("debian-12.qcow2") == [("GET", "debian-12.qcow2", None)]
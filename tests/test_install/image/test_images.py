@@ -40,6 +40,10 @@ class MockOSinfoDB:
     libosinfo.
     """
 
+    @staticmethod
+    def fingerprint():
+        return "mock"
+
     def get_os_by_id(self, libosinfo_id):
         return MockOSinfoObject()
 
@@ -52,8 +56,14 @@ def patch_osinfodb(monkeypatch_module_scope):
     monkeypatch_module_scope.setattr("lcitool.install.osinfo.OSinfoDB", MockOSinfoDB)
 
 
+@pytest.fixture(autouse=True)
+def patch_cache_home(tmp_path, monkeypatch):
+    # the image index and osinfo lookups are stored in the lcitool cache dir
+    monkeypatch.setenv("XDG_CACHE_HOME", str(Path(tmp_path, "cache")))
+
+
 @pytest.fixture(scope="module", autouse=True)
-def patch_cache_dir(tmp_path_factory, monkeypatch_module_scope):
+def patch_cache_dir(monkeypatch_module_scope):
     def mock_cache_dir(self):
         return Path(test_utils.test_data_indir(__file__, "install/image"), "cache")
 
@@ -138,3 +148,37 @@ def test_get_image_NoImageError(monkeypatch, img_params, osinfo_image, targets):
 
     with pytest.raises(image.NoImageError):
         image.Images().get(target, targets.target_facts[target])
+
+
+@pytest.fixture
+def debian_image(osinfo_image):
+    global IMAGE
+    IMAGE = osinfo_image
+    IMAGE.update({"variants": ["generic", "nocloud"], "cloud_init": True})
+    return IMAGE
+
+
+def test_osinfo_lookup_cache(monkeypatch, debian_image, targets):
+    facts = targets.target_facts["debian-12"]
+    url = image.Images().get("debian-12", facts).metadata["url"]
+
+    # the osinfo database isn't loaded again
+    def fail(self):
+        raise AssertionError("osinfo database loaded")
+
+    monkeypatch.setattr(MockOSinfoDB, "__init__", fail)
+    assert image.Images().get("debian-12", facts).metadata["url"] == url
+    assert image.Images(offline=True).get("debian-12", facts).metadata["url"] == url
+
+    # ... unless the database changes
+    monkeypatch.setattr(MockOSinfoDB, "fingerprint", staticmethod(lambda: "new"))
+    with pytest.raises(AssertionError, match="osinfo database loaded"):
+        image.Images().get("debian-12", facts)
+
+    # offline lookups are served from the cache even if it's stale
+    assert image.Images(offline=True).get("debian-12", facts).metadata["url"] == url
+
+
+def test_osinfo_lookup_offline_miss(monkeypatch, debian_image, targets):
+    with pytest.raises(image.ImageError, match="can't resolve it offline"):
+        image.Images(offline=True).get("debian-12", targets.target_facts["debian-12"])
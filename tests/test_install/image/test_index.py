@@ -0,0 +1,134 @@
+# test_index: test the index of the vendor image cache and its eviction
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+
+import pytest
+
+import lcitool.install.image as image
+
+from pathlib import Path
+
+from lcitool import util
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(Path(tmp_path, "cache")))
+    cache_dir = Path(tmp_path, "images")
+    cache_dir.mkdir()
+    monkeypatch.setattr(image.Images, "_get_cache_dir", staticmethod(lambda: cache_dir))
+    return cache_dir
+
+
+def add_image(cache_dir, name, target, size, age):
+    """Store an image downloaded 'age' hours ago in the cache."""
+
+    path = Path(cache_dir, f"{name}.qcow2")
+    path.write_bytes(b"\0" * size)
+
+    metadata = image.Metadata(
+        target=target,
+        image=path.as_posix(),
+        url=f"https://example.org/{name}.qcow2",
+        arch="x86_64",
+        format="qcow2",
+        libosinfo_id=f"http://example.org/{target}",
+    )
+    metadata_path = path.with_suffix(".metadata")
+    metadata.dump(metadata_path)
+
+    mtime = 1_000_000_000 - age * 3600
+    os.utime(metadata_path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def images(cache_dir):
+    add_image(cache_dir, "fedora-old", "fedora-43", 100, age=48)
+    add_image(cache_dir, "fedora-new", "fedora-43", 200, age=24)
+    add_image(cache_dir, "debian-new", "debian-12", 300, age=12)
+    add_image(cache_dir, "alpine-new", "alpine-edge", 400, age=1)
+    return image.Images()
+
+
+def names(entries):
+    return [Path(e["metadata"]["image"]).stem for e in entries]
+
+
+def test_index(cache_dir, images, monkeypatch):
+    entries = images.list()
+    assert names(entries) == ["alpine-new", "debian-new", "fedora-old", "fedora-new"]
+    assert [e["latest"] for e in entries] == [True, True, False, True]
+    assert [e["size"] for e in entries] == [400, 300, 100, 200]
+
+    # the metadata files aren't loaded again while the cache dir is unchanged
+    def load(self, file):
+        raise AssertionError("metadata loaded")
+
+    monkeypatch.setattr(image.Metadata, "load", load)
+    assert names(image.Images().list()) == names(entries)
+
+    # ... and the latest images are served from the index
+    img = image.Images().get("fedora-43", {})
+    assert img.path == Path(cache_dir, "fedora-new.qcow2")
+
+
+def test_index_rebuild(cache_dir, images):
+    images.mark_used(images.get("debian-12", {}))
+
+    # an image added behind our back
+    add_image(cache_dir, "debian-newer", "debian-12", 10, age=0)
+
+    entries = {Path(e["metadata"]["image"]).stem: e for e in image.Images().list()}
+    assert entries["debian-newer"]["latest"]
+    assert not entries["debian-new"]["latest"]
+
+    # usage data survive rebuilding the index
+    assert entries["debian-new"]["last_used"] is not None
+
+
+def test_index_add(cache_dir, images):
+    path = add_image(cache_dir, "fedora-newest", "fedora-43", 50, age=0)
+    img = image.Image(image.Metadata().load(path.with_suffix(".metadata")), cache_dir)
+    images.add(img)
+
+    index = util.load_cache_file(image.Images.INDEX_FILE)
+    assert index["dir_mtime"] == cache_dir.stat().st_mtime_ns
+    assert image.Images().get("fedora-43", {}).path == path
+
+
+def test_prune_superseded(cache_dir, images):
+    evicted = images.prune(dry_run=True)
+    assert names(evicted) == ["fedora-old"]
+    assert Path(cache_dir, "fedora-old.qcow2").exists()
+
+    evicted = images.prune()
+    assert names(evicted) == ["fedora-old"]
+    assert not Path(cache_dir, "fedora-old.qcow2").exists()
+    assert not Path(cache_dir, "fedora-old.metadata").exists()
+    assert names(image.Images().list()) == ["alpine-new", "debian-new", "fedora-new"]
+
+
+def test_prune_lru(cache_dir, images):
+    # used most recently, despite being downloaded first
+    images.mark_used(images.get("fedora-43", {}))
+
+    evicted = images.prune(max_size=650)
+    assert names(evicted) == ["fedora-old", "debian-new"]
+    assert names(image.Images().list()) == ["alpine-new", "fedora-new"]
+
+    with pytest.raises(KeyError):
+        image.Images()._target_images["debian-12"]
+
+
+def test_prune_keeps_backing_stores(cache_dir, images):
+    keep = {
+        Path(cache_dir, "fedora-old.qcow2"),
+        Path(cache_dir, "debian-new.qcow2"),
+    }
+
+    evicted = images.prune(max_size=0, keep=keep)
+    assert names(evicted) == ["fedora-new", "alpine-new"]
+    assert names(image.Images().list()) == ["debian-new", "fedora-old"]
@@ -0,0 +1,183 @@
+# test_batch: test concurrent installation of multiple hosts
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+
+import pytest
+
+from pathlib import Path
+
+import test_utils.utils as test_utils
+
+import lcitool.install.install as install
+
+from lcitool.application import Application, ApplicationError
+from lcitool.config import Config
+from lcitool.install import BatchInstall, InstallerError, VirtInstall
+from lcitool.inventory import Inventory
+from lcitool.libvirt_wrapper import LibvirtWrapper
+
+
+class FakeInstall:
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.ssh_key = None
+        self.finished = False
+
+    def start(self, wait=False, console=True):
+        assert not console
+        with FakeInstall.lock:
+            FakeInstall.running += 1
+            FakeInstall.peak = max(FakeInstall.peak, FakeInstall.running)
+        time.sleep(0.05)
+        with FakeInstall.lock:
+            FakeInstall.running -= 1
+        if self.name.startswith("broken"):
+            raise InstallerError(f"Failed to install host '{self.name}'")
+
+    def finish(self):
+        self.finished = True
+
+
+@pytest.fixture
+def config():
+    return Config(path=Path(test_utils.base_data_dir(), "inventory/in/config.yml"))
+
+
+@pytest.fixture
+def fake_install(monkeypatch):
+    FakeInstall.peak = 0
+    monkeypatch.setattr(
+        VirtInstall,
+        "from_url",
+        classmethod(lambda cls, name, config, facts: FakeInstall(name)),
+    )
+
+
+def test_batch_install(config, fake_install):
+    hosts = [(f"host-{i}", {"target": "fedora-43"}) for i in range(6)]
+    hosts.insert(2, ("broken-1", {"target": "debian-12"}))
+
+    results = BatchInstall(config, jobs=3).run(hosts)
+
+    assert FakeInstall.peak == 3
+    assert [r["host"] for r in results] == [h for h, _ in hosts]
+    assert [r["host"] for r in results if r["error"]] == ["broken-1"]
+    assert results[2]["target"] == "debian-12"
+
+
+def test_batch_install_wait(config, fake_install, monkeypatch):
+    class FakeProber:
+        waited = []
+
+        def wait_all(self, hosts):
+            FakeProber.waited.append(sorted(hosts))
+            return {name: None if name != "cloud-2" else OSError() for name in hosts}
+
+    def from_url(cls, name, config, facts):
+        install = FakeInstall(name)
+        if name.startswith("cloud"):
+            install.ssh_key = "/path/to/key"
+        return install
+
+    monkeypatch.setattr(VirtInstall, "from_url", classmethod(from_url))
+    monkeypatch.setattr(VirtInstall, "ssh_prober", lambda: FakeProber())
+
+    hosts = [
+        (name, {"target": "fedora-43"}) for name in ["url-1", "cloud-1", "cloud-2"]
+    ]
+    results = BatchInstall(config, jobs=3).run(hosts, wait=True)
+
+    # all the hosts are waited for at once
+    assert FakeProber.waited == [["cloud-1", "cloud-2"]]
+    assert [r["host"] for r in results if r["error"]] == ["cloud-2"]
+
+
+def test_batch_install_invalid_jobs(config):
+    with pytest.raises(InstallerError):
+        BatchInstall(config, jobs=0)
+
+
+def test_expand_install_hosts(targets, config, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    inventory_path = Path(tmp_path, "inventory")
+    inventory_path.write_text(
+        "[fedora-43]\n"
+        "fedora-test-1 fully_managed=True\n"
+        "fedora-test-2 fully_managed=True\n"
+        "[debian-12]\n"
+        "debian-test-1\n"
+    )
+    inventory = Inventory(targets, config, inventory_path=inventory_path)
+    expand = Application()._expand_install_hosts
+
+    hosts = expand("fedora-test-*,new-1:alpine-edge", None, inventory, targets)
+    assert [(h, f["target"]) for h, f in hosts] == [
+        ("fedora-test-1", "fedora-43"),
+        ("fedora-test-2", "fedora-43"),
+        ("new-1", "alpine-edge"),
+    ]
+
+    hosts = expand("new-1,new-2", "debian-12", inventory, targets)
+    assert [f["target"] for _, f in hosts] == ["debian-12", "debian-12"]
+
+    # hosts not fully managed by lcitool can't be reinstalled
+    with pytest.raises(ApplicationError):
+        expand("debian-test-1", None, inventory, targets)
+
+    with pytest.raises(ApplicationError):
+        expand("new-1", None, inventory, targets)
+
+
+def test_vendor_images_kept_until_used(config, monkeypatch, tmp_path):
+    images = {"fedora-43": Path(tmp_path, "fedora.qcow2"), "debian-12": None}
+    pruned = []
+
+    class FakeImage:
+        def __init__(self, target):
+            self.target = target
+            self.path = images[target]
+            self.metadata = {"url": f"https://example.org/{target}.qcow2"}
+
+        def download(self, jobs):
+            self.path = Path(tmp_path, f"{self.target}.qcow2")
+
+    class FakeImages:
+        def __init__(self, offline=False):
+            pass
+
+        def get(self, target, facts, arch):
+            return FakeImage(target)
+
+        def add(self, image):
+            pass
+
+        def mark_used(self, image):
+            pass
+
+        def prune(self, max_size, keep):
+            pruned.append(set(keep))
+
+    def from_image(runner, config, path):
+        # another install downloads an image, evicting others, while the
+        # image of this one doesn't back any volume yet
+        if runner.name == "fedora-test":
+            facts = {"target": "debian-12"}
+            VirtInstall.from_vendor_image("debian-test", config, facts)
+        return path
+
+    monkeypatch.setitem(config.values["install"], "image_cache_size", 1)
+    monkeypatch.setattr(install, "Images", FakeImages)
+    monkeypatch.setattr(LibvirtWrapper, "backing_stores", lambda self: set())
+    monkeypatch.setattr(VirtInstall, "_from_image", staticmethod(from_image))
+
+    VirtInstall.from_vendor_image("fedora-test", config, {"target": "fedora-43"})
+
+    assert pruned == [{images["fedora-43"], Path(tmp_path, "debian-12.qcow2")}]
+    assert VirtInstall._held_images == {}
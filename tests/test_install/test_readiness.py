@@ -0,0 +1,91 @@
+# test_readiness: test waiting for hosts to accept SSH connections
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from lcitool.install import InstallerError
+from lcitool.install.readiness import SSHReadinessProber
+
+
+class FastProber(SSHReadinessProber):
+    INITIAL_DELAY = 0.01
+    MAX_DELAY = 0.05
+    CONNECT_TIMEOUT = 0.5
+
+    handshakes = []
+
+    def _handshake(self, address, key_filename):
+        FastProber.handshakes.append((address, key_filename))
+
+
+@pytest.fixture
+def port():
+    FastProber.handshakes = []
+
+    # grab a free port, nothing listens on it until the server is started
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, delay):
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    def _listen():
+        time.sleep(delay)
+        server.bind(("127.0.0.1", port))
+        server.listen()
+
+    thread = threading.Thread(target=_listen)
+    thread.start()
+    return server, thread
+
+
+def test_wait(port):
+    server, thread = start_server(port, 0.2)
+    prober = FastProber(timeout=5, port=port, resolver=lambda name: "127.0.0.1")
+    try:
+        address = asyncio.run(prober.wait("fedora-test", "/path/to/key"))
+    finally:
+        thread.join()
+        server.close()
+
+    # the handshake is only attempted once the port is open
+    assert address == "127.0.0.1"
+    assert FastProber.handshakes == [("127.0.0.1", "/path/to/key")]
+
+
+def test_wait_timeout(port):
+    prober = FastProber(timeout=0.3, port=port, resolver=lambda name: None)
+    with pytest.raises(InstallerError, match="timeout reached"):
+        asyncio.run(prober.wait("127.0.0.1", "/path/to/key"))
+    assert FastProber.handshakes == []
+
+
+def test_wait_all(port):
+    server, thread = start_server(port, 0.2)
+    addresses = {"ready-1": "127.0.0.1", "ready-2": "127.0.0.1"}
+    prober = FastProber(timeout=2, port=port, resolver=addresses.get)
+
+    start = time.monotonic()
+    try:
+        errors = prober.wait_all(
+            {"ready-1": "key-1", "ready-2": "key-2", "127.0.0.2": "key-3"}
+        )
+    finally:
+        thread.join()
+        server.close()
+
+    assert errors["ready-1"] is None
+    assert errors["ready-2"] is None
+    assert isinstance(errors["127.0.0.2"], InstallerError)
+
+    # the hosts are waited for concurrently
+    assert time.monotonic() - start < 2 * 2
@@ -0,0 +1,154 @@
+# test_template: test building and managing VM template images
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import subprocess
+
+import pytest
+
+import libvirt
+
+from pathlib import Path
+
+import test_utils.utils as test_utils
+
+from lcitool import libvirt_wrapper
+from lcitool.config import Config
+from lcitool.install import InstallerError, VirtInstall
+from lcitool.install.template import Templates, TemplateBuilder
+
+
+class FakeVolume:
+    def __init__(self, path):
+        self.path = path
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeInstall:
+    def __init__(self, conn, name, volume):
+        self._conn = conn
+        self.name = name
+        self.volume = volume
+        self.ssh_key = "/path/to/key"
+
+    def run(self, wait=False, console=True):
+        assert wait and not console
+        self._conn.add_domain(self.name, "fedora-43")
+
+
+@pytest.fixture
+def conn(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(libvirt_wrapper, "_connections", {})
+
+    conn = libvirt.virConnect()
+    monkeypatch.setattr(libvirt, "open", lambda uri=None: conn)
+    return conn
+
+
+@pytest.fixture
+def config():
+    return Config(path=Path(test_utils.base_data_dir(), "inventory/in/config.yml"))
+
+
+def add_template(tmp_path, target, version, monkeypatch):
+    monkeypatch.setattr("time.gmtime", lambda: (2026, 1, 1, 0, 0, version, 0, 1, 0))
+    image = Path(tmp_path, "image.qcow2")
+    image.write_text(target)
+    return Templates().add(target, image, projects="libvirt")
+
+
+def test_templates(conn, tmp_path, monkeypatch):
+    assert Templates().latest("fedora-43") is None
+
+    add_template(tmp_path, "fedora-43", 2, monkeypatch)
+    add_template(tmp_path, "fedora-43", 10, monkeypatch)
+    add_template(tmp_path, "debian-12", 5, monkeypatch)
+
+    templates = Templates().list()
+    assert [(t.target, t.version) for t in templates] == [
+        ("debian-12", "20260101000005"),
+        ("fedora-43", "20260101000002"),
+        ("fedora-43", "20260101000010"),
+    ]
+
+    latest = Templates().latest("fedora-43")
+    assert latest.path.name == "fedora-43-20260101000010.qcow2"
+    assert latest.path.read_text() == "fedora-43"
+    assert latest.metadata["projects"] == "libvirt"
+    assert latest.path.stat().st_mode & 0o777 == 0o644
+
+
+def test_install_from_latest_template(conn, config, tmp_path, monkeypatch):
+    facts = {"target": "fedora-43"}
+    monkeypatch.setattr(
+        VirtInstall, "_from_image", staticmethod(lambda runner, config, path: path)
+    )
+
+    with pytest.raises(InstallerError, match="No template built for 'fedora-43'"):
+        VirtInstall.from_template_image("fedora-test", config, facts)
+
+    template = add_template(tmp_path, "fedora-43", 0, monkeypatch)
+    path = VirtInstall.from_template_image("fedora-test", config, facts)
+    assert path == template.path
+
+
+def test_template_builder(conn, config, tmp_path, monkeypatch):
+    volume = FakeVolume(Path(tmp_path, "overlay.qcow2").as_posix())
+    monkeypatch.setattr(
+        VirtInstall,
+        "from_vendor_image",
+        classmethod(lambda cls, name, **kwargs: FakeInstall(conn, name, volume)),
+    )
+
+    commands = []
+    monkeypatch.setattr(
+        TemplateBuilder, "_ssh_run", lambda self, cmd: commands.append(cmd)
+    )
+
+    def check_call(cmd):
+        assert cmd[:4] == ["qemu-img", "convert", "-O", "qcow2"]
+        assert cmd[4] == volume.path
+        Path(cmd[5]).write_text("sealed")
+
+    monkeypatch.setattr(subprocess, "check_call", check_call)
+
+    builder = TemplateBuilder(config, "fedora-43", {"target": "fedora-43"})
+    builder.install()
+    assert conn.domains["lcitool-template-fedora-43"].active
+
+    # a second build can't run until the builder VM is gone
+    with pytest.raises(InstallerError, match="already exists"):
+        TemplateBuilder(config, "fedora-43", {"target": "fedora-43"}).install()
+
+    template = builder.seal(projects="libvirt")
+    assert "cloud-init clean" in commands[0]
+    assert not conn.domains["lcitool-template-fedora-43"].active
+    assert template.path.read_text() == "sealed"
+    assert Templates().latest("fedora-43").path == template.path
+
+    builder.cleanup()
+    assert "lcitool-template-fedora-43" not in conn.domains
+    assert volume.deleted
+
+
+def test_template_builder_existing_vm(conn, config, monkeypatch):
+    monkeypatch.setattr(
+        VirtInstall,
+        "from_vendor_image",
+        classmethod(lambda cls, name, **kwargs: pytest.fail("VM installed")),
+    )
+    conn.add_domain("lcitool-template-fedora-43", "fedora-43")
+
+    builder = TemplateBuilder(config, "fedora-43", {"target": "fedora-43"})
+    try:
+        with pytest.raises(InstallerError, match="already exists"):
+            builder.install()
+    finally:
+        builder.cleanup()
+
+    # the VM is not the builder's to remove, e.g. another build in progress
+    assert conn.domains["lcitool-template-fedora-43"].active
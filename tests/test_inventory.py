@@ -4,13 +4,14 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import json
 import pytest
 import test_utils.utils as test_utils
 
 from pathlib import Path
 
 from lcitool.config import Config
-from lcitool.inventory import Inventory, InventoryError
+from lcitool.inventory import Inventory, InventoryError, StaticInventory
 from lcitool.targets import BuildTarget
 
 
@@ -20,7 +21,10 @@ pytestmark = pytest.mark.filterwarnings(
 
 
 @pytest.fixture(scope="module")
-def inventory(targets):
+def inventory(targets, monkeypatch_module_scope, tmp_path_factory):
+    cache_dir = tmp_path_factory.mktemp("cache")
+    monkeypatch_module_scope.setenv("XDG_CACHE_HOME", str(cache_dir))
+
     config_path = Path(test_utils.test_data_indir(__file__), "config.yml")
     inventory_path = Path(test_utils.test_data_indir(__file__), "inventory")
     return Inventory(targets, Config(path=config_path), inventory_path=inventory_path)
@@ -66,3 +70,169 @@ def test_group_vars(inventory, targets, packages, projects):
 
     for key, value in target.facts.items():
         assert group_vars[key] == value
+
+
+def _inventory_hosts(inventory):
+    hosts = {}
+
+    def _rec(group, group_name):
+        for host_name, host_facts in group.get("hosts", {}).items():
+            host = hosts.setdefault(host_name, {"groups": set(), "facts": {}})
+            host["groups"].add(group_name)
+            host["facts"].update(host_facts)
+        for child_name, child in group.get("children", {}).items():
+            _rec(child, child_name)
+
+    _rec(inventory["all"], "all")
+    return hosts
+
+
+def test_static_inventory(targets):
+    from lcitool.ansible_wrapper import AnsibleWrapper
+
+    sources = [
+        Path(test_utils.test_data_indir(__file__), "inventory"),
+        Path(test_utils.test_data_indir(__file__), "static"),
+        {"all": {"children": {"debian-12": {"hosts": {"libvirt-host": {}}}}}},
+    ]
+
+    static_inventory = StaticInventory()
+    for source in sources:
+        assert static_inventory.add_source(source)
+    actual = static_inventory.resolve(targets.target_facts)
+
+    ansible_runner = AnsibleWrapper()
+    ansible_runner.prepare_env(inventories=sources, group_vars=targets.target_facts)
+    expected = ansible_runner.get_inventory()
+
+    assert _inventory_hosts(actual) == _inventory_hosts(expected)
+
+
+def test_static_inventory_ignored_exts(targets, tmp_path):
+    from lcitool.ansible_wrapper import AnsibleWrapper
+
+    inventory_dir = Path(tmp_path, "inventory")
+    inventory_dir.mkdir()
+    Path(inventory_dir, "hosts.ini").write_text("[fedora-43]\nfedora-test-1\n")
+    Path(inventory_dir, "README.txt").write_text("[debian-12]\ndebian-test-1\n")
+
+    static_inventory = StaticInventory()
+    assert static_inventory.add_source(inventory_dir)
+    actual = static_inventory.resolve(targets.target_facts)
+    assert list(_inventory_hosts(actual)) == ["fedora-test-1"]
+
+    ansible_runner = AnsibleWrapper()
+    ansible_runner.prepare_env(
+        inventories=[inventory_dir], group_vars=targets.target_facts
+    )
+    expected = ansible_runner.get_inventory()
+
+    assert _inventory_hosts(actual) == _inventory_hosts(expected)
+
+
+def test_static_inventory_unsupported(tmp_path):
+    script = Path(tmp_path, "dynamic")
+    script.write_text("#!/bin/sh\necho '{}'\n")
+    script.chmod(0o755)
+    assert not StaticInventory().add_source(script)
+
+    plugin = Path(tmp_path, "plugin.yml")
+    plugin.write_text("plugin: constructed\n")
+    assert not StaticInventory().add_source(plugin)
+
+    ranges = Path(tmp_path, "ranges")
+    ranges.write_text("[fedora-43]\nhost[01:10]\n")
+    assert not StaticInventory().add_source(ranges)
+
+
+def test_inventory_cache(targets, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(Path(tmp_path, "cache")))
+    config = Config(path=Path(test_utils.test_data_indir(__file__), "config.yml"))
+    inventory_path = Path(tmp_path, "inventory")
+    inventory_path.write_text("[fedora-43]\nfedora-test-1\n")
+
+    resolved = []
+    get_ansible_inventory = Inventory._get_ansible_inventory
+
+    def _get_ansible_inventory(self):
+        resolved.append(self)
+        return get_ansible_inventory(self)
+
+    monkeypatch.setattr(Inventory, "_get_ansible_inventory", _get_ansible_inventory)
+
+    def _hosts(**kwargs):
+        return Inventory(targets, config, inventory_path, **kwargs).hosts
+
+    assert _hosts() == ["fedora-test-1"]
+    assert _hosts() == ["fedora-test-1"]
+    assert len(resolved) == 1
+
+    # changing the inventory invalidates the cache
+    inventory_path.write_text("[fedora-43]\nfedora-test-1\nfedora-test-2\n")
+    assert _hosts() == ["fedora-test-1", "fedora-test-2"]
+    assert len(resolved) == 2
+
+    assert _hosts(refresh=True) == ["fedora-test-1", "fedora-test-2"]
+    assert len(resolved) == 3
+
+    # dynamic inventories are never cached
+    inventory_path.chmod(0o755)
+    monkeypatch.setattr(Inventory, "_get_ansible_inventory", lambda self: {"all": {}})
+    assert _hosts() == []
+
+
+def test_dynamic_inventory(targets, monkeypatch, tmp_path):
+    from lcitool.ansible_wrapper import AnsibleWrapper
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(Path(tmp_path, "cache")))
+    config = Config(path=Path(test_utils.test_data_indir(__file__), "config.yml"))
+    script = Path(tmp_path, "dynamic")
+    listing = {
+        "fedora-43": {"hosts": ["fedora-1"]},
+        "debian-12": {
+            "hosts": ["debian-1"],
+            "vars": {"packaging": {}, "paths": {}, "group_var": "group"},
+        },
+        "_meta": {
+            "hostvars": {
+                "fedora-1": {"fully_managed": True},
+                "debian-1": {"paths": {"make": "/usr/local/bin/make"}},
+            }
+        },
+    }
+    script.write_text(f"#!/bin/sh\necho '{json.dumps(listing)}'\n")
+    script.chmod(0o755)
+
+    ansible_runner = AnsibleWrapper()
+    inventory = Inventory(targets, config, script, ansible_runner=ansible_runner)
+
+    for host, target in [("fedora-1", "fedora-43"), ("debian-1", "debian-12")]:
+        assert inventory.get_host_target_name(host) == target
+        for key, value in targets.target_facts[target].items():
+            if host == "debian-1" and key == "paths":
+                continue
+            assert inventory.host_facts[host][key] == value
+
+    # the target facts take precedence over the inventory group vars, the
+    # host vars take precedence over both, just like with static inventories
+    debian_facts = inventory.host_facts["debian-1"]
+    assert debian_facts["packaging"] == targets.target_facts["debian-12"]["packaging"]
+    assert debian_facts["paths"] == {"make": "/usr/local/bin/make"}
+    assert debian_facts["group_var"] == "group"
+    assert inventory.host_facts["fedora-1"]["fully_managed"]
+
+    # the inventory was queried without dumping group_vars of all the targets
+    private_data_dir = ansible_runner._private_data_dir
+    assert not Path(private_data_dir, "inventory/group_vars").exists()
+
+    # only the hosts in play and their own vars are passed on to the playbook
+    subset = inventory.get_ansible_inventory_subset(["fedora-1"])
+    hosts = {"fedora-1": {"fully_managed": True}}
+    assert subset == {"all": {"children": {"fedora-43": {"hosts": hosts}}}}
+    ansible_runner.prepare_env(inventories=[subset], group_vars={"fedora-43": {}})
+
+    # ... replacing the inventory sources queried before
+    inventory_dir = Path(private_data_dir, "inventory")
+    assert not Path(inventory_dir, "dynamic").exists()
+    group_vars = [p.name for p in Path(inventory_dir, "group_vars").iterdir()]
+    assert group_vars == ["fedora-43.yml"]
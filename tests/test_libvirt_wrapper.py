@@ -0,0 +1,207 @@
+# test_libvirt_wrapper: test the libvirt wrapper
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import pytest
+
+from pathlib import Path
+
+import libvirt
+
+from lcitool import libvirt_wrapper
+from lcitool.libvirt_wrapper import LibvirtWrapper
+
+
+@pytest.fixture
+def conn(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(libvirt_wrapper, "_connections", {})
+    monkeypatch.setattr(libvirt, "connections", [])
+
+    conn = libvirt.open()
+    for i in range(50):
+        conn.add_domain(f"fedora-{i}", "fedora-43", persistent=(i % 5 != 0))
+    for i in range(50):
+        conn.add_domain(f"unrelated-{i}")
+
+    monkeypatch.setattr(libvirt, "open", lambda uri=None: conn)
+    return conn
+
+
+def test_shared_connection(monkeypatch):
+    monkeypatch.setattr(libvirt_wrapper, "_connections", {})
+    monkeypatch.setattr(libvirt, "connections", [])
+
+    for _ in range(3):
+        LibvirtWrapper().domains
+    LibvirtWrapper("qemu:///session").domains
+    assert [c.uri for c in libvirt.connections] == [None, "qemu:///session"]
+
+
+def test_hosts(conn):
+    hosts = LibvirtWrapper().hosts
+    assert hosts == {f"fedora-{i}": "fedora-43" for i in range(50)}
+
+    # two bulk listings plus a single metadata query per domain
+    assert conn.round_trips == 2 + 100
+
+
+def test_hosts_cached(conn):
+    LibvirtWrapper().hosts
+    conn.round_trips = 0
+
+    # only the new domain needs to be queried
+    conn.add_domain("debian-0", "debian-12")
+    hosts = LibvirtWrapper().hosts
+    assert hosts["debian-0"] == "debian-12"
+    assert len(hosts) == 51
+    assert conn.round_trips == 2 + 1
+
+    conn.round_trips = 0
+    assert LibvirtWrapper().get_hosts(refresh=True) == hosts
+    assert conn.round_trips == 2 + 101
+
+
+def test_hosts_cached_redefined(conn):
+    LibvirtWrapper().hosts
+    conn.round_trips = 0
+
+    # same UUIDs, but renamed and no longer persistent respectively
+    dom = conn.domains.pop("fedora-1")
+    dom._name = "fedora-renamed"
+    conn.domains[dom._name] = dom
+    conn.domains["fedora-2"]._persistent = False
+
+    hosts = LibvirtWrapper().hosts
+    assert "fedora-1" not in hosts
+    assert hosts["fedora-renamed"] == hosts["fedora-2"]
+    assert conn.round_trips == 2 + 2
+
+
+def test_set_target(conn):
+    LibvirtWrapper().hosts
+    generation = LibvirtWrapper().metadata_generation
+
+    LibvirtWrapper().set_target("unrelated-0", "alpine-edge")
+    assert LibvirtWrapper().metadata_generation == generation + 1
+
+    conn.round_trips = 0
+    assert LibvirtWrapper().hosts["unrelated-0"] == "alpine-edge"
+    assert conn.round_trips == 2
+
+
+def test_domain_address(conn):
+    lease = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE
+    agent = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT
+    ipv4 = {"type": libvirt.VIR_IP_ADDR_TYPE_IPV4, "addr": "192.168.122.10"}
+    ipv6 = {"type": libvirt.VIR_IP_ADDR_TYPE_IPV6, "addr": "fe80::1"}
+
+    dom = conn.lookupByName("fedora-1")
+    assert LibvirtWrapper().domain_address("fedora-1") is None
+    assert LibvirtWrapper().domain_address("nonexistent") is None
+
+    # no lease yet, but the guest agent knows the address
+    dom.addresses[agent] = {"eth0": {"addrs": [ipv6, ipv4]}}
+    assert LibvirtWrapper().domain_address("fedora-1") == "192.168.122.10"
+
+    dom.addresses[lease] = {"vnet0": {"addrs": [dict(ipv4, addr="192.168.122.11")]}}
+    assert LibvirtWrapper().domain_address("fedora-1") == "192.168.122.11"
+
+
+def test_backing_stores(conn):
+    conn.pools = [
+        libvirt.virStoragePool(
+            [
+                libvirt.virStorageVol("/pool/fedora-0.qcow2", "/images/fedora.qcow2"),
+                libvirt.virStorageVol("/pool/standalone.qcow2"),
+            ]
+        ),
+        libvirt.virStoragePool(
+            [libvirt.virStorageVol("/inactive/a.qcow2", "/images/a.qcow2")],
+            active=False,
+        ),
+    ]
+    conn.lookupByName("unrelated-0").disks = {"/tmp/b.qcow2": "/images/b.qcow2"}
+
+    assert LibvirtWrapper().backing_stores() == {
+        Path("/images/fedora.qcow2"),
+        Path("/images/b.qcow2"),
+    }
+
+
+def test_create_volume_options(conn):
+    conn.pools = [libvirt.virStoragePool([])]
+    pool = LibvirtWrapper().pool_by_name("default")
+
+    pool.create_volume(
+        "host.qcow2",
+        15,
+        units="G",
+        preallocation="metadata",
+        cluster_size=128,
+        features=["lazy_refcounts", "extended_l2"],
+    )
+    xml, flags = conn.pools[0].created[-1]
+    assert flags == libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+    assert '<clusterSize unit="KiB">128</clusterSize>' in xml
+    assert "<features><lazy_refcounts /><extended_l2 /></features>" in xml
+
+    # full preallocation needs both the flag and the allocation to match the
+    # capacity, otherwise libvirt only preallocates the metadata
+    pool.create_volume("full.qcow2", 15, units="G", preallocation="full")
+    xml, flags = conn.pools[0].created[-1]
+    assert flags == libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+    assert '<capacity unit="G">15</capacity>' in xml
+    assert '<allocation unit="G">15</allocation>' in xml
+
+    with pytest.raises(ValueError):
+        pool.create_volume("host.qcow2", 15, preallocation="falloc")
+
+
+@pytest.mark.parametrize("preallocation", ["metadata", "full"])
+def test_create_volume_overlay_preallocation(conn, tmp_path, preallocation):
+    image = Path(tmp_path, "debian-12.qcow2")
+    image.touch()
+    conn.files[image.as_posix()] = "qcow2"
+    conn.pools = [libvirt.virStoragePool([])]
+
+    # libvirt can't preallocate an overlay, not even with subclusters
+    pool = LibvirtWrapper().pool_by_name("default")
+    with pytest.raises(ValueError):
+        pool.create_volume(
+            "host.qcow2",
+            15,
+            units="G",
+            backing_store=image,
+            preallocation=preallocation,
+            features=["extended_l2"],
+        )
+    assert conn.pools[0].created == []
+
+
+def test_create_volume_backing_format_cache(conn, tmp_path):
+    image = Path(tmp_path, "debian-12.qcow2")
+    image.touch()
+    conn.files[image.as_posix()] = "qcow2"
+    conn.pools = [libvirt.virStoragePool([])]
+
+    pool = LibvirtWrapper().pool_by_name("default")
+    pool.create_volume("host-1.qcow2", 15, backing_store=image)
+    xml, _ = conn.pools[0].created[-1]
+    assert "<backingStore><path>" in xml and '<format type="qcow2" />' in xml
+
+    # the format was probed in a transient pool, which was destroyed
+    assert len(conn.pools) == 2 and not conn.pools[1].active
+
+    # ... and it's not probed again
+    pool.create_volume("host-2.qcow2", 15, backing_store=image)
+    assert len(conn.pools) == 2
+    assert conn.pools[0].created[-1][0] == xml.replace("host-1", "host-2")
+
+    # unless the image changes
+    conn.files[image.as_posix()] = "raw"
+    os.utime(image, ns=(0, 0))
+    pool.create_volume("host-3.qcow2", 15, backing_store=image)
+    assert len(conn.pools) == 3
+    assert '<format type="raw" />' in conn.pools[0].created[-1][0]
@@ -5,6 +5,10 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 from fnmatch import fnmatch
+import hashlib
+import re
+import subprocess
+import yaml
 import pytest
 
 import test_utils.utils as test_utils
@@ -155,3 +159,197 @@ def test_generate(assert_equal, targets, packages, projects, monkeypatch):
                 )
 
             manifest.generate()
+
+
+def generate_gitlab(targets, packages, projects, monkeypatch, tmp_path, **gitlab):
+    """Generate the CI files of the test manifest with extra gitlab settings."""
+
+    manifest_path = Path(test_utils.test_data_indir(__file__), "manifest.yml")
+    values = util.load_yaml(manifest_path.read_text())
+    values["gitlab"].update(gitlab)
+    manifest_path = Path(tmp_path, "manifest.yml")
+    manifest_path.write_text(yaml.safe_dump(values))
+
+    test_utils.force_load(packages=packages, projects=projects, targets=targets)
+
+    writes = {}
+
+    def fake_write(path, content):
+        writes[path.as_posix()] = content
+
+    with monkeypatch.context() as m:
+        m.setattr(util, "generate_file_header", lambda cliargv: "")
+        m.setattr(util, "atomic_write", fake_write)
+        m.setattr(Path, "mkdir", lambda self, **kwargs: None)
+        m.setattr(Path, "unlink", lambda self, **kwargs: None)
+
+        with open(manifest_path, "r") as fp:
+            manifest = Manifest(targets, packages, projects, fp, quiet=True)
+        manifest.generate()
+
+    return writes
+
+
+def test_generate_parallel_matrix(
+    assert_equal, targets, packages, projects, monkeypatch, tmp_path
+):
+    writes = generate_gitlab(
+        targets, packages, projects, monkeypatch, tmp_path, **{"parallel-matrix": True}
+    )
+
+    outdir = Path(test_utils.test_data_outdir(__file__), "parallel-matrix")
+    for name in ["containers.yml", "builds.yml"]:
+        assert_equal(writes[f"ci/gitlab/{name}"], Path(outdir, name))
+
+    # the templates and any other file are generated as usual
+    expected = Path(test_utils.test_data_outdir(__file__), "ci/gitlab")
+    assert_equal(
+        writes["ci/gitlab/build-templates.yml"],
+        Path(expected, "build-templates.yml"),
+    )
+
+
+def test_generate_container_cache(
+    assert_equal, targets, packages, projects, monkeypatch, tmp_path
+):
+    writes = generate_gitlab(
+        targets, packages, projects, monkeypatch, tmp_path, **{"container-cache": True}
+    )
+
+    outdir = Path(test_utils.test_data_outdir(__file__), "container-cache")
+    assert_equal(
+        writes["ci/gitlab/container-templates.yml"],
+        Path(outdir, "container-templates.yml"),
+    )
+
+    # the publishing rules are left alone
+    expected = Path(test_utils.test_data_outdir(__file__), "ci/gitlab")
+    rules = Path(expected, "container-templates.yml").read_text().split("rules:")[1]
+    assert writes["ci/gitlab/container-templates.yml"].endswith(rules)
+
+
+def test_generate_content_tags(
+    assert_equal, targets, packages, projects, monkeypatch, tmp_path
+):
+    writes = generate_gitlab(
+        targets, packages, projects, monkeypatch, tmp_path, **{"content-tags": True}
+    )
+
+    outdir = Path(test_utils.test_data_outdir(__file__), "content-tags")
+    for name in [
+        "container-templates.yml",
+        "containers.yml",
+        "build-templates.yml",
+        "builds.yml",
+    ]:
+        assert_equal(writes[f"ci/gitlab/{name}"], Path(outdir, name))
+
+    # the tags are the digests of the Dockerfiles, without their header
+    containers = yaml.safe_load(writes["ci/gitlab/containers.yml"])
+    variables = containers["x86_64-debian-12-container"]["variables"]
+    dockerfile = writes["ci/containers/debian-12.Dockerfile"]
+    digest = hashlib.sha256(dockerfile[:-1].encode()).hexdigest()
+    tag = "sha256-" + digest[: Manifest.CONTAINER_TAG_LENGTH]
+    assert variables["CONTAINER_TAG"] == tag
+
+
+def rules_when(rules, variables):
+    """
+    Evaluate the rules of a GitLab job for a pipeline without file changes.
+
+    Only the subset of the expression syntax used by the templates is
+    supported: '&&' of '==', '!=' and '=~' comparisons and bare variables.
+    """
+
+    def _value(operand):
+        if operand.startswith("$"):
+            return variables.get(operand[1:], "")
+        return operand.strip('"')
+
+    def _match(condition):
+        match = re.fullmatch(r"(\$\w+)(?: (==|!=|=~) (.+))?", condition)
+        assert match, condition
+        lhs, op, rhs = match.groups()
+        if op is None:
+            return bool(_value(lhs))
+        if op == "=~":
+            return re.search(rhs.strip("/"), _value(lhs)) is not None
+        return (_value(lhs) == _value(rhs)) == (op == "==")
+
+    for rule in rules:
+        if "changes" in rule:
+            continue
+        if "if" not in rule or all(map(_match, rule["if"].split(" && "))):
+            return rule["when"]
+    return "never"
+
+
+def run_container_script(job, tmp_path, published, **variables):
+    """Run the script of a container job, returning the docker commands."""
+
+    calls = Path(tmp_path, "calls")
+    calls.write_text("")
+    docker = f"""
+        docker() {{
+            echo "$*" >> {calls}
+            if test "$1 $2" = "manifest inspect"; then
+                {"true" if published else "false"}
+            fi
+        }}
+    """
+    script = "\n".join([docker] + job["before_script"] + job["script"])
+    env = {
+        "PATH": "/usr/bin:/bin",
+        "CI_REGISTRY_IMAGE": "registry.example.org/group/project",
+        "NAME": "fedora-rawhide",
+        "CONTAINER_TAG": "sha256-0123456789abcdef",
+    }
+    env.update(variables)
+    subprocess.run(["sh", "-e", "-c", script], env=env, check=True)
+    return [c.split()[0] for c in calls.read_text().splitlines()]
+
+
+def test_content_tags_container_jobs(
+    targets, packages, projects, monkeypatch, tmp_path
+):
+    writes = generate_gitlab(
+        targets, packages, projects, monkeypatch, tmp_path, **{"content-tags": True}
+    )
+    job = yaml.safe_load(writes["ci/gitlab/container-templates.yml"])[".container_job"]
+
+    upstream = {
+        "CI_PROJECT_NAMESPACE": "test-group",
+        "RUN_UPSTREAM_NAMESPACE": "test-group",
+        "CI_DEFAULT_BRANCH": "main",
+        "CI_COMMIT_REF_NAME": "main",
+        "CI_COMMIT_BRANCH": "main",
+    }
+
+    # scheduled pipelines in upstream run the container jobs without forcing
+    # them, so that the missing tags get published...
+    for source in ["schedule", "web", "api"]:
+        pipeline = dict(upstream, CI_PIPELINE_SOURCE=source)
+        assert rules_when(job["rules"], pipeline) == "on_success"
+    pipeline = dict(
+        upstream, CI_PIPELINE_SOURCE="schedule", CI_PROJECT_NAMESPACE="fork"
+    )
+    assert rules_when(job["rules"], pipeline) == "never"
+    pipeline = dict(upstream, CI_PIPELINE_SOURCE="merge_request_event")
+    assert rules_when(job["rules"], pipeline) == "never"
+
+    # ... while the tags which were published already aren't built again,
+    # unless re-publishing is forced
+    assert "build" not in run_container_script(job, tmp_path, published=True)
+    assert "build" in run_container_script(job, tmp_path, published=False)
+    calls = run_container_script(
+        job, tmp_path, published=True, RUN_CONTAINER_BUILDS="1"
+    )
+    assert calls.count("push") == 2
+
+    # without content tags, the container jobs only run when forced
+    writes = generate_gitlab(targets, packages, projects, monkeypatch, tmp_path)
+    job = yaml.safe_load(writes["ci/gitlab/container-templates.yml"])[".container_job"]
+    pipeline = dict(upstream, CI_PIPELINE_SOURCE="schedule")
+    assert rules_when(job["rules"], pipeline) == "never"
+    pipeline["RUN_CONTAINER_BUILDS"] = "1"
+    assert rules_when(job["rules"], pipeline) == "on_success"
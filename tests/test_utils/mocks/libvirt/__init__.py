@@ -1,13 +1,265 @@
-from typing import Any
+from typing import Any, Dict, List, Optional
 
+VIR_CONNECT_LIST_DOMAINS_PERSISTENT = 4
+VIR_CONNECT_LIST_DOMAINS_TRANSIENT = 8
 
-def virConnect() -> Any:
-    pass
+VIR_DOMAIN_AFFECT_LIVE = 1
+VIR_DOMAIN_AFFECT_CONFIG = 2
 
+VIR_DOMAIN_METADATA_ELEMENT = 2
 
-class virStoragePool:
+VIR_ERR_NO_DOMAIN_METADATA = 80
+
+VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE = 0
+VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT = 1
+
+VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA = 1
+
+VIR_IP_ADDR_TYPE_IPV4 = 0
+VIR_IP_ADDR_TYPE_IPV6 = 1
+
+LCITOOL_METADATA = "<host><target>{}</target></host>"
+
+
+class libvirtError(Exception):
+    def __init__(self, message: str, code: int = 0) -> None:
+        super().__init__(message)
+        self._code = code
+
+    def get_error_code(self) -> int:
+        return self._code
+
+
+def registerErrorHandler(handler: Any, ctx: Any) -> None:
     pass
 
 
+class virDomain:
+    """Domain whose every method but name() and UUIDString() is an RPC."""
+
+    def __init__(
+        self,
+        conn: "virConnect",
+        name: str,
+        uuid: str,
+        target: Optional[str],
+        persistent: bool,
+    ) -> None:
+        self._conn = conn
+        self._name = name
+        self._uuid = uuid
+        self._persistent = persistent
+        self.target = target
+        self.addresses: Dict[int, Dict[str, Any]] = {}
+        self.active = True
+
+        # disk path -> backing store path
+        self.disks: Dict[str, str] = {}
+
+    def name(self) -> str:
+        return self._name
+
+    def UUIDString(self) -> str:
+        return self._uuid
+
+    def isPersistent(self) -> bool:
+        self._conn.round_trips += 1
+        return self._persistent
+
+    def isActive(self) -> bool:
+        self._conn.round_trips += 1
+        return self.active
+
+    def XMLDesc(self, flags: int = 0) -> str:
+        self._conn.round_trips += 1
+        disks = "".join(
+            f"<disk><source file='{disk}'/><backingStore type='file'>"
+            f"<source file='{backing}'/></backingStore></disk>"
+            for disk, backing in self.disks.items()
+        )
+        return f"<domain><name>{self._name}</name><devices>{disks}</devices></domain>"
+
+    def shutdown(self) -> int:
+        self._conn.round_trips += 1
+        self.active = False
+        return 0
+
+    def destroy(self) -> int:
+        self._conn.round_trips += 1
+        self.active = False
+        return 0
+
+    def undefine(self) -> int:
+        self._conn.round_trips += 1
+        del self._conn.domains[self._name]
+        return 0
+
+    def metadata(self, type: int, uri: str, flags: int = 0) -> str:
+        self._conn.round_trips += 1
+        if self.target is None:
+            raise libvirtError("metadata not found", VIR_ERR_NO_DOMAIN_METADATA)
+        return LCITOOL_METADATA.format(self.target)
+
+    def interfaceAddresses(self, source: int, flags: int = 0) -> Dict[str, Any]:
+        self._conn.round_trips += 1
+        if source not in self.addresses:
+            raise libvirtError("source not available")
+        return self.addresses[source]
+
+    def setMetadata(
+        self, type: int, metadata: str, key: str, uri: str, flags: int = 0
+    ) -> int:
+        self._conn.round_trips += 1
+        start = metadata.index("<target>") + len("<target>")
+        self.target = metadata[start : metadata.index("</target>")]
+        return 0
+
+
+class virConnect:
+    """Connection counting the round trips to the (fake) daemon."""
+
+    def __init__(self, uri: Optional[str] = None) -> None:
+        self.uri = uri
+        self.round_trips = 0
+        self.domains: Dict[str, virDomain] = {}
+        self.pools: List[virStoragePool] = []
+
+        # image files outside of any pools: path -> format
+        self.files: Dict[str, str] = {}
+
+    def add_domain(
+        self, name: str, target: Optional[str] = None, persistent: bool = True
+    ) -> virDomain:
+        uuid = f"00000000-0000-0000-0000-{len(self.domains):012d}"
+        dom = virDomain(self, name, uuid, target, persistent)
+        self.domains[name] = dom
+        return dom
+
+    def listAllDomains(self, flags: int = 0) -> List[virDomain]:
+        self.round_trips += 1
+        doms = list(self.domains.values())
+        if flags & VIR_CONNECT_LIST_DOMAINS_PERSISTENT:
+            doms = [d for d in doms if d._persistent]
+        if flags & VIR_CONNECT_LIST_DOMAINS_TRANSIENT:
+            doms = [d for d in doms if not d._persistent]
+        return doms
+
+    def listAllStoragePools(self, flags: int = 0) -> List["virStoragePool"]:
+        self.round_trips += 1
+        return self.pools
+
+    def storagePoolLookupByName(self, name: str) -> "virStoragePool":
+        self.round_trips += 1
+        for pool in self.pools:
+            if pool._name == name:
+                return pool
+        raise libvirtError(f"storage pool '{name}' not found")
+
+    def storagePoolCreateXML(self, xml: str, flags: int = 0) -> "virStoragePool":
+        """Create a transient 'dir' pool of the images in 'files'."""
+
+        self.round_trips += 1
+        name = xml[xml.index("<name>") + 6 : xml.index("</name>")]
+        path = xml[xml.index("<path>") + 6 : xml.index("</path>")]
+        volumes = [
+            virStorageVol(file, format=format)
+            for file, format in self.files.items()
+            if file.rsplit("/", 1)[0] == path
+        ]
+        pool = virStoragePool(volumes, name=name, path=path)
+        self.pools.append(pool)
+        return pool
+
+    def storageVolLookupByPath(self, path: str) -> "virStorageVol":
+        self.round_trips += 1
+        for pool in self.pools:
+            for vol in pool.volumes:
+                if pool.active and vol.path() == path:
+                    return vol
+        raise libvirtError(f"storage volume '{path}' not found")
+
+    def lookupByName(self, name: str) -> virDomain:
+        self.round_trips += 1
+        try:
+            return self.domains[name]
+        except KeyError:
+            raise libvirtError(f"domain '{name}' not found")
+
+
+connections: List[virConnect] = []
+
+
+def open(name: Optional[str] = None) -> virConnect:
+    conn = virConnect(name)
+    connections.append(conn)
+    return conn
+
+
 class virStorageVol:
-    pass
+    def __init__(
+        self, path: str, backing: Optional[str] = None, format: str = "qcow2"
+    ) -> None:
+        self._path = path
+        self._backing = backing
+        self._format = format
+
+    def name(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def path(self) -> str:
+        return self._path
+
+    def XMLDesc(self, flags: int = 0) -> str:
+        backing = ""
+        if self._backing:
+            backing = f"<backingStore><path>{self._backing}</path></backingStore>"
+        return (
+            f"<volume><target><path>{self._path}</path>"
+            f"<format type='{self._format}'/></target>{backing}</volume>"
+        )
+
+
+class virStoragePool:
+    def __init__(
+        self,
+        volumes: List[virStorageVol],
+        active: bool = True,
+        name: str = "default",
+        path: str = "/pool",
+    ) -> None:
+        self.volumes = volumes
+        self.active = active
+        self._name = name
+        self._path = path
+
+        # XML descriptions and flags of the created volumes
+        self.created: List[Any] = []
+
+    def name(self) -> str:
+        return self._name
+
+    def isActive(self) -> bool:
+        return self.active
+
+    def refresh(self, flags: int = 0) -> int:
+        return 0
+
+    def destroy(self) -> int:
+        self.active = False
+        return 0
+
+    def listAllVolumes(self, flags: int = 0) -> List[virStorageVol]:
+        return self.volumes
+
+    def createXML(self, xml: str, flags: int = 0) -> virStorageVol:
+        self.created.append((xml, flags))
+        name = xml[xml.index("<name>") + 6 : xml.index("</name>")]
+        vol = virStorageVol(f"{self._path}/{name}")
+        self.volumes.append(vol)
+        return vol
+
+    def storageVolLookupByName(self, name: str) -> virStorageVol:
+        for vol in self.volumes:
+            if vol.name() == name:
+                return vol
+        raise libvirtError(f"storage volume '{name}' not found")